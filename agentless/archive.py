@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+from agentless.compression import open_compressor
+
+LAYER_FOLDER = "layerfiles"
+LAYER_TAR = "layer.tar"
+TOSEND = "tosend"
+MANIFEST = "manifest.json"
+# layer.tar is kept in memory up to this size before spilling to a temporary file
+LAYER_SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+
+def tree_order(path):
+    """
+    Sort key matching tarfile.add recursion, parent first and siblings sorted by name
+    :param path: str
+    :return: list
+    """
+    return path.split("/")
+
+
+class Layer:
+    """
+    layer.tar spooled in scratch with the sha256 digest of its bytes
+    """
+
+    def __init__(self, fileobj, size, digest):
+        self.fileobj = fileobj
+        self.size = size
+        self.digest = digest
+
+
+class _HashingWriter:
+    """
+    Computes sha256 of the bytes passing through, so the digest needs no second read of the layer
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+
+class ArchiveBuilder:
+    """
+    Writes the tosend.tar.gz layout consumed by the scanner in a single pass:
+
+        tosend/
+        tosend/<digest>/
+        tosend/<digest>/layer.tar     compressed tar of layerfiles/<source path>
+        tosend/manifest.json
+
+    digest is the sha256 of layer.tar computed while it is written. layer.tar only depends on the
+    content and metadata of the source files, so identical files always give the same digest.
+
+    Source files are read in place from the mounted snapshot and nothing is written back to it, only
+    layer.tar is spooled, into spool_dir, because its size has to be known before its header is
+    written into tosend.tar.gz. Both tars are compressed
+    with the configured codec, gzip level 9 matches the former tarfile "w:gz" output
+    """
+
+    def __init__(self, logger, codec="gzip", level=9, threads=None, spool_dir=None):
+        self.logger = logger
+        self.spool_dir = spool_dir
+        self.codec = codec
+        self.level = level
+        self.threads = threads
+
+    @contextmanager
+    def compressed_tar(self, fileobj):
+        """
+        Streaming tar writer compressing into fileobj
+        :param fileobj: obj
+        :return: TarFile
+        """
+        compressor = open_compressor(fileobj, codec=self.codec, level=self.level, threads=self.threads)
+        try:
+            with tarfile.open(fileobj=compressor, mode="w|") as tar:
+                yield tar
+        finally:
+            compressor.close()
+
+    @staticmethod
+    def directory_info(name, mtime=None):
+        """
+        Tar header for a directory created by the agent
+        :param name: str
+        :param mtime: float, defaults to now
+        :return: TarInfo
+        """
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o755
+        tarinfo.mtime = time.time() if mtime is None else mtime
+        tarinfo.uid, tarinfo.gid = os.getuid(), os.getgid()
+        return tarinfo
+
+    def build_layer(self, members, fileobj, extra, deadline=None):
+        """
+        Write compressed tar of layerfiles directory straight from source files
+        :param members: list of (source_path, arcname)
+        :param fileobj: obj
+        :param extra: dict
+        :param deadline: Deadline, checked before every file
+        :return:
+        """
+        sources = dict((arcname, source_path) for source_path, arcname in members)
+        # directory mtime is the newest mtime of the files below it, never the time of the scan
+        directories = {}
+        for arcname, source_path in sources.items():
+            mtime = int(os.stat(source_path).st_mtime)
+            parent = os.path.dirname(arcname)
+            while parent:
+                directories[parent] = max(directories.get(parent, 0), mtime)
+                parent = os.path.dirname(parent)
+        with self.compressed_tar(fileobj) as tar:
+            for name in sorted(set(directories) | set(sources), key=tree_order):
+                if name in directories:
+                    tar.addfile(self.directory_info(name, mtime=directories[name]))
+                    continue
+                if deadline is not None:
+                    deadline.check()
+                # fstat of the opened file follows symlinks like the former shutil.copy did
+                with open(sources[name], "rb") as source:
+                    tar.addfile(tar.gettarinfo(arcname=name, fileobj=source), source)
+                self.logger.debug("Added {} as {}".format(sources[name], name), extra=extra)
+
+    @contextmanager
+    def layer(self, members, extra, deadline=None):
+        """
+        Build layer.tar into a scratch spool and compute its digest inline
+        :param members: list of (source_path, arcname)
+        :param extra: dict
+        :param deadline: Deadline
+        :return: Layer
+        """
+        with tempfile.SpooledTemporaryFile(max_size=LAYER_SPOOL_MAX_SIZE, dir=self.spool_dir) as spool:
+            writer = _HashingWriter(spool)
+            self.build_layer(members, writer, extra, deadline=deadline)
+            spool.seek(0)
+            layer = Layer(spool, writer.size, writer.sha256.hexdigest())
+            self.logger.info("Layer built size {} digest {}".format(layer.size, layer.digest), extra=extra)
+            yield layer
+
+    @staticmethod
+    def manifest(digest):
+        """
+        manifest.json content
+        :param digest: str
+        :return: bytes
+        """
+        manifest_dict = [
+            {
+                "RepoTags": [
+                    "vm"
+                ],
+                "Layers": [
+                    "{}/{}".format(digest, LAYER_TAR)
+                ]
+            }
+        ]
+        return json.dumps(manifest_dict, indent=3).encode("utf-8")
+
+    def write_archive(self, layer, fileobj, extra):
+        """
+        Write tosend.tar.gz into fileobj
+        :param layer: Layer
+        :param fileobj: obj
+        :param extra: dict
+        :return:
+        """
+        layer.fileobj.seek(0)
+        manifest = self.manifest(layer.digest)
+        with self.compressed_tar(fileobj) as tar:
+            tar.addfile(self.directory_info(TOSEND))
+            tar.addfile(self.directory_info("{}/{}".format(TOSEND, layer.digest)))
+            tarinfo = tarfile.TarInfo("{}/{}/{}".format(TOSEND, layer.digest, LAYER_TAR))
+            tarinfo.size, tarinfo.mode, tarinfo.mtime = layer.size, 0o644, time.time()
+            tarinfo.uid, tarinfo.gid = os.getuid(), os.getgid()
+            tar.addfile(tarinfo, layer.fileobj)
+            tarinfo = tarfile.TarInfo("{}/{}".format(TOSEND, MANIFEST))
+            tarinfo.size, tarinfo.mode, tarinfo.mtime = len(manifest), 0o644, time.time()
+            tarinfo.uid, tarinfo.gid = os.getuid(), os.getgid()
+            tar.addfile(tarinfo, BytesIO(manifest))
+        self.logger.debug("Archive written codec {} level {} layer size {} digest {}".format(self.codec, self.level, layer.size, layer.digest), extra=extra)
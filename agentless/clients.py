@@ -0,0 +1,94 @@
+import threading
+
+import boto3
+from botocore.config import Config
+
+# Connections a single in flight job may hold per service, s3transfer uses 10 threads per upload
+POOL_CONNECTIONS_PER_JOB = {
+    "ec2": 2,
+    "s3": 10,
+}
+# botocore default
+MIN_POOL_CONNECTIONS = 10
+
+
+class ClientRegistry:
+    """
+    Process wide cache of boto3 clients keyed by service, region and role. Clients are thread safe
+    and keep their HTTP connection pool alive, so the service model is loaded once per key and
+    concurrent jobs share keep-alive connections instead of building a new client per call
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.concurrency = 1
+        self.rate_limiter = None
+        self.created = 0
+        self.reused = 0
+
+    def configure(self, concurrency):
+        """
+        Size connection pools for the scan concurrency. Cached clients whose pool is too small are
+        dropped and created again on their next use, callers holding them keep working
+        :param concurrency: int
+        :return: int, clients dropped
+        """
+        with self.lock:
+            self.concurrency = concurrency
+            small = [key for key, client in self.clients.items() if client.meta.config.max_pool_connections < self.max_pool_connections(key[0])]
+            for key in small:
+                del self.clients[key]
+            return len(small)
+
+    def use_rate_limiter(self, rate_limiter):
+        """
+        Limit request rates of clients created from now on
+        :param rate_limiter: ApiRateLimiter
+        :return:
+        """
+        with self.lock:
+            self.rate_limiter = rate_limiter
+
+    def max_pool_connections(self, service):
+        """
+        Connection pool size for the service
+        :param service: str
+        :return: int
+        """
+        return max(MIN_POOL_CONNECTIONS, POOL_CONNECTIONS_PER_JOB.get(service, 1) * self.concurrency)
+
+    def get_client(self, service, region, role=None, endpoint_url=None):
+        """
+        Get cached client, creating it on first use. boto3 sessions are not thread safe so every
+        client gets its own session and creation happens under the registry lock
+        :param service: str
+        :param region: str
+        :param role: str
+        :param endpoint_url: str, local stand-in endpoint for tests
+        :return: obj
+        """
+        key = (service, region, role, endpoint_url)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is not None:
+                self.reused += 1
+                return client
+            config = Config(max_pool_connections=self.max_pool_connections(service))
+            client = boto3.session.Session(region_name=region).client(service, config=config, endpoint_url=endpoint_url)
+            if self.rate_limiter is not None:
+                self.rate_limiter.register(service, client)
+            self.clients[key] = client
+            self.created += 1
+            return client
+
+    def stats(self):
+        """
+        Client creations versus reuses
+        :return: dict
+        """
+        with self.lock:
+            return {'created': self.created, 'reused': self.reused}
+
+
+registry = ClientRegistry()
@@ -0,0 +1,165 @@
+"""
+Compression codecs for scan archives
+
+gzip    single threaded zlib, level 9 is what tarfile "w:gz" used
+pgzip   pigz style, input is cut into blocks compressed in parallel as separate gzip members,
+        concatenated members are still a valid gzip stream for any gzip reader
+zstd    requires the optional zstandard package
+
+Benchmark on real package databases:
+
+    python -m agentless.compression /var/lib/rpm/Packages /var/lib/dpkg/status
+"""
+import gzip
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ("gzip", "pgzip", "zstd")
+EXTENSIONS = {"gzip": ".gz", "pgzip": ".gz", "zstd": ".zst"}
+# Compression levels accepted by every codec
+LEVELS = {"gzip": (0, 9), "pgzip": (0, 9), "zstd": (1, 22)}
+# Input block compressed as one gzip member by pgzip
+PGZIP_BLOCK_SIZE = 1024 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def shared_executor(threads):
+    """
+    Thread pool shared by all pgzip writers so that parallel jobs do not oversubscribe the cores,
+    zlib releases the GIL while compressing. The pool is sized by the first writer, the writers of
+    a scan all use the same thread count
+    :param threads: int
+    :return: ThreadPoolExecutor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="pgzip")
+        return _executor
+
+
+def extension(codec):
+    """
+    File extension of codec
+    :param codec: str
+    :return: str
+    """
+    return EXTENSIONS[codec]
+
+
+class ParallelGzipWriter:
+    """
+    Writable file object compressing blocks on the shared thread pool, compressed members are
+    written to fileobj in input order. Closing the writer does not close fileobj.
+    """
+
+    def __init__(self, fileobj, level, threads):
+        """
+        :param fileobj: obj
+        :param level: int
+        :param threads: int
+        """
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = max(threads, 1)
+        self.max_pending = self.threads * 2
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= PGZIP_BLOCK_SIZE:
+            self.submit(bytes(self.buffer[:PGZIP_BLOCK_SIZE]))
+            del self.buffer[:PGZIP_BLOCK_SIZE]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append(shared_executor(self.threads).submit(gzip.compress, block, compresslevel=self.level, mtime=0))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buffer or not self.pending:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.closed = True
+
+
+def open_compressor(fileobj, codec="gzip", level=9, threads=None):
+    """
+    Writable file object compressing into fileobj, closing it flushes the compressor but leaves
+    fileobj open
+    :param fileobj: obj
+    :param codec: str
+    :param level: int
+    :param threads: int, defaults to all cores
+    :return: obj
+    """
+    threads = threads or os.cpu_count() or 1
+    if codec == "gzip":
+        # mtime 0 keeps the output a function of the input only
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level, mtime=0)
+    if codec == "pgzip":
+        return ParallelGzipWriter(fileobj, level=level, threads=threads)
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor(level=level, threads=threads).stream_writer(fileobj, closefd=False)
+    raise ValueError("Unknown compression codec {} expected one of {}".format(codec, CODECS))
+
+
+class _CountingSink:
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def benchmark(paths, configurations):
+    """
+    Compress every file with every codec configuration
+    :param paths: list
+    :param configurations: list of (codec, level)
+    :return: list of (path, codec, level, seconds, input bytes, output bytes)
+    """
+    results = []
+    for path in paths:
+        with open(path, "rb") as source:
+            data = source.read()
+        for codec, level in configurations:
+            sink = _CountingSink()
+            started = time.monotonic()
+            compressor = open_compressor(sink, codec=codec, level=level)
+            for index in range(0, len(data), 64 * 1024):
+                compressor.write(data[index:index + 64 * 1024])
+            compressor.close()
+            results.append((path, codec, level, time.monotonic() - started, len(data), sink.size))
+    return results
+
+
+if __name__ == '__main__':
+    configurations = [("gzip", 9), ("gzip", 6), ("gzip", 1), ("pgzip", 9), ("pgzip", 6), ("pgzip", 1)]
+    if zstandard is not None:
+        configurations += [("zstd", 3), ("zstd", 9), ("zstd", 19)]
+    print("{:<40} {:<6} {:>5} {:>9} {:>12} {:>12} {:>7}".format("file", "codec", "level", "seconds", "bytes in", "bytes out", "ratio"))
+    for path, codec, level, seconds, size_in, size_out in benchmark(sys.argv[1:], configurations):
+        print("{:<40} {:<6} {:>5} {:>9.3f} {:>12} {:>12} {:>7.2f}".format(path, codec, level, seconds, size_in, size_out, size_in / max(size_out, 1)))
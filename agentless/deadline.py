@@ -0,0 +1,69 @@
+import time
+
+# Share of the job time budget every stage may use at most, stages not listed are only bound by the
+# job deadline. Shares add up to more than 1 as a job rarely uses every budget to the full
+STAGE_BUDGETS = {
+    "reserve": 0.2,
+    "create": 0.1,
+    "attach": 0.1,
+    "mount": 0.05,
+    "capture": 0.4,
+    "upload": 0.4,
+}
+
+
+class DeadlineExceeded(Exception):
+    """
+    Job or stage ran out of its time budget, the job is cancelled and its volume torn down
+    """
+
+
+class Deadline:
+    """
+    Time budget of a scan job. The job deadline is fixed when the job starts, every stage gets a
+    budget derived from it and ends at the earlier of the stage budget and the job deadline. Waits
+    take their timeout from the remaining time, retries and I/O loops check it between steps
+    """
+
+    def __init__(self, seconds, budgets=None):
+        """
+        :param seconds: float, job time budget
+        :param budgets: dict of stage to share of seconds
+        """
+        self.seconds = float(seconds)
+        self.budgets = STAGE_BUDGETS if budgets is None else budgets
+        self.expires = time.monotonic() + self.seconds
+        self.stage = None
+        self.stage_expires = self.expires
+
+    def enter(self, stage):
+        """
+        Start the budget of stage, raises when the job deadline has passed already
+        :param stage: str
+        :return:
+        """
+        self.check()
+        self.stage = stage
+        share = self.budgets.get(stage)
+        self.stage_expires = self.expires if share is None else min(self.expires, time.monotonic() + share * self.seconds)
+
+    def remaining(self):
+        """
+        Seconds left in the current stage
+        :return: float
+        """
+        return max(0.0, self.stage_expires - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        """
+        Raise DeadlineExceeded when the current stage or the job is out of time
+        :return:
+        """
+        if not self.expired():
+            return
+        if self.stage_expires < self.expires:
+            raise DeadlineExceeded("Stage {} exceeded its budget of {:.1f}s".format(self.stage, self.budgets[self.stage] * self.seconds))
+        raise DeadlineExceeded("Job exceeded its deadline of {:.1f}s in stage {}".format(self.seconds, self.stage))
@@ -0,0 +1,227 @@
+import glob
+import os
+import threading
+import time
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+SYS_BLOCK = "/sys/block"
+DEV = "/dev"
+DEV_BY_ID = "/dev/disk/by-id"
+# udev link of an EBS volume on Nitro instances, the NVMe serial is the volume id without its dash
+EBS_BY_ID = "nvme-Amazon_Elastic_Block_Store_{}"
+# Attachments shared by EBS volumes, network interfaces and instance store volumes on most Nitro types
+NITRO_ATTACHMENT_LIMIT = 28
+# Volumes AWS supports attaching to Xen instances before boot issues appear
+XEN_ATTACHMENT_LIMIT = 40
+# Boot signature ending the first sector of an MBR partitioned disk, GPT disks carry a protective MBR
+MBR_SIGNATURE = b"\x55\xaa"
+# Offset of the four MBR partition entries, a zero type byte marks an unused entry
+MBR_PARTITIONS = 446
+MBR_ENTRY_SIZE = 16
+# Former fixed slot pool, used when the instance type cannot be described
+LEGACY_DEVICE_NAMES = tuple("/dev/sd{}".format(letter) for letter in "fghijklmnop")
+
+
+def candidate_device_names():
+    """
+    Device names recommended by AWS for EBS data volumes on Linux, /dev/sd[f-z] then /dev/xvd[b-c][a-z]
+    :return: list
+    """
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    names = ["/dev/sd{}".format(letter) for letter in letters[letters.index("f"):]]
+    return names + ["/dev/xvd{}{}".format(prefix, letter) for prefix in "bc" for letter in letters]
+
+
+def attachment_limit(instance_type):
+    """
+    EBS volumes the instance type can attach, network interfaces and instance store volumes take
+    their share of the Nitro limit unless the type has a dedicated EBS limit
+    :param instance_type: dict, DescribeInstanceTypes entry
+    :return: int
+    """
+    ebs_info = instance_type.get("EbsInfo", {})
+    if ebs_info.get("AttachmentLimitType") == "dedicated" and ebs_info.get("MaximumEbsAttachments"):
+        return ebs_info["MaximumEbsAttachments"]
+    if instance_type.get("Hypervisor") != "nitro":
+        return XEN_ATTACHMENT_LIMIT
+    instance_store = sum(disk["Count"] for disk in instance_type.get("InstanceStorageInfo", {}).get("Disks", []))
+    return NITRO_ATTACHMENT_LIMIT - instance_store
+
+
+def slot_device_names(instance_type, instance, pool):
+    """
+    Device names for scan volumes, as many as the instance can attach next to its own volumes and
+    network interfaces. Volumes attached under a pool name are scans in progress and keep their slot
+    :param instance_type: dict, DescribeInstanceTypes entry
+    :param instance: dict, DescribeInstances entry of this instance
+    :param pool: set, device names already in the slot pool
+    :return: list
+    """
+    foreign = set(mapping["DeviceName"] for mapping in instance.get("BlockDeviceMappings", []) if mapping["DeviceName"] not in pool)
+    capacity = attachment_limit(instance_type) - len(foreign)
+    if instance_type.get("EbsInfo", {}).get("AttachmentLimitType") != "dedicated" and instance_type.get("Hypervisor") == "nitro":
+        capacity -= len(instance.get("NetworkInterfaces", []))
+    names = [name for name in candidate_device_names() if name not in foreign and name.replace("/dev/xvd", "/dev/sd") not in foreign]
+    return names[:max(capacity, 0)]
+
+
+class _WakeHandler(FileSystemEventHandler):
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    def on_any_event(self, event):
+        self.resolver.wake()
+
+
+class BlockDeviceResolver:
+    """
+    Resolves an attached EBS volume to its block device and root partition from /sys/block and the
+    udev links in /dev/disk/by-id, the lookup is keyed by the volume id so concurrent attaches never
+    resolve to each other's disk.
+
+    Nitro exposes volumes as NVMe namespaces whose serial is the volume id, Xen instances keep the
+    requested device name with the sd prefix renamed to xvd. Waiters are woken by inotify events on
+    /dev instead of polling
+    """
+
+    def __init__(self, logger, extra):
+        self.logger = logger
+        self.extra = extra
+        self.condition = threading.Condition()
+        self.observer = None
+
+    def watch(self):
+        """
+        Start watching device nodes and udev links once
+        :return:
+        """
+        with self.condition:
+            if self.observer is not None:
+                return
+            self.observer = Observer()
+            handler = _WakeHandler(self)
+            for path in (DEV, DEV_BY_ID):
+                if os.path.isdir(path):
+                    self.observer.schedule(handler, path, recursive=False)
+            self.observer.daemon = True
+            self.observer.start()
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    @staticmethod
+    def read(path):
+        try:
+            with open(path) as file:
+                return file.read().strip()
+        except OSError:
+            return None
+
+    def nvme_disk(self, volume_id):
+        """
+        Disk name of a volume on Nitro. The udev link is only created once the kernel has scanned the
+        partition table, the sysfs serial is the fallback for images without the udev link
+        :param volume_id: str
+        :return: str or None
+        """
+        serial = volume_id.replace("-", "")
+        link = os.path.join(DEV_BY_ID, EBS_BY_ID.format(serial))
+        if os.path.exists(link):
+            return os.path.basename(os.path.realpath(link))
+        if glob.glob(os.path.join(DEV_BY_ID, EBS_BY_ID.format("*"))):
+            # udev links EBS volumes on this host, wait for the link of this one
+            return None
+        for path in glob.glob(os.path.join(SYS_BLOCK, "nvme*")):
+            if self.read(os.path.join(path, "device", "serial")) == serial:
+                return os.path.basename(path)
+        return None
+
+    @staticmethod
+    def xen_disk(device_name):
+        """
+        Disk name of a volume attached under device_name on Xen
+        :param device_name: str, /dev/sdX
+        :return: str or None
+        """
+        name = os.path.basename(device_name)
+        for candidate in (name, "xvd" + name[2:] if name.startswith("sd") else name):
+            if os.path.isdir(os.path.join(SYS_BLOCK, candidate)):
+                return candidate
+        return None
+
+    @staticmethod
+    def partitioned(disk):
+        """
+        Does the disk start with a partition table
+        :param disk: str
+        :return: bool or None when the disk cannot be read
+        """
+        try:
+            with open(os.path.join(DEV, disk), "rb") as device:
+                sector = device.read(512)
+        except OSError:
+            return None
+        return sector[510:512] == MBR_SIGNATURE and any(sector[MBR_PARTITIONS + index * MBR_ENTRY_SIZE + 4] for index in range(4))
+
+    def root_partition(self, disk):
+        """
+        Largest partition of the disk, which skips BIOS boot and EFI partitions, or the disk itself
+        when it has no partition table. The kernel adds the partitions of a new disk after the disk,
+        a partitioned disk without them is not resolved until the partition scan has settled
+        :param disk: str
+        :return: str or None
+        """
+        partitions = [os.path.basename(os.path.dirname(path)) for path in glob.glob(os.path.join(SYS_BLOCK, disk, "*", "partition"))]
+        if not partitions:
+            return None if self.partitioned(disk) else disk
+        return max(partitions, key=lambda name: int(self.read(os.path.join(SYS_BLOCK, disk, name, "size")) or 0))
+
+    def resolve(self, volume_id, device_name):
+        """
+        Device node of the root partition of an attached volume
+        :param volume_id: str
+        :param device_name: str, device requested in AttachVolume
+        :return: str or None
+        """
+        disk = self.nvme_disk(volume_id) or self.xen_disk(device_name)
+        if disk is None:
+            return None
+        partition = self.root_partition(disk)
+        if partition is None:
+            return None
+        path = os.path.join(DEV, partition)
+        return path if os.path.exists(path) else None
+
+    def wait(self, volume_id, device_name, timeout, extra):
+        """
+        Block until the volume's root partition appears
+        :param volume_id: str
+        :param device_name: str
+        :param timeout: int
+        :param extra: dict
+        :return: str or None
+        """
+        self.watch()
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                path = self.resolve(volume_id, device_name)
+                if path:
+                    self.logger.info("Volume {} resolved to {}".format(volume_id, path), extra=extra)
+                    return path
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.logger.error("Volume {} device did not appear".format(volume_id), extra=extra)
+                    return None
+                self.condition.wait(remaining)
+
+    def stop(self):
+        with self.condition:
+            if self.observer is None:
+                return
+            self.observer.stop()
+            self.observer = None
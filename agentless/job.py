@@ -0,0 +1,33 @@
+import uuid
+
+
+class ScanJob:
+    """
+    Per snapshot scan context, every job carries its own device, mount and logging state
+    so that several snapshots can be processed in parallel by the same AgentLess instance
+    """
+
+    def __init__(self, tenant_id, scan_id, instance_id, snapshot_id, extra):
+        self.tenant_id = tenant_id
+        self.scan_id = scan_id
+        self.instance_id = instance_id
+        self.snapshot_id = snapshot_id
+        self.extra = dict(extra, snapshotId=str(snapshot_id))
+        self.volume_id = None
+        # idempotency token of CreateVolume, a retried create that already succeeded returns its volume
+        self.client_token = uuid.uuid4().hex
+        self.device = None
+        # owner token of the device slot lease, a slot is only released with the token it was leased under
+        self.device_lease = None
+        self.device_m = None
+        self.mounted_path = None
+        self.scratch_path = None
+        self.object_name = None
+        # provisioning profile of the volume and MB/s read from it while capturing
+        self.volume_profile = None
+        self.read_throughput = None
+        # Deadline, set when the job starts, teardowns run without one
+        self.deadline = None
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(snapshot_id = {self.snapshot_id})(instance_id = {self.instance_id})"
@@ -0,0 +1,66 @@
+import time
+
+# Stages of a snapshot scan job in completion order
+CREATED = "created"
+ATTACHED = "attached"
+MOUNTED = "mounted"
+CAPTURED = "captured"
+UPLOADED = "uploaded"
+STAGES = (CREATED, ATTACHED, MOUNTED, CAPTURED, UPLOADED)
+# Stages whose volume may be reused by a resumed job
+VOLUME_STAGES = (CREATED, ATTACHED, MOUNTED)
+# Seconds journal entries are kept after their last update
+JOURNAL_RETENTION = 7 * 24 * 3600
+
+
+class StageJournal:
+    """
+    SQLite journal of completed job stages and their artifacts, keyed by tenant, scan, instance and
+    snapshot so that a scan submitted again resumes its jobs: an uploaded job is skipped, a spooled
+    archive is left to the upload spool and a volume still present is attached and mounted again
+    instead of created from the snapshot
+    """
+
+    def __init__(self, utility, logger):
+        """
+        :param utility: Utility
+        :param logger: obj
+        """
+        self.utility = utility
+        self.logger = logger
+
+    @staticmethod
+    def key(job):
+        return {'tenant_id': str(job.tenant_id), 'scan_id': str(job.scan_id), 'instance_id': str(job.instance_id), 'snapshot_id': str(job.snapshot_id)}
+
+    def lookup(self, job):
+        """
+        Journal entry of job
+        :param job: ScanJob
+        :return: dict or None
+        """
+        return self.utility.get_stage(self.key(job), logger=self.logger, extra=job.extra)
+
+    def record(self, job, stage, **artifacts):
+        """
+        Record stage of job as completed
+        :param job: ScanJob
+        :param stage: str
+        :param artifacts: JobStage columns
+        :return: bool
+        """
+        self.logger.debug("Stage {} completed {}".format(stage, artifacts), extra=job.extra)
+        return self.utility.save_stage(self.key(job), stage, artifacts, logger=self.logger, extra=job.extra)
+
+    @staticmethod
+    def reached(entry, stage):
+        """
+        Has the job of the entry completed stage
+        :param entry: dict or None
+        :param stage: str
+        :return: bool
+        """
+        return entry is not None and STAGES.index(entry['stage']) >= STAGES.index(stage)
+
+    def prune(self, extra):
+        return self.utility.prune_stages(time.time() - JOURNAL_RETENTION, logger=self.logger, extra=extra)
@@ -1,19 +1,37 @@
-import hashlib
+import copy
 import json
 import os
 import shutil
 import subprocess
 import sys
-import tarfile
 import time
+from contextlib import ExitStack
 from functools import wraps
-from tenacity import retry, RetryError, stop_after_attempt, retry_if_exception_type, wait_random_exponential
 
-import boto3
+import shnbin_common
 from botocore.exceptions import ClientError
 from ec2_metadata import ec2_metadata
+from agentless.archive import ArchiveBuilder, LAYER_FOLDER
+from agentless.clients import registry
+from agentless.compression import extension, zstandard, CODECS, LEVELS
+from agentless.deadline import Deadline, DeadlineExceeded
+from agentless.devices import BlockDeviceResolver, LEGACY_DEVICE_NAMES, attachment_limit, slot_device_names
+from agentless.job import ScanJob
+from agentless.journal import StageJournal, CREATED, ATTACHED, MOUNTED, CAPTURED, UPLOADED, VOLUME_STAGES
 from agentless.logger import create_logger
+from agentless.pipeline import Pipeline
+from agentless.prefetch import Prefetcher
+from agentless.profiles import VolumeProfiles, AUTO
+from agentless.ratelimit import ApiRateLimiter
+from agentless.reaper import OrphanReaper, volume_tags, TAG_OWNER_PID
+from agentless.report import ScanReport, REPORT_FOLDER, REUSED
+from agentless.retries import retry_policy, TransientError
+from agentless.scratch import ScratchManager, MB, ARCHIVE_OVERHEAD
+from agentless.spool import UploadSpool, SPOOL_FOLDER
+from agentless.teardown import TeardownQueue
+from agentless.upload import MultipartUploadWriter
 from agentless.utility import Utility
+from agentless.waiter import VolumeWaiter
 import logging.config
 
 # Removed unnecessary logging from boto3, requests, botocore, ec2_metadata, retrying etc
@@ -22,9 +40,69 @@ logging.config.dictConfig({
     'disable_existing_loggers': True,
 })
 
+# Optional keys accepted in the scan request json along with their default values
+DEFAULT_OPTIONS = {
+    # Number of snapshots processed in parallel, bounded by free attach devices
+    "concurrency": 4,
+    # Snapshots whose volume is created, attached and mounted ahead while others are processed
+    "lookahead": 2,
+    # "file" writes tosend.tar.gz to disk and uploads it, "stream" feeds the archive into a multipart upload
+    "uploadMode": "file",
+    "uploadPartSizeMb": 8,
+    # Parts buffered in memory per job while being uploaded in parallel
+    "uploadPartsInFlight": 4,
+    # S3 compatible endpoint used instead of AWS S3, for local testing
+    "s3EndpointUrl": None,
+    # gzip, pgzip (parallel gzip members, readable by any gzip reader) or zstd
+    "compression": "gzip",
+    "compressionLevel": 9,
+    # Threads used by pgzip and zstd, 0 uses all cores
+    "compressionThreads": 0,
+    # Intermediate files are written here, never inside the mounted snapshot volume, tmpfs or NVMe instance store recommended
+    "scratchPath": "/var/tmp/agentless",
+    # Scratch space shared by all jobs, 0 uses 90% of the free space of scratchPath
+    "scratchBudgetMb": 0,
+    # Reserved by a job before its volume is created, resized once the files to archive are known
+    "scratchReserveMb": 256,
+    # Layers are stored once per tenant under their sha256, a layer already stored is copied server side instead of uploaded
+    "dedupLayers": True,
+    # Snapshots are immutable, a snapshot already scanned is copied server side from its previous result
+    "snapshotCache": True,
+    # Also keep the snapshot result index in S3 so that other scanner instances reuse it
+    "snapshotIndexS3": False,
+    # Archives waiting for upload in file mode, must survive restarts, defaults to the app data path
+    "uploadSpoolPath": None,
+    # Archives in the upload spool of all runs, jobs wait for uploads to free space when it is full
+    "uploadSpoolMb": 10240,
+    # Seconds a snapshot may take from provisioning to upload, its stages get a share of it
+    "jobTimeoutSeconds": 3600,
+    # Provisioning profile of scan volumes, auto picks gp3 for snapshots with Fast Snapshot Restore in
+    # this zone and gp3-restore with more IOPS and throughput for lazily restored ones
+    "volumeProfile": AUTO,
+    # Profiles added to or replacing the built in ones, name to CreateVolume arguments
+    "volumeProfiles": {},
+    # Parallel reads of the files to archive shared by all jobs, a restored volume loads blocks from S3 on first read, 0 disables
+    "prefetchThreads": 16,
+    "prefetchChunkKb": 512,
+}
 
-def retry_if_exception(error):
-    return isinstance(error, RetryError)
+# Accepted values of uploadMode
+UPLOAD_MODES = ("file", "stream")
+# Waits of jobs without a deadline, teardowns, are bound by these. Jobs wait as long as their stage budget
+# Seconds a job waits for scratch space before failing
+SCRATCH_WAIT_TIMEOUT = 600
+# Seconds a job waits for space in the upload spool before failing
+SPOOL_WAIT_TIMEOUT = 600
+# Seconds a job waits for a volume to become available, in-use or detached
+VOLUME_STATE_TIMEOUT = 60
+# Seconds a job waits for a free device slot or for its attached volume to appear, as long as the former 20 retries
+DEVICE_WAIT_TIMEOUT = 100
+# Snapshot volumes are mounted under MOUNT_ROOT/tenant_id/scan_id/instance_id/snapshot_id
+MOUNT_ROOT = "/mnt"
+# Errors of a detach or delete whose volume is already detached or deleted
+VOLUME_GONE_ERRORS = ("InvalidVolume.NotFound", "InvalidAttachment.NotFound")
+# Errors of a detach whose volume is not attached, IncorrectState is returned for available volumes
+VOLUME_DETACHED_ERRORS = VOLUME_GONE_ERRORS + ("IncorrectState",)
 
 
 def method_start_end(func):
@@ -45,9 +123,16 @@ class AgentLess:
         self.ec2_client = None
         self.s3_client = None
         self.extra = {'scanId': None, 'tenantId': None}
-        self.device = None
-        self.device_m = None
-        self.cache = {}
+        self.options = dict(DEFAULT_OPTIONS)
+        self.scratch = None
+        self.spool = None
+        self.teardowns = None
+        self.journal = StageJournal(utility, logger)
+        self.volume_profiles = None
+        self.prefetcher = None
+        self.report = None
+        self.volume_waiter = VolumeWaiter(client_factory=self.get_ec2_client, logger=logger, extra=self.extra)
+        self.device_resolver = BlockDeviceResolver(logger=logger, extra=self.extra)
         self.logger = logger
         self.tenant_id = None
         self.scan_id = None
@@ -57,97 +142,164 @@ class AgentLess:
         self.utility = utility
 
     @method_start_end
-    def get_session(self):
-        """
-        Getting AWS Session
-        :return: obj
-        """
-        if 'session' not in self.cache:
-            boto3.setup_default_session(region_name=ec2_metadata.region)
-            self.cache['session'] = boto3.DEFAULT_SESSION
-            self.logger.info("Creation Session..", extra=self.extra)
-        return self.cache['session']
-
-    @method_start_end
-    @retry(stop=stop_after_attempt(10), wait=wait_random_exponential(multiplier=0.5, max=45), retry=retry_if_exception_type(RetryError))
+    @retry_policy
     def get_ec2_client(self):
         """
         Getting Ec2 Client
         :return: obj
         """
-        try:
-            return self.get_session().client("ec2")
-        except Exception as e:
-            self.logger.exception(str(e.args[0]), extra=self.extra)
-            raise RetryError("Retrying Again")
+        return registry.get_client("ec2", ec2_metadata.region, self.instance_role)
 
     @method_start_end
-    @retry(stop=stop_after_attempt(10), wait=wait_random_exponential(multiplier=0.5, max=45), retry=retry_if_exception_type(RetryError))
+    @retry_policy
     def get_s3_client(self, ):
         """
         Get S3 Client
         :return: obj
         """
-        try:
-            return self.get_session().client("s3")
-        except Exception as e:
-            self.logger.exception(str(e.args[0]), extra=self.extra)
-            raise RetryError("Retrying Again")
+        return registry.get_client("s3", ec2_metadata.region, self.instance_role, endpoint_url=self.options["s3EndpointUrl"])
 
     @method_start_end
-    @retry(stop=stop_after_attempt(10), wait=wait_random_exponential(multiplier=0.5, max=45), retry=retry_if_exception_type(RetryError))
-    def upload_to_s3(self, file_path, bucket_name, object_name):
+    @retry_policy
+    def upload_to_s3(self, job, file_path, bucket_name, object_name):
         """
         Upload to S3
+        :param job: ScanJob
         :param file_path: str
         :param bucket_name: str
         :param object_name: str
         :return: bool
         """
-        self.logger.info("Uploading started: to S3 at location: {} bucket name: {} file_path: {}".format(object_name, bucket_name, file_path), extra=self.extra)
+        self.logger.info("Uploading started: to S3 at location: {} bucket name: {} file_path: {}".format(object_name, bucket_name, file_path), extra=job.extra)
+        self.get_s3_client().upload_file(file_path, bucket_name, object_name)
+        self.logger.info("Uploading Completed: to S3 at location: {} bucket name: {} file_path: {}".format(object_name, bucket_name, file_path), extra=job.extra)
+        return True
+
+    @method_start_end
+    @retry_policy
+    def stream_to_s3(self, job, builder, layer, bucket_name, object_name):
+        """
+        Stream tosend.tar.gz into S3 through a multipart upload without writing it to disk
+        :param job: ScanJob
+        :param builder: ArchiveBuilder
+        :param layer: Layer
+        :param bucket_name: str
+        :param object_name: str
+        :return: bool
+        """
+        self.logger.info("Streaming started: to S3 at location: {} bucket name: {}".format(object_name, bucket_name), extra=job.extra)
+        with MultipartUploadWriter(self.get_s3_client(), bucket_name, object_name, logger=self.logger, extra=job.extra,
+                                   part_size=int(self.options["uploadPartSizeMb"]) * 1024 * 1024,
+                                   parts_in_flight=int(self.options["uploadPartsInFlight"]), deadline=job.deadline) as writer:
+            builder.write_archive(layer, writer, job.extra)
+        self.logger.info("Streaming Completed: to S3 at location: {} bucket name: {}".format(object_name, bucket_name), extra=job.extra)
+        return True
+
+    def snapshot_index_key(self, job):
+        """
+        S3 index object of snapshot result agentless-va/tenant_id/snapshots/snapshot_id.json
+        :param job: ScanJob
+        :return: str
+        """
+        return os.path.join('agentless-va', str(job.tenant_id), 'snapshots', '{}.json'.format(job.snapshot_id))
+
+    @method_start_end
+    def find_snapshot_result(self, job):
+        """
+        Key of the previous scan result of the snapshot from local cache or S3 index
+        :param job: ScanJob
+        :return: str or None
+        """
+        key = self.utility.get_snapshot_result(job.snapshot_id, job.tenant_id, self.bucket_name, logger=self.logger, extra=job.extra)
+        if key or not self.options["snapshotIndexS3"]:
+            return key
         try:
-            self.get_s3_client().upload_file(file_path, bucket_name, object_name)
-            self.logger.info("Uploading Completed: to S3 at location: {} bucket name: {} file_path: {}".format(object_name, bucket_name, file_path), extra=self.extra)
-            return True
+            body = self.get_s3_client().get_object(Bucket=self.bucket_name, Key=self.snapshot_index_key(job))["Body"].read()
+            return json.loads(body)["key"]
         except ClientError as e:
-            self.logger.exception(str(e.args[0]), extra=self.extra)
-            raise RetryError("Retrying Again")
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
 
     @method_start_end
-    def create_path_with_parent_directory_if_not_exists(self, path):
+    def reuse_snapshot_result(self, job, object_name):
+        """
+        Server side copy of the previous result of the snapshot to the scan location
+        :param job: ScanJob
+        :param object_name: str
+        :return: bool
+        """
+        try:
+            prior_key = self.find_snapshot_result(job)
+            # result of another codec has another archive name
+            if not prior_key or os.path.basename(prior_key) != os.path.basename(object_name):
+                return False
+            if prior_key != object_name:
+                self.get_s3_client().copy({'Bucket': self.bucket_name, 'Key': prior_key}, self.bucket_name, object_name)
+            elif not self.s3_object_exists(job, self.bucket_name, object_name):
+                raise ClientError({"Error": {"Code": "NoSuchKey", "Message": object_name}}, "HeadObject")
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                self.logger.exception("Snapshot result reuse failed {}".format(e), extra=job.extra)
+                return False
+            self.logger.warning("Previous result of snapshot missing in S3, scanning again", extra=job.extra)
+            self.utility.forget_snapshot_result(job.snapshot_id, job.tenant_id, self.bucket_name, logger=self.logger, extra=job.extra)
+            return False
+        self.save_snapshot_result(job, object_name)
+        self.journal.record(job, UPLOADED, object_name=object_name)
+        self.logger.info("Snapshot already scanned, result {} copied to {}".format(prior_key, object_name), extra=job.extra)
+        return True
+
+    @method_start_end
+    def save_snapshot_result(self, job, object_name):
+        """
+        Record scan result of the snapshot locally and in the S3 index
+        :param job: ScanJob
+        :param object_name: str
+        :return: bool
+        """
+        saved = self.utility.save_snapshot_result(job.snapshot_id, job.tenant_id, self.bucket_name, object_name, logger=self.logger, extra=job.extra)
+        if self.options["snapshotIndexS3"]:
+            try:
+                body = json.dumps({"snapshotId": job.snapshot_id, "key": object_name})
+                self.get_s3_client().put_object(Bucket=self.bucket_name, Key=self.snapshot_index_key(job), Body=body.encode("utf-8"))
+            except ClientError as e:
+                self.logger.exception("Snapshot index upload failed {}".format(e), extra=job.extra)
+                return False
+        return saved
+
+    @method_start_end
+    def create_path_with_parent_directory_if_not_exists(self, job, path):
         """
         Create path with leaves if path does not exist
+        :param job: ScanJob
         :param path: str
         :return: bool
         """
         if os.path.exists(path):
-            self.logger.warning("{} already exists".format(path), extra=self.extra)
+            self.logger.warning("{} already exists".format(path), extra=job.extra)
             return True
         else:
-            self.logger.debug("Creating path {}".format(path), extra=self.extra)
+            self.logger.debug("Creating path {}".format(path), extra=job.extra)
             try:
                 os.makedirs(path)
-                self.logger.debug("Created path {}".format(path), extra=self.extra)
+                self.logger.debug("Created path {}".format(path), extra=job.extra)
                 return True
             except Exception as e:
-                self.logger.exception("Unable to create path {} with leaves {}".format(path, e), extra=self.extra)
+                self.logger.exception("Unable to create path {} with leaves {}".format(path, e), extra=job.extra)
                 return False
 
     @method_start_end
-    def collect_va_files(self, mounted_path, folder_name):
+    def collect_va_files(self, job, mounted_path):
         """
-        Gathering Required Files according to mentioned path list from Current OS and copying contents of existing directories under layerfiles location
+        Gathering Required Files according to mentioned path list from Current OS, files are not copied,
+        the archive reads them in place and stores them under layerfiles location
+        :param job: ScanJob
         :param mounted_path: str
-        :param folder_name: str
-        :return: bool
+        :return: list of (source_path, arcname)
         """
-        # Path till layerfiles /mnt/tenant_id/scan_id/instance_id/snapshot_id/layerfiles
-        layerfiles_path = os.path.join(mounted_path, folder_name)
-        if not self.create_path_with_parent_directory_if_not_exists(path=layerfiles_path):
-            self.logger.error("layerfiles_path {} creation Failed".format(layerfiles_path), extra=self.extra)
-            return False
-        to_hash = ""
-        self.logger.info("Gathering required files for VM\n", extra=self.extra)
+        members = []
+        self.logger.info("Gathering required files for VM\n", extra=job.extra)
         path_list = ["/lib/apk/db/installed",
                      "/var/lib/dpkg/status",
                      "/var/lib/rpm/Packages",
@@ -162,192 +314,250 @@ class AgentLess:
                      "/etc/system-release",
                      "/var/lib/dpkg/status-old",
                      "/etc/apt/sources.list.d/pgdg.list"]
-        # command = "mount - o nouuid ${} /mnt/{}/{}/{}/{}".format(tenant_id, scan_id, device_, instance_id_, snapshot_id_)
         for _path in path_list:
             # source_path = /mnt/tenant_id/scan_id/instance_id/snapshot_id/lib/apk/db/installed
             # mounted_path = /mnt/tenant_id/scan_id/instance_id/snapshot_id
             source_path = os.path.join(mounted_path, _path.lstrip("/").strip())
             if not os.path.exists(source_path):
                 continue
-            # intermediate_path =lib/apk/db
-            intermediate_path = _path.rsplit("/", 1)[0].lstrip("/").strip()
-            # destination_path = /mnt/tenant_id/scan_id/instance_id/snapshot_id/layerfiles/lib/apk/db
-            destination_path = os.path.join(layerfiles_path, intermediate_path)
-            if not self.create_path_with_parent_directory_if_not_exists(destination_path):
-                self.logger.error("destination_path {} creation Failed".format(destination_path), extra=self.extra)
-                return False
-            # source_path = /mnt/tenant_id/scan_id/instance_id/snapshot_id/lib/apk/db/installed   destination_path = /mnt/tenant_id/scan_id/instance_id/snapshot_id/layerfiles/lib/apk/db
-            self.logger.info("Copying files from source_path {} to destination_path {}".format(source_path, destination_path), extra=self.extra)
-            shutil.copy(source_path, destination_path)
-            to_hash += os.path.join(" ", folder_name, _path.lstrip("/").strip())
-        return to_hash
+            # arcname = layerfiles/lib/apk/db/installed
+            arcname = os.path.join(LAYER_FOLDER, _path.lstrip("/").strip())
+            self.logger.info("Collecting file source_path {} as {}".format(source_path, arcname), extra=job.extra)
+            members.append((source_path, arcname))
+        return members
 
     @method_start_end
-    def create_checksum(self, hashable_string):
+    def s3_object_exists(self, job, bucket_name, object_name):
         """
-        Creating sha256 hash
-        :param hashable_string: str
-        :return: string
+        HEAD check of S3 object
+        :param job: ScanJob
+        :param bucket_name: str
+        :param object_name: str
+        :return: bool
         """
-        checksum = hashlib.sha256(hashable_string.encode('utf-8')).hexdigest()
-        self.logger.info("Created checksum {}".format(checksum), extra=self.extra)
-        return checksum
+        try:
+            self.get_s3_client().head_object(Bucket=bucket_name, Key=object_name)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            self.logger.exception(str(e.args[0]), extra=job.extra)
+            raise
 
     @method_start_end
-    def create_tar_file(self, file_path, source_dir):
+    def copy_known_layer(self, job, layer_key, object_name):
         """
-        Creating Tar file using python tar module
-        :param file_path: str
-        :param source_dir: str
-        :return:
+        Server side copy of an already stored layer with the same digest to the scan location
+        :param job: ScanJob
+        :param layer_key: str
+        :param object_name: str
+        :return: bool
         """
+        known = self.utility.is_layer_known(self.bucket_name, layer_key, logger=self.logger, extra=job.extra)
+        if not known and not self.s3_object_exists(job, self.bucket_name, layer_key):
+            return False
         try:
-            with tarfile.open(file_path, "w:gz") as tar:
-                tar.add(source_dir, arcname=os.path.basename(source_dir))
-            self.logger.debug("Tar {} Created".format(file_path), extra=self.extra)
-            return bool(os.path.join(source_dir, file_path))
-        except Exception as e:
-            self.logger.exception("Tar Creation failed {}".format(e), extra=self.extra)
+            self.get_s3_client().copy({'Bucket': self.bucket_name, 'Key': layer_key}, self.bucket_name, object_name)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                raise
+            # removed from S3 since it was indexed, uploaded again
+            self.logger.warning("Layer {} missing in S3".format(layer_key), extra=job.extra)
+            self.utility.forget_layer(self.bucket_name, layer_key, logger=self.logger, extra=job.extra)
             return False
+        if not known:
+            self.utility.save_layer(self.bucket_name, layer_key, os.path.basename(os.path.dirname(layer_key)), logger=self.logger, extra=job.extra)
+        self.logger.info("Upload skipped, layer {} copied to {}".format(layer_key, object_name), extra=job.extra)
+        return True
 
     @method_start_end
-    def move_tar_into_checksum_location(self, src, dest):
+    def publish_layer(self, job, object_name, layer_key, digest):
         """
-        Move Tar file under tosend/checksum location
-        :param src: str
-        :param dest: str
+        Copy uploaded archive to its content address so that next scans of identical files skip the upload
+        :param job: ScanJob
+        :param object_name: str
+        :param layer_key: str
+        :param digest: str
         :return: bool
         """
         try:
-            shutil.move(src, dest)
-            self.logger.debug("layer.tar moved from {} {}".format(src, dest), extra=self.extra)
-            return True
-        except Exception as e:
-            self.logger.exception(str(e.args[0]), extra=self.extra)
+            self.get_s3_client().copy({'Bucket': self.bucket_name, 'Key': object_name}, self.bucket_name, layer_key)
+        except ClientError as e:
+            self.logger.exception("Layer publish to {} failed {}".format(layer_key, e), extra=job.extra)
             return False
+        return self.utility.save_layer(self.bucket_name, layer_key, digest, logger=self.logger, extra=job.extra)
+
+    def archive_builder(self, job):
+        """
+        Archive builder configured from scan options
+        :param job: ScanJob
+        :return: ArchiveBuilder
+        """
+        return ArchiveBuilder(self.logger, codec=self.options["compression"], level=int(self.options["compressionLevel"]),
+                              threads=int(self.options["compressionThreads"]) or None, spool_dir=job.scratch_path)
 
     @method_start_end
-    def create_manifest(self, path, layer_hash):
+    def spool_archive(self, job, builder, layer, layer_key):
         """
-        Creating manifest file under tosend location
-        :param path: str
-        :param layer_hash: str
+        Write tosend.tar.gz into the upload spool and record it for the background uploader
+        :param job: ScanJob
+        :param builder: ArchiveBuilder
+        :param layer: Layer
+        :param layer_key: str
+        :return: str, spool entry id
+        """
+        # the layer and the archive overhead bound the compressed archive
+        spooled = self.spool.write(os.path.basename(job.object_name), lambda spool_file: builder.write_archive(layer, spool_file, job.extra),
+                                   size=layer.size + ARCHIVE_OVERHEAD, timeout=self.wait_timeout(job, SPOOL_WAIT_TIMEOUT), extra=job.extra)
+        if spooled is None:
+            self.check_deadline(job)
+            raise Exception("Upload spool is full")
+        entry_id, path = spooled
+        entry = {'id': entry_id, 'path': path, 'bucket': self.bucket_name, 'object_name': job.object_name, 'layer_key': layer_key, 'digest': layer.digest,
+                 'tenant_id': str(job.tenant_id), 'scan_id': str(job.scan_id), 'instance_id': str(job.instance_id), 'snapshot_id': str(job.snapshot_id)}
+        if not self.utility.save_upload(entry, logger=self.logger, extra=job.extra):
+            os.unlink(path)
+            raise Exception("Upload spool record failed")
+        self.journal.record(job, CAPTURED, spool_id=entry_id, digest=layer.digest, layer_key=layer_key, object_name=job.object_name)
+        self.logger.debug("Archive spooled {}".format(path), extra=job.extra)
+        return entry_id
+
+    def deliver_spooled(self, entry):
+        """
+        Upload a spooled archive, run by the background uploader
+        :param entry: dict, uploadSpool row
+        :return:
+        """
+        job = ScanJob(tenant_id=entry['tenant_id'], scan_id=entry['scan_id'], instance_id=entry['instance_id'], snapshot_id=entry['snapshot_id'], extra=self.extra)
+        job.object_name = entry['object_name']
+        self.report.enter(job, "upload")
+        try:
+            if not (self.options["dedupLayers"] and self.copy_known_layer(job, entry['layer_key'], job.object_name)):
+                self.upload_to_s3(job, file_path=entry['path'], bucket_name=entry['bucket'], object_name=job.object_name)
+                if self.options["dedupLayers"]:
+                    self.publish_layer(job, job.object_name, entry['layer_key'], entry['digest'])
+            if self.options["snapshotCache"]:
+                self.save_snapshot_result(job, job.object_name)
+        except Exception as e:
+            self.report.fail(job, e)
+            raise
+        self.journal.record(job, UPLOADED, object_name=job.object_name)
+        self.report.finish(job)
+
+    def deliver_layer(self, job, builder, layer, layer_key):
+        """
+        Copy an already stored identical layer or stream the archive into S3, a failure is raised
+        chained to the error that caused it
+        :param job: ScanJob
+        :param builder: ArchiveBuilder
+        :param layer: Layer
+        :param layer_key: str
         :return: bool
         """
         try:
-            manifest_dict = [
-                {
-                    "RepoTags": [
-                        "vm"
-                    ],
-                    "Layers": [
-                        "{}/layer.tar".format(layer_hash)
-                    ]
-                }
-            ]
-            out_file = open(os.path.join(path, 'manifest.json'), 'w')
-            json.dump(manifest_dict, out_file, indent=3)
-            self.logger.debug("manifest.json created", extra=self.extra)
+            if not (self.options["dedupLayers"] and self.copy_known_layer(job, layer_key, job.object_name)):
+                self.stream_to_s3(job, builder, layer, bucket_name=self.bucket_name, object_name=job.object_name)
+                if self.options["dedupLayers"]:
+                    self.publish_layer(job, job.object_name, layer_key, layer.digest)
+            if self.options["snapshotCache"]:
+                self.save_snapshot_result(job, job.object_name)
+            self.journal.record(job, UPLOADED, digest=layer.digest, layer_key=layer_key, object_name=job.object_name)
+            self.report.finish(job)
             return True
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            self.logger.exception(str(e.args[0]), extra=self.extra)
-            return False
+            self.logger.exception("Archive upload failed {}".format(e), extra=job.extra)
+            raise Exception("Upload To S3 Failed") from e
 
     @method_start_end
-    def create_volume(self, snapshot_id, count=0):
+    def create_volume(self, job):
         """
         Create Volume
-        :param count: int
-        :param snapshot_id: str
+        :param job: ScanJob
         :return: str or None
         """
-
+        job.volume_profile, arguments = self.volume_profiles.select(job.snapshot_id)
+        self.logger.info("Creating volume with profile {} {}".format(job.volume_profile, arguments), extra=job.extra)
+        self.report.annotate(job, volumeProfile=job.volume_profile)
         client = self.get_ec2_client()
-        response = self._create_volume(client, snapshot_id)
+        response = self._create_volume(job, client, job.snapshot_id, arguments)
         volume_id = response["VolumeId"]
-        return self.is_volume_ready(count, volume_id)
+        return self.is_volume_ready(job, volume_id)
 
     @method_start_end
-    def is_volume_ready(self, count, volume_id):
+    def is_volume_ready(self, job, volume_id):
         """
         Check volume is up or not for attach
-        :param count: int
+        :param job: ScanJob
         :param volume_id: str
         :return: str/bool
         """
-        state = self.describe_volume(volume_id=volume_id)
-        while state != "available":
-            time.sleep(5)
-            state = self.describe_volume(volume_id=volume_id)
-            if count == 10:
-                self.logger.error("Volume creation timed out!".format(volume_id), extra=self.extra)
-                return False
-            count += 1
-        else:
-            self.logger.debug("State is {} for Volume id {}".format(state, volume_id), extra=self.extra)
-            return volume_id
+        state = self.volume_waiter.wait(volume_id, states=("available",), timeout=self.wait_timeout(job, VOLUME_STATE_TIMEOUT), extra=job.extra)
+        if state != "available":
+            self.check_deadline(job)
+            self.logger.error("Volume {} creation timed out! state {}".format(volume_id, state), extra=job.extra)
+            return False
+        self.logger.debug("State is {} for Volume id {}".format(state, volume_id), extra=job.extra)
+        return volume_id
 
     @method_start_end
-    @retry(stop=stop_after_attempt(15), wait=wait_random_exponential(multiplier=0.5, max=45), retry=retry_if_exception_type(RetryError))
-    def _create_volume(self, client, snapshot_id):
+    @retry_policy
+    def _create_volume(self, job, client, snapshot_id, arguments):
         """
         Private Create Volume
+        :param job: ScanJob
         :param client: obj
         :param snapshot_id: str
+        :param arguments: dict, type, IOPS and throughput of the volume profile
         :return:
         """
-        try:
-            response = client.create_volume(
-                AvailabilityZone=ec2_metadata.availability_zone,
-                Iops=100,
-                SnapshotId=snapshot_id,
-                VolumeType='io1',
-                MultiAttachEnabled=True,
-            )
-            return response
-        except Exception as e:
-            self.logger.exception(str(e.args[0]), extra=self.extra)
-            raise RetryError("Retrying Again Private Create volume")
+        return client.create_volume(
+            AvailabilityZone=ec2_metadata.availability_zone,
+            SnapshotId=snapshot_id,
+            # same token on every retry, a create that timed out after succeeding does not create a second volume
+            ClientToken=job.client_token,
+            # owner tags let the reaper of a later run find the volume if this process dies
+            TagSpecifications=volume_tags(self.ec2_instance_id, job),
+            **arguments
+        )
 
     @method_start_end
-    def attach_volume(self, instance_id, volume_id, count=0):
+    def attach_volume(self, job, instance_id, volume_id):
         """
         Attach Volume
-        :param count: int
+        :param job: ScanJob
         :param instance_id: str
         :param volume_id: str
         :return: bool
         """
         client = self.get_ec2_client()
-        self._attach_volume(client, instance_id, volume_id)
-        return self.is_volume_attached(count, instance_id, volume_id)
+        self._attach_volume(job, client, instance_id, volume_id)
+        return self.is_volume_attached(job, instance_id, volume_id)
 
     @method_start_end
-    def is_volume_attached(self, count, instance_id, volume_id):
+    def is_volume_attached(self, job, instance_id, volume_id):
         """
         Check if volume Attached or not
-        :param count: int
+        :param job: ScanJob
         :param instance_id: str
         :param volume_id: str
         :return: bool
         """
-        state = self.describe_volume(volume_id=volume_id)
-        while state != 'in-use':
-            time.sleep(5)
-            state = self.describe_volume(volume_id=volume_id)
-            if count == 10:
-                self.logger.error("Attaching Volume timeout", extra=self.extra)
-                return False
-            count += 1
-        else:
-            self.logger.debug("State is {} for volume {} and instance {}".format(state, volume_id, instance_id), extra=self.extra)
-            return True
+        state = self.volume_waiter.wait(volume_id, states=("in-use",), timeout=self.wait_timeout(job, VOLUME_STATE_TIMEOUT), extra=job.extra)
+        if state != 'in-use':
+            self.check_deadline(job)
+            self.logger.error("Attaching Volume timeout state {}".format(state), extra=job.extra)
+            return False
+        self.logger.debug("State is {} for volume {} and instance {}".format(state, volume_id, instance_id), extra=job.extra)
+        return True
 
     @method_start_end
-    @retry(stop=stop_after_attempt(15), wait=wait_random_exponential(multiplier=0.5, max=45), retry=retry_if_exception_type(RetryError))
-    def _attach_volume(self, client, instance_id, volume_id):
+    @retry_policy
+    def _attach_volume(self, job, client, instance_id, volume_id):
         """
         Private Attach Volume
+        :param job: ScanJob
         :param client: obj
         :param instance_id: str
         :param volume_id: str
@@ -355,95 +565,83 @@ class AgentLess:
         """
         try:
             client.attach_volume(
-                Device=self.device,
+                Device=job.device,
                 InstanceId=instance_id,
                 VolumeId=volume_id,
             )
-        except Exception as e:
-            self.logger.exception(str(e.args[0]), extra=self.extra)
-            self.device = self.get_device()
-            raise RetryError("Retrying Again Private Attach volume")
-
-    @method_start_end
-    @retry(stop=stop_after_attempt(15), wait=wait_random_exponential(multiplier=0.5, max=45), retry=retry_if_exception_type(RetryError))
-    def describe_volume(self, volume_id):
-        """
-        Describe Volume
-        :param volume_id: str
-        :return: str
-        """
-        client = self.get_ec2_client()
-        try:
-            response = client.describe_volumes(
-                VolumeIds=[
-                    volume_id
-                ]
-            )
-            return response["Volumes"][0]["State"]
-        except Exception as e:
-            self.logger.exception(str(e.args[0]), extra=self.extra)
-            raise RetryError("Retrying Again Describe volume..")
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidParameterValue" or "already in use" not in str(e):
+                raise
+            # taken by an attachment outside the slot pool, the slot stays leased so no job gets it again
+            self.logger.warning("Device {} is in use, attaching under another slot".format(job.device), extra=job.extra)
+            job.device = self.get_device(job)
+            if not job.device:
+                raise
+            raise TransientError("Device in use") from e
 
     @method_start_end
-    def detach_volume(self, instance_id, volume_id, count=0):
+    def detach_volume(self, job, instance_id, volume_id):
         """
-        Detach Volume
-        :param count: int
+        Detach Volume, a volume already detached or deleted counts as detached
+        :param job: ScanJob
         :param instance_id: str
         :param volume_id: str
         :return: bool
         """
         client = self.get_ec2_client()
-        self._detach_volume(client, instance_id, volume_id)
-        return self.is_volume_detached(count, instance_id, volume_id)
+        if not self._detach_volume(job, client, instance_id, volume_id):
+            return True
+        return self.is_volume_detached(job, instance_id, volume_id)
 
     @method_start_end
-    def is_volume_detached(self, count, instance_id, volume_id):
+    def is_volume_detached(self, job, instance_id, volume_id):
         """
         Is Volume Detached
-        :param count: int
+        :param job: ScanJob
         :param instance_id: str
         :param volume_id: str
         :return: bool
         """
-        state = self.describe_volume(volume_id=volume_id)
-        while state != 'available':
-            time.sleep(5)
-            state = self.describe_volume(volume_id=volume_id)
-            if count == 10:
-                self.logger.error("DeAttaching Volume timeout!", extra=self.extra)
-                return False
-            count += 1
-        else:
-            self.logger.debug("State is {} for volume {} and instance {}".format(state, volume_id, instance_id), extra=self.extra)
-            return True
+        state = self.volume_waiter.wait(volume_id, states=('available',), timeout=VOLUME_STATE_TIMEOUT, extra=job.extra)
+        if state != 'available':
+            self.logger.error("DeAttaching Volume timeout! state {}".format(state), extra=job.extra)
+            return False
+        self.logger.debug("State is {} for volume {} and instance {}".format(state, volume_id, instance_id), extra=job.extra)
+        return True
 
     @method_start_end
-    @retry(stop=stop_after_attempt(15), wait=wait_random_exponential(multiplier=0.5, max=45), retry=retry_if_exception_type(RetryError))
-    def _detach_volume(self, client, instance_id, volume_id):
+    @retry_policy
+    def _detach_volume(self, job, client, instance_id, volume_id):
         """
         Private Detach Volume
+        :param job: ScanJob
         :param client: obj
         :param instance_id: str
         :param volume_id: str
-        :return:
+        :return: bool, False when the volume is not attached
         """
         try:
+            # a resumed teardown whose device slot was taken over by a live scan detaches by volume only
+            device = {'Device': job.device} if job.device else {}
             client.detach_volume(
-                Device=self.device,
                 Force=True,
                 InstanceId=instance_id,
-                VolumeId=volume_id
+                VolumeId=volume_id,
+                **device
             )
-        except Exception as e:
-            self.logger.exception(str(e.args[0]) + "retrying Private Detach Volume", extra=self.extra)
-            raise RetryError("Retrying Again")
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in VOLUME_DETACHED_ERRORS:
+                self.logger.debug("Volume {} is not attached".format(volume_id), extra=job.extra)
+                return False
+            raise
 
     @method_start_end
-    @retry(stop=stop_after_attempt(15), wait=wait_random_exponential(multiplier=0.5, max=45), retry=retry_if_exception_type(RetryError))
-    def mount_volume(self, path, tenant_id, scan_id, instance_id, snapshot_id):
+    @retry_policy
+    def mount_volume(self, job, path, tenant_id, scan_id, instance_id, snapshot_id):
         """
         Mount Volume
+        :param job: ScanJob
         :param path: str
         :param scan_id: str
         :param tenant_id: str
@@ -451,37 +649,54 @@ class AgentLess:
         :param snapshot_id: str
         :return: bool
         """
-        self.device_m = self.get_device_mount()
-        try:
-            format_dict = {
-                "path": path,
-                "device": self.device_m,
-                "instance_id": instance_id,
-                "snapshot_id": snapshot_id,
-                "tenant_id": tenant_id,
-                "scan_id": scan_id
-            }
-            command = "mount -o nouuid {device} {path}/{tenant_id}/{scan_id}/{instance_id}/{snapshot_id}".format(**format_dict)
-            return_code = subprocess.call([command], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            return not bool(return_code)
-        except Exception as e:
-            self.logger.exception(str(e.args[0]) + "retrying Mount Volume", extra=self.extra)
-            raise RetryError("Retrying Again")
+        job.device_m = self.device_resolver.wait(job.volume_id, job.device, timeout=self.wait_timeout(job, DEVICE_WAIT_TIMEOUT), extra=job.extra)
+        if not job.device_m:
+            self.check_deadline(job)
+            return False
+        format_dict = {
+            "path": path,
+            "device": job.device_m,
+            "instance_id": instance_id,
+            "snapshot_id": snapshot_id,
+            "tenant_id": tenant_id,
+            "scan_id": scan_id
+        }
+        # noatime, reading the files in place must not write access times back to the restored volume
+        command = "mount -o nouuid,noatime {device} {path}/{tenant_id}/{scan_id}/{instance_id}/{snapshot_id}".format(**format_dict)
+        return_code = subprocess.call([command], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        return not bool(return_code)
 
     @method_start_end
-    @retry(stop=stop_after_attempt(15), wait=wait_random_exponential(multiplier=0.5, max=45), retry=retry_if_exception_type(RetryError))
-    def unmount_volume(self):
+    @retry_policy
+    def unmount_volume(self, job):
         """
-        Unmount volume
+        Unmount volume by its mount point, the device node is not known to a resumed teardown
+        :param job: ScanJob
         :return: bool
         """
-        try:
-            command = "umount --force {}".format(self.device_m)
-            return_code = subprocess.call([command], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            return not bool(return_code)
-        except Exception as e:
-            self.logger.exception(str(e.args[0]) + "retrying Unmount Volume", extra=self.extra)
-            raise RetryError("Retrying Again")
+        return_code = subprocess.call(["umount", "--force", job.mounted_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return not bool(return_code)
+
+    @method_start_end
+    def validate_options(self):
+        """
+        Reject option values every job would fail with
+        :return:
+        """
+        if self.options["compression"] not in CODECS:
+            raise Exception("compression {} is not one of {}".format(self.options["compression"], CODECS))
+        if self.options["compression"] == "zstd" and zstandard is None:
+            raise Exception("compression zstd requires the zstandard package")
+        level = self.options["compressionLevel"]
+        if isinstance(level, str) and level.strip().lstrip("-").isdigit():
+            level = int(level)
+        if isinstance(level, bool) or not isinstance(level, int):
+            raise Exception("compressionLevel {!r} is not an integer".format(self.options["compressionLevel"]))
+        lowest, highest = LEVELS[self.options["compression"]]
+        if not lowest <= level <= highest:
+            raise Exception("compressionLevel {} of {} is not in {}-{}".format(level, self.options["compression"], lowest, highest))
+        if self.options["uploadMode"] not in UPLOAD_MODES:
+            raise Exception("uploadMode {} is not one of {}".format(self.options["uploadMode"], UPLOAD_MODES))
 
     @method_start_end
     def parse_args(self, param_string):
@@ -491,254 +706,466 @@ class AgentLess:
         snapshot_data_ = json_data["snapshotData"]
         bucket_name = json_data["bucketName"]
         instance_role = json_data["roleName"]
+        self.options = {key: json_data.get(key, value) for key, value in DEFAULT_OPTIONS.items()}
         self.logger.info("tenantId = {tenantId} scanId={scanId} bucketName={bucketName} instanceRole={roleName}".format(**json_data), extra=self.extra)
+        self.logger.info("options = {}".format(self.options), extra=self.extra)
+        try:
+            self.validate_options()
+        except Exception as e:
+            self.logger.error("Invalid options {}".format(e), extra=self.extra)
+            raise
         return tenant_id, scan_id, snapshot_data_, bucket_name, instance_role
 
     @method_start_end
-    def get_device(self, count=0):
-        """
-        Get Available Device for attaching
-        :param count: int
-        :return: bool
-        """
-        self.device = self.utility.get_device(logger=self.logger, extra=self.extra)['device']
-        while not self.device:
-            self.logger.info("No devices are free retrying again", extra=self.extra)
-            time.sleep(5)
-            self.device = self.utility.get_device(logger=self.logger, extra=self.extra)['device']
-            if count == 20:
-                self.logger.error("Devices timeout!", extra=self.extra)
-                return False
-            count += 1
-        else:
-            return self.device
-
-    @method_start_end
-    def get_device_mount(self, count=0):
+    def get_device(self, job):
         """
-        Get Available Device for mounting
-        :param count: int
+        Get Available Device for attaching, waits until another job releases one
+        :param job: ScanJob
         :return: bool
         """
-        self.device_m = self.utility.get_device_mount(logger=self.logger, extra=self.extra)['device']
-        while not self.device_m:
-            self.logger.info("No new mounted device found retrying again", extra=self.extra)
-            time.sleep(5)
-            self.device_m = self.utility.get_device_mount(logger=self.logger, extra=self.extra)['device']
-            if count == 20:
-                self.logger.error("Devices timeout!", extra=self.extra)
-                return False
-            count += 1
-        else:
-            return self.device_m
+        leased = self.utility.acquire_device(timeout=self.wait_timeout(job, DEVICE_WAIT_TIMEOUT), logger=self.logger, extra=job.extra)
+        if not leased['device']:
+            self.check_deadline(job)
+            self.logger.error("Devices timeout!", extra=job.extra)
+            return False
+        job.device_lease = leased['owner']
+        return leased['device']
 
     @method_start_end
-    def delete_volume(self, volume_id):
+    def delete_volume(self, job, volume_id):
         """
-        Delete Volume
+        Delete Volume, a volume already deleted counts as deleted
+        :param job: ScanJob
         :param volume_id: str
         :return: bool
         """
         client = self.get_ec2_client()
-        response = self._delete_volume(client, volume_id)
-        if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-            self.logger.debug("Volume {} deleted ".format(volume_id), extra=self.extra)
+        response = self._delete_volume(job, client, volume_id)
+        if response is None or response['ResponseMetadata']['HTTPStatusCode'] == 200:
+            self.logger.debug("Volume {} deleted ".format(volume_id), extra=job.extra)
             return True
         else:
-            self.logger.error("Volume {} deletion timeout ".format(volume_id), extra=self.extra)
+            self.logger.error("Volume {} deletion timeout ".format(volume_id), extra=job.extra)
             return False
 
     @method_start_end
-    @retry(stop=stop_after_attempt(15), wait=wait_random_exponential(multiplier=0.5, max=45), retry=retry_if_exception_type(RetryError))
-    def _delete_volume(self, client, volume_id):
+    @retry_policy
+    def _delete_volume(self, job, client, volume_id):
         """
         Private Delete Volume
+        :param job: ScanJob
         :param client: obj
         :param volume_id: str
-        :return: dict
+        :return: dict or None when the volume no longer exists
         """
         try:
             response = client.delete_volume(
                 VolumeId=volume_id,
             )
             return response
-        except Exception as e:
-            self.logger.exception(str(e.args[0]) + "retrying Private Delete Volume", extra=self.extra)
-            raise RetryError("Retrying Again Private Delete Volume")
-
-    def main(self, instance_id, snapshot_id):
-        folder = "layerfiles"
-        tar_file_name = "layer.tar"
-        tosend = 'tosend'
-        # todo path need to decide
-        path = r"/mnt"
-        tosend_tar_gz = "tosend.tar.gz"
-        volume_id = self.create_volume(snapshot_id=snapshot_id)
-        self.device = self.get_device()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in VOLUME_GONE_ERRORS:
+                self.logger.debug("Volume {} already deleted".format(volume_id), extra=job.extra)
+                return None
+            raise
+
+    def provision(self, job):
+        """
+        Create, attach and mount the volume of the snapshot
+        :param job: ScanJob
+        :return: bool, False when a previous result of the snapshot was reused and nothing is left to process
+        """
+        path = MOUNT_ROOT
+        tosend_tar_gz = "tosend.tar" + extension(self.options["compression"])
+        instance_id, snapshot_id = job.instance_id, job.snapshot_id
+        object_name = job.object_name = os.path.join('agentless-va', str(job.tenant_id), str(job.scan_id), str(instance_id), str(snapshot_id), tosend_tar_gz)
+        self.enter_stage(job, "create")
+        entry = self.journal.lookup(job)
+        if self.journal.reached(entry, UPLOADED) and entry['object_name'] == object_name:
+            self.logger.info("Snapshot already uploaded to {} by a previous run".format(object_name), extra=job.extra)
+            self.report.finish(job, REUSED)
+            return False
+        if self.journal.reached(entry, CAPTURED) and entry['object_name'] == object_name and self.utility.upload_spooled(entry['spool_id'], logger=self.logger, extra=job.extra):
+            # queued by the spool resume of this run, which reports the outcome
+            self.logger.info("Snapshot archive already spooled by a previous run, only the upload is resumed", extra=job.extra)
+            self.report.pause(job)
+            return False
+        # mounted_path = /mnt/tenant_id/scan_id/instance_id/snapshot_id
+        mounted_path = job.mounted_path = "{}/{}/{}/{}/{}".format(path, job.tenant_id, job.scan_id, instance_id, snapshot_id)
+        # scratch_path = scratchPath/tenant_id/scan_id/instance_id/snapshot_id
+        job.scratch_path = self.scratch.job_path(job)
+        if self.options["snapshotCache"] and self.reuse_snapshot_result(job, object_name):
+            if job.volume_id:
+                # volume resumed from a previous run is not needed
+                self.cleanup(job)
+            self.report.finish(job, REUSED)
+            return False
+        volume_id = job.volume_id = job.volume_id or self.create_volume(job)
         if not volume_id:
-            self.logger.error("There is some problem in creating volume", extra=self.extra)
+            self.logger.error("There is some problem in creating volume", extra=job.extra)
             raise Exception("There is some problem in creating volume")
-        if not self.device:
-            self.logger.error("There is some problem in getting device", extra=self.extra)
-            raise Exception("There is some problem in getting device")
-        self.logger.info("Volume_id ={} device= {}".format(volume_id, self.device), extra=self.extra)
-        if not self.attach_volume(instance_id=self.ec2_instance_id, volume_id=volume_id):
-            self.logger.error("There is some problem in attaching Volume {} on instance_id {}".format(volume_id, self.ec2_instance_id), extra=self.extra)
-            raise Exception("There is some problem in attaching Volume {} on instance_id {}".format(volume_id, self.ec2_instance_id))
-        # mounted_path = /mnt/tenant_id/scan_id/instance_id/snapshot_id
-        mounted_path = "{}/{}/{}/{}/{}".format(path, self.tenant_id, self.scan_id, instance_id, snapshot_id)
-        if not self.create_path_with_parent_directory_if_not_exists(path=mounted_path):
-            self.logger.error("mounted_path {} creation failed".format(mounted_path), extra=self.extra)
+        self.journal.record(job, CREATED, volume_id=volume_id, device=None, mounted_path=None, spool_id=None)
+        self.enter_stage(job, "attach")
+        if not job.device:
+            job.device = self.get_device(job)
+            if not job.device:
+                job.device = None
+                self.cleanup(job)
+                self.logger.error("There is some problem in getting device", extra=job.extra)
+                raise Exception("There is some problem in getting device")
+            self.logger.info("Volume_id ={} device= {}".format(volume_id, job.device), extra=job.extra)
+            if not self.attach_volume(job, instance_id=self.ec2_instance_id, volume_id=volume_id):
+                self.cleanup(job)
+                self.logger.error("There is some problem in attaching Volume {} on instance_id {}".format(volume_id, self.ec2_instance_id), extra=job.extra)
+                raise Exception("There is some problem in attaching Volume {} on instance_id {}".format(volume_id, self.ec2_instance_id))
+        self.journal.record(job, ATTACHED, device=job.device)
+        self.enter_stage(job, "mount")
+        if not self.create_path_with_parent_directory_if_not_exists(job, path=mounted_path):
+            self.cleanup(job)
+            self.logger.error("mounted_path {} creation failed".format(mounted_path), extra=job.extra)
             raise Exception("mounted_path {} creation failed".format(mounted_path))
 
-        if not self.mount_volume(path=path, tenant_id=self.tenant_id, scan_id=self.scan_id, instance_id=instance_id, snapshot_id=snapshot_id):
-            self.detach_volume(instance_id=self.ec2_instance_id, volume_id=volume_id)
-            self.utility.release_device(device=self.device, logger=self.logger, extra=self.extra)
-            self.delete_volume(volume_id=volume_id)
-            self.cleanup_directories(path=path)
-            self.logger.error("There is some problem in mounting volume", extra=self.extra)
+        if not os.path.ismount(mounted_path) and not self.mount_volume(job, path=path, tenant_id=job.tenant_id, scan_id=job.scan_id, instance_id=instance_id, snapshot_id=snapshot_id):
+            self.cleanup(job)
+            self.logger.error("There is some problem in mounting volume", extra=job.extra)
             raise Exception("There is some problem in mounting volume")
+        self.journal.record(job, MOUNTED, mounted_path=mounted_path)
+        # waiting for a free worker
+        self.enter_stage(job, "ready")
+        return True
 
-        file_hash = self.collect_va_files(mounted_path=mounted_path, folder_name=folder)
-        if not file_hash:
-            self.cleanup(self.ec2_instance_id, path, volume_id)
-            self.logger.error("file_hash = {} ".format(file_hash), extra=self.extra)
-            raise Exception("file_hash = {}".format(file_hash))
-        # creating tar of layerfiles dir for ex: /mnt/tenant_id/scan_id/instance_id/snapshot_id/layerfiles
-        if not self.create_tar_file(file_path=os.path.join(os.path.dirname(os.path.join(mounted_path, folder)), tar_file_name), source_dir=os.path.join(mounted_path, folder)):
-            self.cleanup(self.ec2_instance_id, path, volume_id)
-            self.logger.error("Tar file {} creation with path {} failed !".format(tar_file_name, os.path.join(os.path.dirname(os.path.join(mounted_path, folder)), tar_file_name)), extra=self.extra)
-            raise Exception("Tar file {} creation with path {} failed !".format(tar_file_name, os.path.join(os.path.dirname(os.path.join(mounted_path, folder)), tar_file_name)))
-        checksum, checksum_location = self.create_checksum_and_location(file_hash, mounted_path)
-        if not checksum or not checksum_location:
-            self.cleanup(self.ec2_instance_id, path, volume_id)
-            self.logger.error("Checksum and Checksum location creation failed", extra=self.extra)
-            raise Exception("Checksum and Checksum location creation failed")
-        if not self.create_manifest(path=os.path.join(mounted_path, tosend), layer_hash=checksum):
-            self.cleanup(self.ec2_instance_id, path, volume_id)
-            self.logger.error("Unable To Create Manifest in path {} ".format(os.path.join(mounted_path, tosend)), extra=self.extra)
-            raise Exception("Unable To Create Manifest in path {} ".format(os.path.join(mounted_path, tosend)))
-        tar_file_location = os.path.join(mounted_path, tar_file_name)
-        if not self.move_tar_into_checksum_location(tar_file_location, checksum_location):
-            self.cleanup(self.ec2_instance_id, path, volume_id)
-            self.logger.error("Tar file move from src {} to dest {} failed !".format(tar_file_location, checksum_location), extra=self.extra)
-            raise Exception("Tar file move from src {} to dest {} failed !".format(tar_file_location, checksum_location))
-        # creating tar of tosend dir for ex: /mnt/tenant_id/scan_id/instance_id/snapshot_id/tosend
-        if not self.create_tar_file(file_path=os.path.join(os.path.dirname(os.path.join(mounted_path, tosend)), tosend_tar_gz), source_dir=os.path.join(mounted_path, tosend)):
-            self.cleanup(self.ec2_instance_id, path, volume_id)
-            self.logger.error("Tar file {} creation with path {} failed !".format(tosend_tar_gz, os.path.join(os.path.dirname(os.path.join(mounted_path, tosend)), tosend_tar_gz)), extra=self.extra)
-            raise Exception("Tar file {} creation with path {} failed !".format(tosend_tar_gz, os.path.join(os.path.dirname(os.path.join(mounted_path, tosend)), tosend_tar_gz)))
-        # uploading tosend_tar_gz into s3
-        if not self.upload_to_s3(file_path=os.path.join(mounted_path, tosend_tar_gz), bucket_name=self.bucket_name, object_name=os.path.join('agentless-va', str(self.tenant_id), str(self.scan_id), str(instance_id), str(snapshot_id), tosend_tar_gz)):
-            self.cleanup(self.ec2_instance_id, path, volume_id)
-            self.logger.error("Upload To S3 Failed", extra=self.extra)
-            raise Exception("Upload To S3 Failed")
-        # Unmount Volume
-        if not self.unmount_volume():
-            self.utility.release_device_mount(device=self.device_m, logger=self.logger, extra=self.extra)
-            self.detach_volume(instance_id=self.ec2_instance_id, volume_id=volume_id)
-            self.utility.release_device(device=self.device, logger=self.logger, extra=self.extra)
-            self.delete_volume(volume_id=volume_id)
-            self.cleanup_directories(path)
-            self.logger.error("Volume Unmount Failed", extra=self.extra)
+    def resume_volume(self, job):
+        """
+        Volume left by an interrupted run of job, reused when it still exists and is either available or
+        attached to this instance under a device slot that can be taken over. Run before any new device
+        slot is allocated, sets job.volume_id and job.device when the volume is attached already
+        :param job: ScanJob
+        :return: str or None
+        """
+        entry = self.journal.lookup(job)
+        if entry is None or entry['stage'] not in VOLUME_STAGES or not entry['volume_id']:
+            return None
+        volume_id = entry['volume_id']
+        if volume_id in self.utility.teardown_volume_ids(logger=self.logger, extra=job.extra):
+            return None
+        client = self.get_ec2_client()
+        try:
+            volume = client.describe_volumes(VolumeIds=[volume_id])['Volumes'][0]
+        except (ClientError, IndexError) as e:
+            self.logger.info("Volume {} of previous run is gone {}".format(volume_id, e), extra=job.extra)
+            return None
+        attachment = next((attachment for attachment in volume.get('Attachments', []) if attachment['InstanceId'] == self.ec2_instance_id), None)
+        lease = volume['State'] == 'in-use' and attachment and self.utility.adopt_device(attachment['Device'], logger=self.logger, extra=job.extra)
+        if lease:
+            job.device, job.device_lease = attachment['Device'], lease
+        elif volume['State'] != 'available':
+            self.logger.warning("Volume {} of previous run is {}, not resumed".format(volume_id, volume['State']), extra=job.extra)
+            return None
+        try:
+            # the reaper of a later run must not take the volume for an orphan of the exited process
+            client.create_tags(Resources=[volume_id], Tags=[{'Key': TAG_OWNER_PID, 'Value': str(os.getpid())}])
+        except ClientError as e:
+            self.logger.warning("Volume {} owner tag update failed {}".format(volume_id, e), extra=job.extra)
+        self.logger.info("Resuming with volume {} of previous run, stage {}".format(volume_id, entry['stage']), extra=job.extra)
+        job.volume_id = volume_id
+        return volume_id
+
+    def process(self, job):
+        """
+        Capture the files of the mounted snapshot and release its volume, then upload. In file mode the
+        archive goes to the durable upload spool and is uploaded in the background. A job resumed by a
+        later run starts over from here at most, the layer spool does not survive the process
+        :param job: ScanJob
+        :return:
+        """
+        mounted_path, scratch_path, object_name = job.mounted_path, job.scratch_path, job.object_name
+        tosend_tar_gz = os.path.basename(object_name)
+        self.enter_stage(job, "capture")
+        if not self.create_path_with_parent_directory_if_not_exists(job, path=scratch_path):
+            self.cleanup(job)
+            self.logger.error("scratch_path {} creation failed".format(scratch_path), extra=job.extra)
+            raise Exception("scratch_path {} creation failed".format(scratch_path))
+        members = self.collect_va_files(job, mounted_path=mounted_path)
+        if not members:
+            self.cleanup(job)
+            self.logger.error("No required files found in {}".format(mounted_path), extra=job.extra)
+            raise Exception("No required files found in {}".format(mounted_path))
+        if not self.scratch.grow(job, self.scratch.estimate(members), timeout=self.wait_timeout(job, SCRATCH_WAIT_TIMEOUT)):
+            self.check_deadline(job)
+            self.cleanup(job)
+            self.logger.error("Scratch space reservation failed", extra=job.extra)
+            raise Exception("Scratch space reservation failed")
+        builder = self.archive_builder(job)
+        with ExitStack() as stack:
+            try:
+                started = time.monotonic()
+                read = self.prefetcher.warm(members, job.extra, deadline=job.deadline)
+                if read:
+                    # the prefetch only reads the source files from the volume, the read throughput of the profile
+                    job.read_throughput = round(read / MB / max(time.monotonic() - started, 0.001), 1)
+                    self.logger.info("Volume profile {} read throughput {} MB/s".format(job.volume_profile, job.read_throughput), extra=job.extra)
+                    self.report.annotate(job, readMBps=job.read_throughput)
+                layer = stack.enter_context(builder.layer(members, job.extra, deadline=job.deadline))
+                # layer_key = agentless-va/tenant_id/layers/digest/tosend.tar.gz
+                layer_key = os.path.join('agentless-va', str(job.tenant_id), 'layers', layer.digest, tosend_tar_gz)
+                entry_id = None
+                if self.options["uploadMode"] != "stream":
+                    entry_id = self.spool_archive(job, builder, layer, layer_key)
+            except Exception as e:
+                self.logger.exception("Archive creation failed {}".format(e), extra=job.extra)
+                self.cleanup(job)
+                raise Exception("Archive creation failed") from e
+            finally:
+                # the files are not read again, their pages are left to the other jobs
+                self.prefetcher.drop(members, job.extra)
+            # every needed byte is in the open layer spool or in the upload spool, the volume is
+            # torn down in the background before uploading
+            self.cleanup(job)
+            self.enter_stage(job, "upload")
+            if entry_id is None:
+                self.deliver_layer(job, builder, layer, layer_key)
+        if entry_id is not None:
+            # the background upload reports the outcome
+            self.report.pause(job)
+            self.spool.submit(entry_id)
+
+    def cleanup(self, job):
+        """
+        Queue teardown of the volume and directories of job, it runs in the background so the job
+        returns without waiting for detach and delete. The teardown works on a copy without the
+        deadline, a cancelled job still releases everything, and the job no longer holds its volume
+        :param job: ScanJob
+        :return: str or None when the job holds nothing
+        """
+        if not (job.volume_id or job.device or job.mounted_path):
+            return None
+        leftover = copy.copy(job)
+        leftover.deadline = None
+        job.volume_id = job.device = job.device_lease = job.mounted_path = None
+        return self.teardowns.submit(leftover)
+
+    def enter_stage(self, job, stage):
+        """
+        Job starts stage, the stage budget starts and a job past its deadline is cancelled
+        :param job: ScanJob
+        :param stage: str
+        :return:
+        """
+        if job.deadline is not None:
+            job.deadline.enter(stage)
+        self.report.enter(job, stage)
+
+    @staticmethod
+    def wait_timeout(job, timeout):
+        """
+        Seconds a wait of job may take, what is left of its stage budget or timeout without a deadline
+        :param job: ScanJob
+        :param timeout: int
+        :return: float
+        """
+        return timeout if job.deadline is None else job.deadline.remaining()
+
+    @staticmethod
+    def check_deadline(job):
+        """
+        Raise DeadlineExceeded when a wait of job ended because its stage budget ran out
+        :param job: ScanJob
+        :return:
+        """
+        if job.deadline is not None:
+            job.deadline.check()
+
+    def teardown(self, job):
+        """
+        Unmount, detach, release the device slot, delete and remove the job directories. Every step
+        checks what is left to do, so a teardown interrupted by a failure or a crash can run again
+        :param job: ScanJob
+        :return:
+        """
+        if job.mounted_path and os.path.ismount(job.mounted_path) and not self.unmount_volume(job):
+            self.logger.error("Volume Unmount Failed", extra=job.extra)
             raise Exception("Volume Unmount Failed")
-        # updating unmount info in DB
-        if not self.utility.release_device_mount(device=self.device_m, logger=self.logger, extra=self.extra):
-            self.detach_volume(instance_id=self.ec2_instance_id, volume_id=volume_id)
-            self.utility.release_device(device=self.device, logger=self.logger, extra=self.extra)
-            self.delete_volume(volume_id=volume_id)
-            self.cleanup_directories(path)
-            self.logger.error("Release Device Mount Failed", extra=self.extra)
-            raise Exception("Release Device Mount Failed")
-        # volume detach
-        if not self.detach_volume(instance_id=self.ec2_instance_id, volume_id=volume_id):
-            self.utility.release_device(device=self.device, logger=self.logger, extra=self.extra)
-            self.delete_volume(volume_id=volume_id)
-            self.cleanup_directories(path)
-            self.logger.error("Detach Volume Failed", extra=self.extra)
+        if job.volume_id and not self.detach_volume(job, instance_id=self.ec2_instance_id, volume_id=job.volume_id):
+            # the device slot stays leased while the volume may still be attached under its name
+            self.logger.error("Detach Volume Failed", extra=job.extra)
             raise Exception("Detach Volume Failed")
-        # updating release device status in DB attached during volume attach
-        if not self.utility.release_device(device=self.device, logger=self.logger, extra=self.extra):
-            self.delete_volume(volume_id=volume_id)
-            self.cleanup_directories(path)
-            self.logger.error("Release Device Failed", extra=self.extra)
-            raise Exception("Release Device Failed")
-        # deleted volume
-        if not self.delete_volume(volume_id=volume_id):
-            self.cleanup_directories(path)
-            self.logger.error("Delete Volume Failed", extra=self.extra)
+        if job.device:
+            # False when the slot was already released by an earlier attempt
+            self.utility.release_device(device=job.device, owner=job.device_lease, logger=self.logger, extra=job.extra)
+            job.device = job.device_lease = None
+        if job.volume_id and not self.delete_volume(job, volume_id=job.volume_id):
+            self.logger.error("Delete Volume Failed", extra=job.extra)
             raise Exception("Delete Volume Failed")
-        # remove mounted path directory
-        if not self.cleanup_directories(path):
-            self.logger.error("Directory cleanup Failed", extra=self.extra)
-            raise Exception("Directory cleanup Failed")
+        # only the job's own mounted and scratch paths are removed as other snapshots of the same
+        # tenant may still be mounted under /mnt/tenant_id
+        for path in (job.mounted_path, job.scratch_path):
+            if path and not os.path.ismount(path):
+                shutil.rmtree(path, ignore_errors=True)
 
-    def cleanup(self, instance_id, path, volume_id):
+    def resumed_job(self, entry):
         """
-        Cleanup
-        :param instance_id: str
-        :param path: str
-        :param volume_id: atr
-        :return:
+        ScanJob of a teardown left by a previous run
+        :param entry: dict, teardown columns
+        :return: ScanJob
         """
-        self.unmount_volume()
-        self.detach_volume(instance_id=instance_id, volume_id=volume_id)
-        self.utility.release_device_mount(device=self.device_m, logger=self.logger, extra=self.extra)
-        self.detach_volume(instance_id=instance_id, volume_id=volume_id)
-        self.utility.release_device(device=self.device, logger=self.logger, extra=self.extra)
-        self.delete_volume(volume_id=volume_id)
-        self.cleanup_directories(path=path)
+        job = ScanJob(tenant_id=entry['tenant_id'], scan_id=entry['scan_id'], instance_id=entry['instance_id'], snapshot_id=entry['snapshot_id'],
+                      extra={'scanId': entry['scan_id'], 'tenantId': entry['tenant_id']})
+        job.volume_id, job.device, job.mounted_path, job.scratch_path = entry['volume_id'], entry['device'], entry['mounted_path'], entry['scratch_path']
+        return job
 
-    def create_checksum_and_location(self, file_hash, mounted_path):
+    def reaped_job(self, entry):
         """
-        Create Checksum And Respective Directories
-        :param file_hash:
-        :param mounted_path:
-        :return:
+        ScanJob of a volume or mount left by an exited process, its scratch path is removed too
+        :param entry: dict, teardown columns
+        :return: ScanJob
+        """
+        job = self.resumed_job(entry)
+        if entry['snapshot_id']:
+            job.scratch_path = self.scratch.job_path(job)
+        return job
+
+    def attach_slot_names(self):
+        """
+        Device names of the slot pool sized from the attachment limit of this instance type minus the
+        volumes and network interfaces already attached, the former 11 names if it cannot be described
+        :return: list
+        """
+        try:
+            client = self.get_ec2_client()
+            instance_type = client.describe_instance_types(InstanceTypes=[ec2_metadata.instance_type])['InstanceTypes'][0]
+            instance = client.describe_instances(InstanceIds=[self.ec2_instance_id])['Reservations'][0]['Instances'][0]
+        except (ClientError, IndexError, KeyError) as e:
+            self.logger.warning("Instance type attachment limit unknown, using {} devices {}".format(len(LEGACY_DEVICE_NAMES), e), extra=self.extra)
+            return list(LEGACY_DEVICE_NAMES)
+        names = slot_device_names(instance_type, instance, pool=self.utility.pool_devices(logger=self.logger, extra=self.extra))
+        self.logger.info("Instance type {} attachment limit {} device slots {}".format(ec2_metadata.instance_type, attachment_limit(instance_type), len(names)), extra=self.extra)
+        return names
+
+    def get_concurrency(self, job_count):
+        """
+        Number of snapshots processed in parallel and provisioned ahead of them, together bounded by
+        free attach devices
+        :param job_count: int
+        :return: tuple of int
+        """
+        free_devices = self.utility.free_device_count(logger=self.logger, extra=self.extra)
+        concurrency = max(1, min(int(self.options["concurrency"]), free_devices, job_count))
+        lookahead = max(0, min(int(self.options["lookahead"]), free_devices - concurrency, job_count - concurrency))
+        self.logger.info("Running {} snapshots with concurrency {} lookahead {} free devices {}".format(job_count, concurrency, lookahead, free_devices), extra=self.extra)
+        return concurrency, lookahead
+
+    def provision_job(self, job):
+        """
+        First pipeline stage of a snapshot scan
+        :param job: ScanJob
+        :return: bool
         """
+        self.logger.info("*" * 100, extra=job.extra)
+        self.logger.info("Start Running Ec2 InstanceID: {} Tenant ID: {} ScanId: {} BucketName: {} snapshotID: {} instanceID: {}".format(self.ec2_instance_id, job.tenant_id, job.scan_id, self.bucket_name, job.snapshot_id, job.instance_id), extra=job.extra)
+        # the deadline starts when the pipeline takes the job up, not while it waits for its turn
+        job.deadline = Deadline(float(self.options["jobTimeoutSeconds"]))
+        self.enter_stage(job, "reserve")
+        # backpressure, a job does not create its volume until scratch space is available
         try:
-            checksum = self.create_checksum(file_hash)
-            checksum_location = os.path.join(mounted_path, 'tosend', checksum)
-            os.makedirs(checksum_location)
-            return checksum, checksum_location
+            if not self.scratch.reserve(job, int(self.options["scratchReserveMb"]) * MB, timeout=self.wait_timeout(job, SCRATCH_WAIT_TIMEOUT)):
+                self.check_deadline(job)
+                raise Exception("Scratch space reservation failed")
         except Exception as e:
-            self.logger.exception(str(e.args[0]) + "creating checksum and directory Failed", extra=self.extra)
-            return False, False
+            self.report.fail(job, e)
+            # a volume resumed from a previous run holds a device slot
+            self.cleanup(job)
+            raise
+        try:
+            provisioned = self.provision(job)
+        except Exception as e:
+            self.report.fail(job, e)
+            # a job cancelled or failed midway hands what it still holds to teardown
+            self.cleanup(job)
+            self.scratch.release(job)
+            raise
+        if not provisioned:
+            self.scratch.release(job)
+            self.log_job_end(job)
+        return provisioned
 
-    def cleanup_directories(self, path):
+    def process_job(self, job):
         """
-        Cleanup All Directories recursively
-        :param path: str
+        Second pipeline stage of a snapshot scan
+        :param job: ScanJob
         :return:
         """
         try:
-            command = "rm -rf {}".format(os.path.join(path, str(self.tenant_id)))
-            return_code = subprocess.call([command], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            return not bool(return_code)
+            self.process(job)
         except Exception as e:
-            self.logger.exception(str(e.args[0]) + "Directory Cleanup failed", extra=self.extra)
-            return False
+            self.report.fail(job, e)
+            self.cleanup(job)
+            raise
+        finally:
+            self.scratch.release(job)
+        self.log_job_end(job)
+
+    def log_job_end(self, job):
+        self.logger.info("End Ec2 InstanceID: {} Tenant ID: {} ScanId: {} BucketName: {} snapshotID: {} instanceID: {}".format(self.ec2_instance_id, job.tenant_id, job.scan_id, self.bucket_name, job.snapshot_id, job.instance_id), extra=job.extra)
 
     @method_start_end
     def start(self):
-        device_population_response = self.utility.all_devices(logger=self.logger, extra=self.extra)['device']
-        if len(device_population_response) == 0:
-            self.logger.error("Device Population was failed", extra=self.extra)
-            raise Exception("Device Population was failed")
         if len(self.parse_args(sys.argv[1])) != 5:
             self.logger.error("script is executed with less parameters {}".format(str(sys.argv[1:])), extra=self.extra)
             raise Exception("script is executed with less parameters {}".format(str(sys.argv[1:])))
         self.tenant_id, self.scan_id, self.snapshot_data, self.bucket_name, self.instance_role = self.parse_args(sys.argv[1])
         self.extra.update({'scanId': str(self.scan_id), 'tenantId': str(self.tenant_id)})
+        # before the first client is created, EC2 calls of all jobs and processes on the host share one rate
+        rate_limiter = ApiRateLimiter(self.utility, logger=self.logger, extra=self.extra)
+        registry.use_rate_limiter(rate_limiter)
+        # pools sized for the most jobs in flight, the concurrency is only lowered once devices are counted
+        registry.configure(int(self.options["concurrency"]) + int(self.options["lookahead"]))
+        self.volume_profiles = VolumeProfiles(self.options["volumeProfile"], self.options["volumeProfiles"], logger=self.logger, extra=self.extra)
+        self.prefetcher = Prefetcher(int(self.options["prefetchThreads"]), int(self.options["prefetchChunkKb"]) * 1024, logger=self.logger)
+        device_population_response = self.utility.all_devices(self.attach_slot_names(), logger=self.logger, extra=self.extra)['device']
+        if len(device_population_response) == 0:
+            self.logger.error("Device Population was failed", extra=self.extra)
+            raise Exception("Device Population was failed")
         self.logger.debug("{}".format(device_population_response), extra=self.extra)
+        jobs = []
         for snapshot_id, instance_id in self.snapshot_data.items():
-            self.logger.info("*" * 100, extra=self.extra)
             if not self.tenant_id or not self.scan_id or not snapshot_id or not instance_id or not self.bucket_name:
                 self.logger.error("tenant_id: {}, scan_id: {}, snapshot_data: {} bucket_name: {} exiting!".format(self.tenant_id, self.scan_id, self.snapshot_data, self.bucket_name), extra=self.extra)
                 raise Exception("tenant_id: {}, scan_id: {}, snapshot_data: {} bucket_name: {} exiting!".format(self.tenant_id, self.scan_id, self.snapshot_data, self.bucket_name))
-            self.logger.info("Start Running Ec2 InstanceID: {} Tenant ID: {} ScanId: {} BucketName: {} snapshotID: {} instanceID: {}".format(self.ec2_instance_id, self.tenant_id, self.scan_id, self.bucket_name, snapshot_id, instance_id), extra=self.extra)
-            self.main(instance_id=instance_id, snapshot_id=snapshot_id)
-            self.logger.info("End Ec2 InstanceID: {} Tenant ID: {} ScanId: {} BucketName: {} snapshotID: {} instanceID: {}".format(self.ec2_instance_id, self.tenant_id, self.scan_id, self.bucket_name, snapshot_id, instance_id), extra=self.extra)
+            jobs.append(ScanJob(tenant_id=self.tenant_id, scan_id=self.scan_id, instance_id=instance_id, snapshot_id=snapshot_id, extra=self.extra))
+        self.report = ScanReport(self.tenant_id, self.scan_id, self.snapshot_data)
+        self.volume_profiles.load(self.get_ec2_client(), list(self.snapshot_data), ec2_metadata.availability_zone)
+        self.scratch = ScratchManager(self.options["scratchPath"], self.options["scratchBudgetMb"], logger=self.logger, extra=self.extra)
+        spool_path = self.options["uploadSpoolPath"] or os.path.join(shnbin_common.get_app_data_path(), SPOOL_FOLDER)
+        self.spool = UploadSpool(spool_path, self.options["uploadSpoolMb"], deliver=self.deliver_spooled, utility=self.utility, workers=int(self.options["concurrency"]), logger=self.logger, extra=self.extra)
+        self.spool.resume(self.bucket_name)
+        self.teardowns = TeardownQueue(self.teardown, utility=self.utility, workers=int(self.options["concurrency"]), logger=self.logger, extra=self.extra)
+        self.teardowns.resume(self.resumed_job)
+        self.journal.prune(extra=self.extra)
+        # volumes of interrupted jobs take back their device slots before the reaper and new jobs run
+        resumed = set(volume_id for volume_id in map(self.resume_volume, jobs) if volume_id)
+        # leftovers of exited processes hold device slots, they are torn down before new jobs run. Failed
+        # teardowns stay recorded for the next run and do not fail this scan
+        reaper = OrphanReaper(self.get_ec2_client, utility=self.utility, teardowns=self.teardowns, job_factory=self.reaped_job, mount_root=MOUNT_ROOT, logger=self.logger, extra=self.extra)
+        reaper.reap(self.ec2_instance_id, keep=resumed)
+        concurrency, lookahead = self.get_concurrency(len(jobs))
+        registry.configure(concurrency + lookahead)
+        pipeline = Pipeline(provision=self.provision_job, process=self.process_job, concurrency=concurrency, lookahead=lookahead, logger=self.logger, extra=self.extra)
+        # failures are logged and reported per snapshot below
+        pipeline.run(jobs)
+        self.spool.drain()
+        # failed teardowns stay recorded and are resumed by the next run, the snapshots were captured
+        self.teardowns.drain()
+        self.logger.info("Volume waiter issued {} DescribeVolumes calls".format(self.volume_waiter.describe_calls), extra=self.extra)
+        self.logger.info("AWS clients {}".format(registry.stats()), extra=self.extra)
+        self.logger.info("EC2 rate limiter {}".format(rate_limiter.stats()), extra=self.extra)
+        self.logger.info("Retries per error class {}".format(retry_policy.stats()), extra=self.extra)
+        report = self.report.write(os.path.join(shnbin_common.get_app_data_path(), REPORT_FOLDER))
+        self.logger.info("Scan finished, {} snapshots succeeded {} failed".format(report['succeeded'], report['failed']), extra=self.extra)
+        # machine readable outcome of every snapshot for the orchestrator, only failed snapshots need a new
+        # scan. It is the only output on stdout, logs go to stderr and the log file and SQL is not echoed
+        print(json.dumps(report))
+        if report['failed']:
+            raise Exception("{} of {} snapshots failed".format(report['failed'], len(report['snapshots'])))
 
 
 if __name__ == '__main__':
@@ -749,4 +1176,3 @@ if __name__ == '__main__':
         utl = Utility()
         agentless = AgentLess(logger=log, utility=utl)
         agentless.start()
-
@@ -1,6 +1,6 @@
 import os
 
-from sqlalchemy import Column, String, BOOLEAN
+from sqlalchemy import Column, String, BOOLEAN, Float, Integer, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import sqlalchemy as sa
@@ -8,9 +8,36 @@ import shnbin_common
 
 CURRENT_DIRECTORY_PATH = os.path.dirname(__file__)
 SQLALCHEMY_DATABASE_URI = "sqlite:////{}".format(os.path.join(shnbin_common.get_app_data_path(), 'devices.db'))
-engine = sa.create_engine(SQLALCHEMY_DATABASE_URI, echo=True)
+# Seconds a connection waits on the database lock held by another process
+BUSY_TIMEOUT = 30
+engine = sa.create_engine(SQLALCHEMY_DATABASE_URI, echo=False, connect_args={'timeout': BUSY_TIMEOUT})
+# Device slot allocation, every transaction takes the write lock up front with BEGIN IMMEDIATE so
+# that allocations of concurrent processes on the host are serialized by SQLite itself
+lease_engine = sa.create_engine(SQLALCHEMY_DATABASE_URI, echo=False, connect_args={'timeout': BUSY_TIMEOUT})
 Base = declarative_base()
 
+
+@event.listens_for(engine, "connect")
+@event.listens_for(lease_engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL lets readers run while a lease transaction holds the write lock
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout={}".format(BUSY_TIMEOUT * 1000))
+    cursor.close()
+
+
+@event.listens_for(lease_engine, "connect")
+def disable_pysqlite_begin(dbapi_connection, connection_record):
+    # pysqlite would otherwise emit its own deferred BEGIN
+    dbapi_connection.isolation_level = None
+
+
+@event.listens_for(lease_engine, "begin")
+def begin_immediate(connection):
+    connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
 Session = sessionmaker(bind=engine)
 Session.configure(bind=engine)
 session = Session()
@@ -20,6 +47,10 @@ class Device(Base):
     __tablename__ = "device"
     value = Column(String(100), primary_key=True, nullable=False, unique=True)
     status = Column(BOOLEAN, nullable=False, unique=False)
+    # lease of the process holding the slot, reclaimed once expired or the process is gone
+    owner = Column(String(100), nullable=True)
+    owner_pid = Column(Integer, nullable=True)
+    lease_expires = Column(Float, nullable=True)
 
     def __init__(self, value=None, status=None):
         self.value = value
@@ -29,17 +60,154 @@ class Device(Base):
         return f"{self.__class__.__name__}(value = {self.value})(status = {self.status})"
 
 
-class DeviceMount(Base):
-    __tablename__ = "deviceMount"
-    value = Column(String(100), primary_key=True, nullable=False, unique=True)
-    status = Column(BOOLEAN, nullable=False, unique=False)
+class LayerDigest(Base):
+    """
+    Layers known to be stored in S3 under their content address
+    """
+    __tablename__ = "layerDigest"
+    key = Column(String(500), primary_key=True, nullable=False)
+    bucket = Column(String(100), primary_key=True, nullable=False)
+    digest = Column(String(64), nullable=False)
+    created = Column(Float, nullable=False)
 
-    def __init__(self, value=None, status=None):
-        self.value = value
-        self.status = status
+    def __init__(self, key=None, bucket=None, digest=None, created=None):
+        self.key = key
+        self.bucket = bucket
+        self.digest = digest
+        self.created = created
 
     def __repr__(self):
-        return f"{self.__class__.__name__}(value = {self.value})(status = {self.status})"
+        return f"{self.__class__.__name__}(key = {self.key})(bucket = {self.bucket})"
+
+
+class SnapshotResult(Base):
+    """
+    Scan result of an immutable snapshot, reused when the snapshot is requested again
+    """
+    __tablename__ = "snapshotResult"
+    snapshot_id = Column(String(100), primary_key=True, nullable=False)
+    tenant_id = Column(String(100), primary_key=True, nullable=False)
+    bucket = Column(String(100), primary_key=True, nullable=False)
+    key = Column(String(500), nullable=False)
+    created = Column(Float, nullable=False)
+
+    def __init__(self, snapshot_id=None, tenant_id=None, bucket=None, key=None, created=None):
+        self.snapshot_id = snapshot_id
+        self.tenant_id = tenant_id
+        self.bucket = bucket
+        self.key = key
+        self.created = created
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(snapshot_id = {self.snapshot_id})(key = {self.key})"
+
+
+class JobStage(Base):
+    """
+    Last completed stage of a snapshot scan job and the artifacts it produced, a retried or restarted
+    job resumes after it
+    """
+    __tablename__ = "jobStage"
+    tenant_id = Column(String(100), primary_key=True, nullable=False)
+    scan_id = Column(String(100), primary_key=True, nullable=False)
+    instance_id = Column(String(100), primary_key=True, nullable=False)
+    snapshot_id = Column(String(100), primary_key=True, nullable=False)
+    stage = Column(String(20), nullable=False)
+    volume_id = Column(String(100), nullable=True)
+    device = Column(String(100), nullable=True)
+    mounted_path = Column(String(500), nullable=True)
+    spool_id = Column(String(32), nullable=True)
+    digest = Column(String(64), nullable=True)
+    layer_key = Column(String(500), nullable=True)
+    object_name = Column(String(500), nullable=True)
+    updated = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(snapshot_id = {self.snapshot_id})(stage = {self.stage})"
+
+
+class UploadSpool(Base):
+    """
+    Archive written to the local upload spool and not yet delivered to S3
+    """
+    __tablename__ = "uploadSpool"
+    id = Column(String(32), primary_key=True, nullable=False)
+    path = Column(String(500), nullable=False)
+    bucket = Column(String(100), nullable=False)
+    object_name = Column(String(500), nullable=False)
+    layer_key = Column(String(500), nullable=False)
+    digest = Column(String(64), nullable=False)
+    tenant_id = Column(String(100), nullable=False)
+    scan_id = Column(String(100), nullable=False)
+    instance_id = Column(String(100), nullable=False)
+    snapshot_id = Column(String(100), nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    created = Column(Float, nullable=False)
+    # process uploading the archive, cleared when it fails or exits
+    owner_pid = Column(Integer, nullable=True)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(id = {self.id})(object_name = {self.object_name})"
+
+
+class Teardown(Base):
+    """
+    Volume and directories of a scan job waiting to be torn down
+    """
+    __tablename__ = "teardown"
+    id = Column(String(32), primary_key=True, nullable=False)
+    volume_id = Column(String(100), nullable=True)
+    device = Column(String(100), nullable=True)
+    mounted_path = Column(String(500), nullable=True)
+    scratch_path = Column(String(500), nullable=True)
+    tenant_id = Column(String(100), nullable=False)
+    scan_id = Column(String(100), nullable=False)
+    instance_id = Column(String(100), nullable=False)
+    snapshot_id = Column(String(100), nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    created = Column(Float, nullable=False)
+    # process running the teardown, cleared when it fails or exits
+    owner_pid = Column(Integer, nullable=True)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(id = {self.id})(volume_id = {self.volume_id})"
+
+
+class ApiBucket(Base):
+    """
+    Token bucket of an AWS API action shared by all scanner processes on the host, rate is adjusted
+    by AIMD on throttling
+    """
+    __tablename__ = "apiBucket"
+    action = Column(String(100), primary_key=True, nullable=False)
+    tokens = Column(Float, nullable=False)
+    # tokens per second
+    rate = Column(Float, nullable=False)
+    capacity = Column(Float, nullable=False)
+    updated = Column(Float, nullable=False)
+    last_decrease = Column(Float, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(action = {self.action})(rate = {self.rate})"
+
+
+LEASE_COLUMNS = (("owner", "VARCHAR(100)"), ("owner_pid", "INTEGER"), ("lease_expires", "FLOAT"))
+
+
+def migrate_lease_columns():
+    """
+    Add lease columns to a device table created before leases existed, slots held by such an old run
+    get an expired lease so that they are reclaimed
+    :return:
+    """
+    with lease_engine.begin() as connection:
+        columns = [row[1] for row in connection.exec_driver_sql('PRAGMA table_info("device")')]
+        missing = [(name, type_) for name, type_ in LEASE_COLUMNS if name not in columns]
+        for name, type_ in missing:
+            connection.exec_driver_sql('ALTER TABLE "device" ADD COLUMN {} {}'.format(name, type_))
+        if missing:
+            connection.exec_driver_sql('UPDATE "device" SET lease_expires = 0 WHERE status = 0')
 
 
 Base.metadata.create_all(engine)
+migrate_lease_columns()
@@ -0,0 +1,97 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Pipeline:
+    """
+    Two stage scheduler for scan jobs. Provisioning (volume create, attach and mount) runs ahead of
+    processing (archive, upload and teardown), so while `concurrency` jobs are processed up to
+    `lookahead` further jobs already have their volume attached and start the moment a worker frees up.
+
+    Jobs holding a volume are bounded by concurrency + lookahead, provisioning also waits for free
+    device slots. Jobs are processed in the order their provisioning completes, a failed job does not
+    stop the others
+    """
+
+    def __init__(self, provision, process, concurrency, lookahead, logger, extra):
+        """
+        :param provision: callable(job) returning False when the job needs no processing
+        :param process: callable(job)
+        :param concurrency: int
+        :param lookahead: int
+        :param logger: obj
+        :param extra: dict
+        """
+        self.provision = provision
+        self.process = process
+        self.concurrency = concurrency
+        self.lookahead = lookahead
+        self.logger = logger
+        self.extra = extra
+        self.ready = queue.Queue()
+        self.holding = threading.BoundedSemaphore(concurrency + lookahead)
+        self.lock = threading.Lock()
+        self.failures = []
+        # seconds workers waited for a provisioned job and provisioned volumes waited for a worker
+        self.worker_idle = 0.0
+        self.volume_idle = 0.0
+
+    def fail(self, job, error):
+        self.logger.exception("Scan failed for {} {}".format(job, error), extra=job.extra)
+        with self.lock:
+            self.failures.append(error)
+
+    def provision_stage(self, job):
+        self.holding.acquire()
+        try:
+            provisioned = self.provision(job)
+        except Exception as e:
+            self.ready.put((job, False, None, e))
+            return
+        self.ready.put((job, provisioned, time.monotonic(), None))
+
+    def process_stage(self):
+        while True:
+            waiting = time.monotonic()
+            item = self.ready.get()
+            if item is None:
+                return
+            with self.lock:
+                self.worker_idle += time.monotonic() - waiting
+            job, provisioned, ready_at, error = item
+            try:
+                if error is not None:
+                    self.fail(job, error)
+                elif not provisioned:
+                    continue
+                else:
+                    with self.lock:
+                        self.volume_idle += time.monotonic() - ready_at
+                    self.process(job)
+            except Exception as e:
+                self.fail(job, e)
+            finally:
+                self.holding.release()
+
+    def run(self, jobs):
+        """
+        Run all jobs
+        :param jobs: list of ScanJob
+        :return: list of exceptions of failed jobs
+        """
+        started = time.monotonic()
+        workers = [threading.Thread(target=self.process_stage, name="scan-{}".format(index)) for index in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        with ThreadPoolExecutor(max_workers=self.concurrency + self.lookahead, thread_name_prefix="provision") as executor:
+            for job in jobs:
+                executor.submit(self.provision_stage, job)
+        for _ in workers:
+            self.ready.put(None)
+        for worker in workers:
+            worker.join()
+        self.logger.info("Pipeline concurrency {} lookahead {} took {:.1f}s, workers idle {:.1f}s, provisioned volumes idle {:.1f}s".format(
+            self.concurrency, self.lookahead, time.monotonic() - started, self.worker_idle, self.volume_idle), extra=self.extra)
+        return self.failures
@@ -0,0 +1,106 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class Prefetcher:
+    """
+    Read ahead of the files to archive on a volume restored from a snapshot. Such a volume fetches
+    every block from S3 on first read, read one after another the files see that latency for every
+    block. The files are cut into chunks which a shared pool of threads reads with pread, so many
+    block fetches are outstanding at once, after posix_fadvise(WILLNEED) has asked the kernel to
+    start its own read ahead of the whole file.
+
+    Once the archive is built the pages of the files are dropped with posix_fadvise(DONTNEED), the
+    page cache is not filled with files of every snapshot scanned in parallel
+    """
+
+    def __init__(self, threads, chunk_size, logger):
+        """
+        :param threads: int, reads in flight across all jobs, 0 disables the read ahead
+        :param chunk_size: int, bytes per read
+        :param logger: obj
+        """
+        self.chunk_size = max(chunk_size, 4096)
+        self.logger = logger
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="prefetch") if threads > 0 else None
+
+    def advise(self, fd, advice, source_path, extra):
+        """
+        posix_fadvise over the whole file, missing on some platforms where the threaded reads still work
+        :param fd: int
+        :param advice: str, name of the os.POSIX_FADV_* constant
+        :param source_path: str
+        :param extra: dict
+        :return:
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError as e:
+            self.logger.debug("{} failed for {} {}".format(advice, source_path, e), extra=extra)
+
+    @staticmethod
+    def read_chunk(fd, offset, length):
+        # pread releases the GIL and does not move a shared file offset
+        return len(os.pread(fd, length, offset))
+
+    def warm(self, members, extra, deadline=None):
+        """
+        Read the files of members into the page cache, files which cannot be read are left to the
+        archive which reports the error
+        :param members: list of (source_path, arcname)
+        :param extra: dict
+        :param deadline: Deadline
+        :return: int, bytes read
+        """
+        if self.executor is None:
+            return 0
+        started = time.monotonic()
+        descriptors = []
+        futures = []
+        try:
+            for source_path, _ in members:
+                try:
+                    fd = os.open(source_path, os.O_RDONLY)
+                except OSError as e:
+                    self.logger.warning("Prefetch skipped {} {}".format(source_path, e), extra=extra)
+                    continue
+                descriptors.append(fd)
+                self.advise(fd, "POSIX_FADV_WILLNEED", source_path, extra)
+                size = os.fstat(fd).st_size
+                futures.extend(self.executor.submit(self.read_chunk, fd, offset, min(self.chunk_size, size - offset))
+                               for offset in range(0, size, self.chunk_size))
+            done, _ = wait(futures, timeout=None if deadline is None else deadline.remaining())
+            if deadline is not None:
+                deadline.check()
+            read = sum(future.result() for future in done if not future.exception())
+            failed = sum(1 for future in done if future.exception())
+        finally:
+            # descriptors are closed only once no read of them is pending
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            for fd in descriptors:
+                os.close(fd)
+        seconds = time.monotonic() - started
+        self.logger.info("Prefetched {} files {} bytes in {:.2f}s {} chunks failed".format(len(descriptors), read, seconds, failed), extra=extra)
+        return read
+
+    def drop(self, members, extra):
+        """
+        Drop the cached pages of the files of members
+        :param members: list of (source_path, arcname)
+        :param extra: dict
+        :return:
+        """
+        for source_path, _ in members:
+            try:
+                fd = os.open(source_path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                self.advise(fd, "POSIX_FADV_DONTNEED", source_path, extra)
+            finally:
+                os.close(fd)
@@ -0,0 +1,128 @@
+from botocore.exceptions import ClientError
+
+# CreateVolume arguments of every provisioning profile. A volume restored from a snapshot without Fast
+# Snapshot Restore loads each block from S3 on first read, more IOPS and throughput let more of these
+# reads run at once. gp3 includes 3000 IOPS and 125 MiB/s at no extra cost
+VOLUME_PROFILES = {
+    "gp3": {"VolumeType": "gp3", "Iops": 3000, "Throughput": 125},
+    "gp3-restore": {"VolumeType": "gp3", "Iops": 6000, "Throughput": 500},
+    "io2": {"VolumeType": "io2", "Iops": 3000},
+    # volume of the former releases
+    "io1": {"VolumeType": "io1", "Iops": 100, "MultiAttachEnabled": True},
+}
+# Profile chosen per snapshot, fully initialized when Fast Snapshot Restore is enabled in the zone
+AUTO = "auto"
+FAST_RESTORE_PROFILE = "gp3"
+LAZY_RESTORE_PROFILE = "gp3-restore"
+# Only Provisioned IOPS volumes can be attached to several instances
+MULTI_ATTACH_TYPES = ("io1", "io2")
+# DescribeFastSnapshotRestores accepts at most 200 values per filter
+MAX_BATCH_SIZE = 200
+# Highest provisioned IOPS per GiB of volume size, and the IOPS every volume of the type supports
+IOPS_PER_GIB = {"gp3": 500, "io1": 50, "io2": 500}
+MIN_IOPS = {"gp3": 3000, "io1": 100, "io2": 100}
+# gp3 throughput in MiB/s, at most 0.25 MiB/s per provisioned IOPS
+MIN_THROUGHPUT = 125
+THROUGHPUT_PER_IOPS = 0.25
+
+
+def volume_arguments(profile, size=None):
+    """
+    CreateVolume arguments of profile for a volume of size GiB, MultiAttachEnabled is dropped for types
+    not supporting it. IOPS and throughput are capped to what the size allows, a volume of unknown size
+    gets the IOPS every volume of its type supports
+    :param profile: dict
+    :param size: int or None
+    :return: dict
+    """
+    arguments = dict(profile)
+    volume_type = arguments.get("VolumeType")
+    if volume_type not in MULTI_ATTACH_TYPES:
+        arguments.pop("MultiAttachEnabled", None)
+    if "Iops" in arguments and volume_type in IOPS_PER_GIB:
+        limit = IOPS_PER_GIB[volume_type] * size if size else MIN_IOPS[volume_type]
+        arguments["Iops"] = max(MIN_IOPS[volume_type], min(arguments["Iops"], limit))
+    if "Throughput" in arguments:
+        limit = int(arguments.get("Iops", MIN_IOPS["gp3"]) * THROUGHPUT_PER_IOPS)
+        arguments["Throughput"] = max(MIN_THROUGHPUT, min(arguments["Throughput"], limit))
+    return arguments
+
+
+class VolumeProfiles:
+    """
+    Provisioning profile of the scan volume of every snapshot, either the configured one or chosen by
+    whether Fast Snapshot Restore is enabled for the snapshot in the availability zone of the scanner.
+    The snapshots of a scan are looked up in one batched DescribeFastSnapshotRestores call, their sizes
+    in one batched DescribeSnapshots call as IOPS and throughput are limited by the volume size
+    """
+
+    def __init__(self, profile, custom_profiles, logger, extra):
+        """
+        :param profile: str, profile name or auto
+        :param custom_profiles: dict of name to CreateVolume arguments, added to or replacing VOLUME_PROFILES
+        :param logger: obj
+        :param extra: dict
+        """
+        self.profiles = dict(VOLUME_PROFILES, **(custom_profiles or {}))
+        if profile != AUTO and profile not in self.profiles:
+            raise ValueError("Unknown volume profile {}, expected {} or one of {}".format(profile, AUTO, sorted(self.profiles)))
+        self.profile = profile
+        self.logger = logger
+        self.extra = extra
+        self.fast_restores = set()
+        # snapshot id to volume size in GiB
+        self.sizes = {}
+
+    def load(self, client, snapshot_ids, availability_zone):
+        """
+        Look up the sizes of the snapshots and with the auto profile the snapshots with Fast Snapshot
+        Restore enabled in availability_zone, without the permission every snapshot counts as lazily restored
+        :param client: ec2 client
+        :param snapshot_ids: list
+        :param availability_zone: str
+        :return: set
+        """
+        snapshot_ids = sorted(set(str(snapshot_id) for snapshot_id in snapshot_ids))
+        self.load_sizes(client, snapshot_ids)
+        if self.profile != AUTO:
+            return self.fast_restores
+        try:
+            for index in range(0, len(snapshot_ids), MAX_BATCH_SIZE):
+                paginator = client.get_paginator("describe_fast_snapshot_restores")
+                pages = paginator.paginate(Filters=[{"Name": "snapshot-id", "Values": snapshot_ids[index:index + MAX_BATCH_SIZE]},
+                                                    {"Name": "availability-zone", "Values": [availability_zone]},
+                                                    {"Name": "state", "Values": ["enabled"]}])
+                for page in pages:
+                    self.fast_restores.update(restore["SnapshotId"] for restore in page["FastSnapshotRestores"])
+        except ClientError as e:
+            self.logger.warning("Fast Snapshot Restore lookup failed, volumes use profile {} {}".format(LAZY_RESTORE_PROFILE, e), extra=self.extra)
+        self.logger.info("Fast Snapshot Restore enabled in {} for {} of {} snapshots".format(availability_zone, len(self.fast_restores), len(snapshot_ids)), extra=self.extra)
+        return self.fast_restores
+
+    def load_sizes(self, client, snapshot_ids):
+        """
+        Look up the volume size of the snapshots, without the permission volumes get the IOPS every
+        volume of their type supports
+        :param client: ec2 client
+        :param snapshot_ids: list
+        :return: dict
+        """
+        try:
+            for index in range(0, len(snapshot_ids), MAX_BATCH_SIZE):
+                paginator = client.get_paginator("describe_snapshots")
+                for page in paginator.paginate(SnapshotIds=snapshot_ids[index:index + MAX_BATCH_SIZE]):
+                    self.sizes.update((snapshot["SnapshotId"], snapshot["VolumeSize"]) for snapshot in page["Snapshots"])
+        except ClientError as e:
+            self.logger.warning("Snapshot size lookup failed, volumes use the IOPS of the smallest volume {}".format(e), extra=self.extra)
+        return self.sizes
+
+    def select(self, snapshot_id):
+        """
+        Profile of the volume of snapshot
+        :param snapshot_id: str
+        :return: tuple of (profile name, CreateVolume arguments)
+        """
+        name = self.profile
+        if name == AUTO:
+            name = FAST_RESTORE_PROFILE if str(snapshot_id) in self.fast_restores else LAZY_RESTORE_PROFILE
+        return name, volume_arguments(self.profiles[name], self.sizes.get(str(snapshot_id)))
@@ -0,0 +1,110 @@
+import threading
+import time
+
+# Error codes EC2 and other AWS services return when a request rate is exceeded
+THROTTLING_ERRORS = ("RequestLimitExceeded", "Throttling", "ThrottlingException", "TooManyRequestsException")
+# Tokens per second a bucket starts with and never exceeds. EC2 refills an account wide bucket of 20
+# tokens per second for non mutating and 5 per second for mutating actions, a host starts well below
+DEFAULT_RATES = {
+    "describe": (5.0, 20.0),
+    "mutate": (1.0, 5.0),
+}
+# Rate never goes below this, one call every 5 seconds
+MIN_RATE = 0.2
+# Burst is this many seconds of the current rate
+BURST_SECONDS = 2
+# Rate is halved on throttling and grows by ADDITIVE_STEP tokens per second with every accepted call
+DECREASE_FACTOR = 0.5
+ADDITIVE_STEP = 0.05
+# Throttles within this many seconds of a decrease are part of the same burst
+DECREASE_INTERVAL = 1.0
+
+
+class ApiRateLimiter:
+    """
+    Host wide token bucket per API action, shared by all threads and all scanner processes through
+    SQLite. Every HTTP attempt of a registered client, including botocore's own retries, waits for a
+    token of its action. The rate of an action is halved when AWS throttles it and raised a little
+    with every accepted call, so the aggregate rate of the host tracks what the account allows
+    """
+
+    def __init__(self, utility, logger, extra, services=("ec2",)):
+        """
+        :param utility: Utility
+        :param logger: obj
+        :param extra: dict
+        :param services: tuple, services whose clients are limited
+        """
+        self.utility = utility
+        self.logger = logger
+        self.extra = extra
+        self.services = services
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    @staticmethod
+    def limits(action):
+        """
+        Initial and maximum rate of action
+        :param action: str, service.Operation
+        :return: tuple of float
+        """
+        operation = action.split(".")[-1]
+        return DEFAULT_RATES["describe" if operation.startswith(("Describe", "Get", "List")) else "mutate"]
+
+    def register(self, service, client):
+        """
+        Hook the limiter into the client's request events
+        :param service: str
+        :param client: obj
+        :return:
+        """
+        if service not in self.services:
+            return
+        client.meta.events.register("before-send.{}".format(client.meta.service_model.service_id.hyphenize()), self.before_send)
+        client.meta.events.register("needs-retry.{}".format(client.meta.service_model.service_id.hyphenize()), self.after_attempt)
+
+    @staticmethod
+    def action(event_name):
+        # before-send.ec2.CreateVolume
+        return ".".join(event_name.split(".")[1:])
+
+    def before_send(self, event_name, **kwargs):
+        action = self.action(event_name)
+        rate, max_rate = self.limits(action)
+        wait = self.utility.take_api_token(action, rate, burst_seconds=BURST_SECONDS, logger=self.logger, extra=self.extra)
+        with self.lock:
+            self.calls += 1
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+        # None lets botocore send the request
+        return None
+
+    def after_attempt(self, event_name, response=None, **kwargs):
+        if response is None:
+            return None
+        action = self.action(event_name)
+        _, max_rate = self.limits(action)
+        code = response[1].get("Error", {}).get("Code")
+        if code in THROTTLING_ERRORS:
+            with self.lock:
+                self.throttled += 1
+            if self.utility.decrease_api_rate(action, DECREASE_FACTOR, MIN_RATE, DECREASE_INTERVAL, logger=self.logger, extra=self.extra):
+                self.logger.warning("{} throttled, rate halved".format(action), extra=self.extra)
+        elif code is None:
+            self.utility.increase_api_rate(action, ADDITIVE_STEP, max_rate, logger=self.logger, extra=self.extra)
+        # None leaves the retry decision to botocore
+        return None
+
+    def stats(self):
+        """
+        Calls, throttled calls, seconds waited for tokens and current rates
+        :return: dict
+        """
+        with self.lock:
+            stats = {'calls': self.calls, 'throttled': self.throttled, 'waited': round(self.waited, 1)}
+        stats['rates'] = self.utility.api_rates(logger=self.logger, extra=self.extra)
+        return stats
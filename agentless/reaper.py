@@ -0,0 +1,167 @@
+import os
+
+from botocore.exceptions import ClientError
+
+PROC_MOUNTS = "/proc/mounts"
+# Tags set on every scan volume at creation, the owner tags identify the scanner process holding it
+TAG_OWNER_INSTANCE = "agentless:owner-instance"
+TAG_OWNER_PID = "agentless:owner-pid"
+TAG_TENANT_ID = "agentless:tenant-id"
+TAG_SCAN_ID = "agentless:scan-id"
+TAG_INSTANCE_ID = "agentless:instance-id"
+TAG_SNAPSHOT_ID = "agentless:snapshot-id"
+# Volumes in these states cannot be detached or deleted yet, or are already going away
+SKIPPED_STATES = ("creating", "deleting", "deleted")
+
+
+def volume_tags(owner_instance_id, job):
+    """
+    TagSpecifications of the volume of job
+    :param owner_instance_id: str, scanner instance
+    :param job: ScanJob
+    :return: list
+    """
+    tags = {
+        TAG_OWNER_INSTANCE: owner_instance_id,
+        TAG_OWNER_PID: os.getpid(),
+        TAG_TENANT_ID: job.tenant_id,
+        TAG_SCAN_ID: job.scan_id,
+        TAG_INSTANCE_ID: job.instance_id,
+        TAG_SNAPSHOT_ID: job.snapshot_id,
+    }
+    return [{"ResourceType": "volume", "Tags": [{"Key": key, "Value": str(value)} for key, value in tags.items()]}]
+
+
+def scan_mounts(root, mounts_file=PROC_MOUNTS):
+    """
+    Mounts of scan volumes, root/tenant_id/scan_id/instance_id/snapshot_id
+    :param root: str
+    :param mounts_file: str
+    :return: dict of mount point to device
+    """
+    mounts = {}
+    with open(mounts_file) as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            # spaces and tabs in mount points are octal escaped
+            mount_point = fields[1].encode().decode("unicode_escape")
+            relative = os.path.relpath(mount_point, root)
+            if not relative.startswith("..") and len(relative.split(os.sep)) == 4:
+                mounts[mount_point] = fields[0]
+    return mounts
+
+
+class OrphanReaper:
+    """
+    Reclaims what scanner processes left behind when they died between volume creation and teardown:
+    volumes tagged with this instance whose owner process is gone, their mounts and device slots, and
+    scan mounts whose device no longer exists.
+
+    Tagged volumes, /proc/mounts and the device pool are read in one pass, the leftovers are queued on
+    the teardown queue and torn down in parallel before new jobs run
+    """
+
+    def __init__(self, client_factory, utility, teardowns, job_factory, mount_root, logger, extra):
+        """
+        :param client_factory: callable returning ec2 client
+        :param utility: Utility
+        :param teardowns: TeardownQueue
+        :param job_factory: callable(entry dict) returning ScanJob, entry has the teardown columns
+        :param mount_root: str
+        :param logger: obj
+        :param extra: dict
+        """
+        self.client_factory = client_factory
+        self.utility = utility
+        self.teardowns = teardowns
+        self.job_factory = job_factory
+        self.mount_root = mount_root
+        self.logger = logger
+        self.extra = extra
+
+    def tagged_volumes(self, instance_id):
+        """
+        Volumes tagged as owned by the scanner instance
+        :param instance_id: str
+        :return: list
+        """
+        volumes = []
+        paginator = self.client_factory().get_paginator("describe_volumes")
+        for page in paginator.paginate(Filters=[{"Name": "tag:{}".format(TAG_OWNER_INSTANCE), "Values": [instance_id]}]):
+            volumes.extend(page["Volumes"])
+        return volumes
+
+    def is_orphan(self, volume, busy):
+        """
+        Volume whose owner process exited and which no queued teardown covers
+        :param volume: dict, DescribeVolumes entry
+        :param busy: set, volume ids of recorded teardowns
+        :return: bool
+        """
+        if volume["VolumeId"] in busy or volume["State"] in SKIPPED_STATES:
+            return False
+        tags = {tag["Key"]: tag["Value"] for tag in volume.get("Tags", [])}
+        try:
+            pid = int(tags.get(TAG_OWNER_PID))
+        except (TypeError, ValueError):
+            return True
+        return pid != os.getpid() and not self.utility.is_process_alive(pid)
+
+    def orphan_entry(self, volume, instance_id):
+        """
+        Teardown columns of an orphaned volume, its mount point is rebuilt from the tags and its device
+        is the one it is attached under on this instance
+        :param volume: dict
+        :param instance_id: str
+        :return: dict
+        """
+        tags = {tag["Key"]: tag["Value"] for tag in volume.get("Tags", [])}
+        ids = [tags.get(key, "") for key in (TAG_TENANT_ID, TAG_SCAN_ID, TAG_INSTANCE_ID, TAG_SNAPSHOT_ID)]
+        device = next((attachment["Device"] for attachment in volume.get("Attachments", []) if attachment["InstanceId"] == instance_id), None)
+        return {'volume_id': volume["VolumeId"], 'device': device, 'mounted_path': os.path.join(self.mount_root, *ids) if all(ids) else None,
+                'tenant_id': ids[0], 'scan_id': ids[1], 'instance_id': ids[2], 'snapshot_id': ids[3]}
+
+    def reap(self, instance_id, keep=()):
+        """
+        Tear down leftovers of exited scanner processes and wait until they are gone
+        :param instance_id: str
+        :param keep: set, volume ids left for the jobs resuming with them
+        :return: tuple of (report dict, list of exceptions of failed teardowns)
+        """
+        report = {'volumes': [], 'mounts': [], 'devices': []}
+        try:
+            volumes = self.tagged_volumes(instance_id)
+        except ClientError as e:
+            self.logger.warning("Tagged volumes lookup failed, orphaned volumes are not reclaimed {}".format(e), extra=self.extra)
+            volumes = []
+        try:
+            mounts = scan_mounts(self.mount_root)
+        except OSError as e:
+            self.logger.warning("Mounts lookup failed {}".format(e), extra=self.extra)
+            mounts = {}
+        busy = self.utility.teardown_volume_ids(logger=self.logger, extra=self.extra) | set(keep)
+        entries = [self.orphan_entry(volume, instance_id) for volume in volumes if self.is_orphan(volume, busy)]
+        reaped_paths = set(entry['mounted_path'] for entry in entries)
+        # the volume of a mount whose device node is gone was detached under it, only the mount is left
+        entries += [{'volume_id': None, 'device': None, 'mounted_path': mount_point, 'tenant_id': "", 'scan_id': "", 'instance_id': "", 'snapshot_id': ""}
+                    for mount_point, device in mounts.items() if mount_point not in reaped_paths and device.startswith("/dev/") and not os.path.exists(device)]
+        for entry in entries:
+            job = self.job_factory(dict(entry, scratch_path=None))
+            if job.device:
+                job.device_lease = self.utility.adopt_device(job.device, logger=self.logger, extra=self.extra)
+                if not job.device_lease:
+                    # not in the pool or leased by a live scan, no slot to give back
+                    job.device = None
+            if job.volume_id:
+                report['volumes'].append(job.volume_id)
+            if job.mounted_path in mounts:
+                report['mounts'].append(job.mounted_path)
+            if job.device:
+                report['devices'].append(job.device)
+            self.teardowns.submit(job)
+        failures = self.teardowns.drain()
+        self.logger.info("Reaper reclaimed {} volumes {}, {} mounts {}, {} device slots {}, {} failed".format(
+            len(report['volumes']), report['volumes'], len(report['mounts']), report['mounts'], len(report['devices']), report['devices'], len(failures)), extra=self.extra)
+        return report, failures
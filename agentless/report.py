@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+
+REPORT_FOLDER = "reports"
+# Snapshot outcomes
+PENDING = "pending"
+SUCCESS = "success"
+REUSED = "reused"
+FAILED = "failed"
+
+
+class ScanReport:
+    """
+    Outcome of every snapshot of a scan: status, failed stage, error and seconds per stage. Snapshots
+    are independent units, the report tells the orchestrator which of them to submit again.
+
+    Jobs enter stages as they go, the time until the next stage or the end of the job is added to the
+    stage. Background uploads of the scan's archives report under the same snapshot
+    """
+
+    def __init__(self, tenant_id, scan_id, snapshot_data):
+        """
+        :param tenant_id: str
+        :param scan_id: str
+        :param snapshot_data: dict of snapshot id to instance id
+        """
+        self.tenant_id = str(tenant_id)
+        self.scan_id = str(scan_id)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.snapshots = {str(snapshot_id): {'snapshotId': str(snapshot_id), 'instanceId': str(instance_id), 'status': PENDING,
+                                             'failedStage': None, 'errorClass': None, 'error': None, 'durations': {},
+                                             'volumeProfile': None, 'readMBps': None}
+                          for snapshot_id, instance_id in snapshot_data.items()}
+        # snapshot id to (stage, monotonic start) of the stage in progress
+        self.current = {}
+
+    def outcome(self, job):
+        if str(job.scan_id) != self.scan_id or str(job.tenant_id) != self.tenant_id:
+            return None
+        return self.snapshots.get(str(job.snapshot_id))
+
+    def close_stage(self, job, outcome):
+        stage, started = self.current.pop(str(job.snapshot_id), (None, None))
+        if stage is not None:
+            outcome['durations'][stage] = round(outcome['durations'].get(stage, 0.0) + time.monotonic() - started, 3)
+        return stage
+
+    def enter(self, job, stage):
+        """
+        Job starts stage, the previous one ends
+        :param job: ScanJob
+        :param stage: str
+        :return:
+        """
+        with self.lock:
+            outcome = self.outcome(job)
+            if outcome is None:
+                return
+            self.close_stage(job, outcome)
+            self.current[str(job.snapshot_id)] = (stage, time.monotonic())
+
+    def finish(self, job, status=SUCCESS):
+        """
+        Job completed
+        :param job: ScanJob
+        :param status: str
+        :return:
+        """
+        with self.lock:
+            outcome = self.outcome(job)
+            if outcome is None:
+                return
+            self.close_stage(job, outcome)
+            outcome['status'] = status
+            outcome['failedStage'] = outcome['errorClass'] = outcome['error'] = None
+
+    def annotate(self, job, **fields):
+        """
+        Record facts about the job next to its outcome
+        :param job: ScanJob
+        :param fields: report keys and values
+        :return:
+        """
+        with self.lock:
+            outcome = self.outcome(job)
+            if outcome is not None:
+                outcome.update(fields)
+
+    def pause(self, job):
+        """
+        Job handed over to a background stage which reports on its own
+        :param job: ScanJob
+        :return:
+        """
+        with self.lock:
+            outcome = self.outcome(job)
+            if outcome is not None:
+                self.close_stage(job, outcome)
+
+    def fail(self, job, error):
+        """
+        Job failed in its current stage
+        :param job: ScanJob
+        :param error: Exception
+        :return:
+        """
+        with self.lock:
+            outcome = self.outcome(job)
+            if outcome is None:
+                return
+            stage = self.close_stage(job, outcome) or outcome['failedStage']
+            # the error that caused a wrapping "... failed" exception names the actual fault
+            cause = error.__cause__ or error
+            outcome.update(status=FAILED, failedStage=stage, errorClass=type(cause).__name__, error=str(error))
+
+    def as_dict(self):
+        """
+        Report of the scan, snapshots still pending are reported as failed in their last stage
+        :return: dict
+        """
+        with self.lock:
+            snapshots = []
+            for snapshot_id, outcome in self.snapshots.items():
+                outcome = dict(outcome, durations=dict(outcome['durations']))
+                if outcome['status'] == PENDING:
+                    outcome.update(status=FAILED, failedStage=self.current.get(snapshot_id, (None,))[0], errorClass="Incomplete")
+                snapshots.append(outcome)
+        return {'tenantId': self.tenant_id, 'scanId': self.scan_id, 'seconds': round(time.time() - self.started, 3),
+                'succeeded': sum(outcome['status'] != FAILED for outcome in snapshots), 'failed': sum(outcome['status'] == FAILED for outcome in snapshots),
+                'snapshots': snapshots}
+
+    def write(self, directory):
+        """
+        Write the report to directory/<scanId>.json
+        :param directory: str
+        :return: dict
+        """
+        report = self.as_dict()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "{}.json".format(self.scan_id))
+        with open(path + ".part", "w") as file:
+            json.dump(report, file, indent=2)
+        os.replace(path + ".part", path)
+        return report
@@ -0,0 +1,137 @@
+import logging
+import random
+import threading
+
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError, ClientError, ParamValidationError
+from tenacity import retry, stop_never
+
+THROTTLING = "throttling"
+TRANSIENT = "transient"
+EVENTUAL_CONSISTENCY = "eventual-consistency"
+TERMINAL = "terminal"
+
+THROTTLING_CODES = frozenset((
+    "RequestLimitExceeded", "Throttling", "ThrottlingException", "ThrottledException", "RequestThrottled",
+    "RequestThrottledException", "TooManyRequestsException", "SlowDown", "BandwidthLimitExceeded",
+    "EC2ThrottledException", "ProvisionedThroughputExceededException",
+))
+TRANSIENT_CODES = frozenset((
+    "InternalError", "InternalFailure", "ServiceUnavailable", "Unavailable", "RequestTimeout",
+    "RequestTimeoutException", "IDPCommunicationError", "PriorRequestNotComplete",
+))
+# Returned while a resource created or changed a moment ago is not visible everywhere yet
+EVENTUAL_CONSISTENCY_CODES = frozenset((
+    "InvalidVolume.NotFound", "InvalidAttachment.NotFound", "IncorrectState", "VolumeInUse",
+    "InvalidUploadId.NotFound", "NoSuchUpload",
+))
+# Attempts and full jitter backoff (base, max seconds) per error class, terminal errors are not retried
+BACKOFF = {
+    THROTTLING: (8, 1.0, 20.0),
+    TRANSIENT: (5, 0.5, 10.0),
+    EVENTUAL_CONSISTENCY: (10, 1.0, 5.0),
+    TERMINAL: (1, 0.0, 0.0),
+}
+
+
+class TransientError(Exception):
+    """
+    Failure known to clear up when the call is made again
+    """
+
+
+def classify(error):
+    """
+    Retry class of an error raised by an AWS call or a local step
+    :param error: Exception
+    :return: str
+    """
+    # upload_file raises S3UploadFailedError in place of the ClientError of the failed request
+    if isinstance(error, S3UploadFailedError) and (error.__cause__ or error.__context__) is not None:
+        return classify(error.__cause__ or error.__context__)
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code", "")
+        if code in THROTTLING_CODES:
+            return THROTTLING
+        if code in EVENTUAL_CONSISTENCY_CODES:
+            return EVENTUAL_CONSISTENCY
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        if code in TRANSIENT_CODES or status >= 500:
+            return TRANSIENT
+        return TERMINAL
+    # malformed requests never succeed, connection and credential fetch errors do
+    if isinstance(error, ParamValidationError):
+        return TERMINAL
+    if isinstance(error, (BotoCoreError, TransientError, OSError)):
+        return TRANSIENT
+    return TERMINAL
+
+
+class RetryPolicy:
+    """
+    Central retry policy of AWS calls and local mount steps. Errors are classified as throttling,
+    transient, eventual consistency or terminal, every class has its own attempts and backoff and
+    terminal errors are raised at once. The original error is raised once attempts are exhausted.
+
+    Retries stop at the deadline of the job the call works for, the last error is raised then.
+    Retries and final failures are counted per class
+    """
+
+    def __init__(self, backoff=None):
+        """
+        :param backoff: dict of class to (attempts, base seconds, max seconds)
+        """
+        self.backoff = dict(backoff or BACKOFF)
+        self.lock = threading.Lock()
+        self.counts = {name: {'retries': 0, 'failures': 0} for name in self.backoff}
+
+    @staticmethod
+    def deadline_of(retry_state):
+        # deadline of the job or writer the call works for, calls without one are bound by attempts only
+        return next((arg.deadline for arg in list(retry_state.args) + list(retry_state.kwargs.values()) if getattr(arg, "deadline", None) is not None), None)
+
+    def should_retry(self, retry_state):
+        if not retry_state.outcome.failed:
+            return False
+        name = classify(retry_state.outcome.exception())
+        attempts = self.backoff[name][0]
+        deadline = self.deadline_of(retry_state)
+        retrying = retry_state.attempt_number < attempts and (deadline is None or not deadline.expired())
+        with self.lock:
+            self.counts[name]['retries' if retrying else 'failures'] += 1
+        return retrying
+
+    def wait(self, retry_state):
+        _, base, maximum = self.backoff[classify(retry_state.outcome.exception())]
+        deadline = self.deadline_of(retry_state)
+        if deadline is not None:
+            maximum = min(maximum, deadline.remaining())
+        return random.uniform(0, min(maximum, base * 2 ** (retry_state.attempt_number - 1)))
+
+    @staticmethod
+    def log_retry(retry_state):
+        # extra of the job when the call has one, as in method_start_end otherwise
+        job = next((arg for arg in list(retry_state.args) + list(retry_state.kwargs.values()) if hasattr(arg, "snapshot_id") and hasattr(arg, "extra")), None)
+        extra = job.extra if job is not None else {'scanId': None, 'tenantId': None}
+        error = retry_state.outcome.exception()
+        logging.getLogger("Agentless").warning("{} failed with {} error {}, attempt {} retrying in {:.1f}s".format(
+            retry_state.fn.__name__, classify(error), error, retry_state.attempt_number, retry_state.next_action.sleep), extra=extra)
+
+    def __call__(self, func):
+        """
+        Decorate func with the policy
+        :param func: callable
+        :return: callable
+        """
+        return retry(retry=self.should_retry, wait=self.wait, stop=stop_never, before_sleep=self.log_retry, reraise=True)(func)
+
+    def stats(self):
+        """
+        Retries and final failures per error class
+        :return: dict
+        """
+        with self.lock:
+            return {name: dict(counts) for name, counts in self.counts.items()}
+
+
+retry_policy = RetryPolicy()
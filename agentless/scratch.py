@@ -0,0 +1,143 @@
+import os
+import shutil
+import threading
+
+MB = 1024 * 1024
+# Share of the free space of the scratch file system used when no budget is configured
+AUTO_BUDGET_RATIO = 0.9
+# tar headers, manifest and compression overhead on incompressible input
+ARCHIVE_OVERHEAD = MB
+# Largest share of the budget a single up-front reservation takes
+UPFRONT_MAX_SHARE = 0.25
+
+
+class ScratchManager:
+    """
+    Scratch workspace for intermediate artifacts on a fast local path (tmpfs or NVMe instance store).
+    Every job reserves the space it may need before writing, jobs block while the budget is exhausted
+    which applies backpressure to new jobs instead of filling the file system.
+
+    A job reserves a capped up-front share before its volume is created and grows it to the actual
+    need once its files are known. The outstanding total of both never exceeds the budget. The up-front
+    share holds no bytes yet, a growing job gives its own up and revokes the newest shares of other jobs
+    instead of waiting for them, their jobs may be waiting for its slot and reserve again when they grow.
+    New up-front reservations wait while a job is growing, so running jobs are served first
+    """
+
+    def __init__(self, root, budget_mb, logger, extra):
+        """
+        :param root: str
+        :param budget_mb: int, 0 uses AUTO_BUDGET_RATIO of the free space
+        :param logger: obj
+        :param extra: dict
+        """
+        self.root = root
+        self.logger = logger
+        self.extra = extra
+        os.makedirs(root, exist_ok=True)
+        if budget_mb:
+            self.budget = int(budget_mb) * MB
+        else:
+            self.budget = int(shutil.disk_usage(root).free * AUTO_BUDGET_RATIO)
+        self.reserved = {}
+        # jobs whose reservation was grown to their actual need
+        self.grown = set()
+        self.growing = 0
+        self.condition = threading.Condition()
+        self.logger.info("Scratch path {} budget {} MB".format(root, self.budget // MB), extra=extra)
+
+    def job_path(self, job):
+        """
+        Scratch path of job root/tenant_id/scan_id/instance_id/snapshot_id
+        :param job: ScanJob
+        :return: str
+        """
+        return os.path.join(self.root, str(job.tenant_id), str(job.scan_id), str(job.instance_id), str(job.snapshot_id))
+
+    @staticmethod
+    def estimate(members):
+        """
+        Worst case scratch bytes for archiving members, the layer.tar spool. tosend.tar.gz is written
+        to the upload spool or streamed
+        :param members: list of (source_path, arcname)
+        :return: int
+        """
+        return sum(os.stat(source_path).st_size for source_path, _ in members) + ARCHIVE_OVERHEAD
+
+    def used(self):
+        return sum(self.reserved.values())
+
+    def grown_used(self):
+        return sum(self.reserved[key] for key in self.grown)
+
+    def reserve(self, job, size, timeout):
+        """
+        Up-front reservation of job, capped to UPFRONT_MAX_SHARE of the budget, blocks until enough
+        budget is free and no job is waiting to grow
+        :param job: ScanJob
+        :param size: int
+        :param timeout: int
+        :return: bool
+        """
+        size = min(size, int(self.budget * UPFRONT_MAX_SHARE))
+        with self.condition:
+            if not self.condition.wait_for(lambda: not self.growing and self.used() + size <= self.budget, timeout=timeout):
+                self.logger.error("Scratch space wait timeout, {} MB needed {} MB in use".format(size // MB, self.used() // MB), extra=job.extra)
+                return False
+            self.reserved[job.snapshot_id] = size
+        self.logger.debug("Scratch reserved {} MB".format(size // MB), extra=job.extra)
+        return True
+
+    def grow(self, job, size, timeout):
+        """
+        Replace the reservation of job with its actual need, blocks until the grown reservations of
+        other jobs leave enough budget and revokes up-front reservations until the total fits
+        :param job: ScanJob
+        :param size: int
+        :param timeout: int
+        :return: bool
+        """
+        with self.condition:
+            if size > self.budget:
+                self.logger.warning("Scratch needed {} MB is above budget {} MB".format(size // MB, self.budget // MB), extra=job.extra)
+                size = self.budget
+            # the up-front share is given up while waiting, two growing jobs never wait for each other's share
+            self.reserved.pop(job.snapshot_id, None)
+            self.grown.discard(job.snapshot_id)
+            self.growing += 1
+            try:
+                if not self.condition.wait_for(lambda: self.grown_used() + size <= self.budget, timeout=timeout):
+                    self.logger.error("Scratch space wait timeout, {} MB needed {} MB in use".format(size // MB, self.grown_used() // MB), extra=job.extra)
+                    return False
+                self.revoke(self.used() + size - self.budget, job)
+                self.reserved[job.snapshot_id] = size
+                self.grown.add(job.snapshot_id)
+            finally:
+                self.growing -= 1
+                self.condition.notify_all()
+        self.logger.debug("Scratch grown to {} MB".format(size // MB), extra=job.extra)
+        return True
+
+    def revoke(self, size, job):
+        """
+        Drop up-front reservations, newest first, until size bytes are free
+        :param size: int
+        :param job: ScanJob
+        :return:
+        """
+        for key in reversed([key for key in self.reserved if key not in self.grown]):
+            if size <= 0:
+                break
+            size -= self.reserved.pop(key)
+            self.logger.debug("Scratch up-front reservation of {} revoked".format(key), extra=job.extra)
+
+    def release(self, job):
+        """
+        Release reservation of job
+        :param job: ScanJob
+        :return:
+        """
+        with self.condition:
+            self.reserved.pop(job.snapshot_id, None)
+            self.grown.discard(job.snapshot_id)
+            self.condition.notify_all()
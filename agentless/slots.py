@@ -0,0 +1,144 @@
+import errno
+import glob
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+SOCKET_SUFFIX = ".sock"
+# Waiters re-check at least this often so that slots freed by lease expiry, which sends no
+# wakeup, are found without a release
+RECHECK_INTERVAL = 30
+
+
+class SlotWaiter:
+    """
+    Blocking acquisition of device slots. Waiters of this process queue per slot kind and are
+    served in FIFO order, a release wakes them immediately through a condition variable.
+
+    Other processes on the host are woken through unix datagram sockets, every waiting process
+    binds <directory>/<pid>.sock and a release sends one datagram to each of them
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: str
+        """
+        self.directory = directory
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.tickets = 0
+        self.generation = 0
+        self.socket = None
+        self.socket_path = os.path.join(directory, "{}{}".format(os.getpid(), SOCKET_SUFFIX))
+
+    def listen(self):
+        """
+        Bind the wakeup socket of this process and start its listener thread once
+        :return:
+        """
+        with self.condition:
+            if self.socket is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.bind(self.socket_path)
+            threading.Thread(target=self.receive, args=(self.socket,), name="slot-waiter", daemon=True).start()
+
+    def receive(self, sock):
+        while True:
+            try:
+                sock.recv(64)
+            except OSError:
+                return
+            self.wake()
+
+    def wake(self):
+        """
+        Wake waiters of this process
+        :return:
+        """
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def notify(self, logger, extra):
+        """
+        Wake waiters of this process and of every other process on the host
+        :param logger: obj
+        :param extra: dict
+        :return:
+        """
+        self.wake()
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        try:
+            for path in glob.glob(os.path.join(self.directory, "*{}".format(SOCKET_SUFFIX))):
+                if path == self.socket_path:
+                    continue
+                try:
+                    sender.sendto(b"1", path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # socket of an exited process
+                    self.remove(path)
+                except OSError as e:
+                    # a full queue already holds a pending wakeup
+                    if e.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                        logger.warning("Slot wakeup of {} failed {}".format(path, e), extra=extra)
+        finally:
+            sender.close()
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def acquire(self, kind, claim, timeout, recheck=RECHECK_INTERVAL):
+        """
+        Block until claim returns a slot, waiters of the same kind are served first come first served.
+        Only the head of the queue runs claim, so a woken waiter never loses its slot to a later one
+        :param kind: str
+        :param claim: callable returning the slot or a falsy value
+        :param timeout: int
+        :param recheck: int, longest wait without a wakeup
+        :return: obj or False
+        """
+        self.listen()
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.tickets += 1
+            ticket = self.tickets
+            queue = self.queues.setdefault(kind, deque())
+            queue.append(ticket)
+        try:
+            while True:
+                with self.condition:
+                    if not self.condition.wait_for(lambda: queue[0] == ticket, timeout=max(deadline - time.monotonic(), 0)):
+                        return False
+                    # read before claiming, a release while claiming still wakes the next wait
+                    generation = self.generation
+                slot = claim()
+                if slot:
+                    return slot
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                with self.condition:
+                    self.condition.wait_for(lambda: self.generation != generation, timeout=min(remaining, recheck))
+        finally:
+            with self.condition:
+                queue.remove(ticket)
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            if self.socket is None:
+                return
+            self.socket.close()
+            self.socket = None
+        self.remove(self.socket_path)
@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from agentless.scratch import MB
+
+# Folder of the app data path used when no spool path is configured
+SPOOL_FOLDER = "spool"
+# Runs an archive is offered for upload before it is dropped from the spool
+MAX_UPLOAD_ATTEMPTS = 10
+# Seconds between checks of a full spool, other processes free space without notifying this one
+SPOOL_POLL_SECONDS = 5
+
+
+class UploadSpool:
+    """
+    Durable queue of archives waiting for upload. An archive is written and fsynced under directory
+    and recorded in SQLite before the snapshot volume is released, a background pool then uploads it
+    so a device slot is only held while files are extracted.
+
+    Uploads failing in this run stay spooled and are resumed by the next run for the same bucket.
+    The archives under directory, of every run and process, never exceed capacity bytes, a new archive
+    waits until uploads free enough space which applies backpressure to the jobs writing them
+    """
+
+    def __init__(self, directory, capacity, deliver, utility, workers, logger, extra):
+        """
+        :param directory: str
+        :param capacity: int, MB
+        :param deliver: callable(entry dict), uploads the archive at entry['path']
+        :param utility: Utility
+        :param workers: int
+        :param logger: obj
+        :param extra: dict
+        """
+        self.directory = directory
+        self.capacity = int(capacity) * MB
+        self.deliver = deliver
+        self.utility = utility
+        self.logger = logger
+        self.extra = extra
+        os.makedirs(directory, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="spool-upload")
+        self.lock = threading.Lock()
+        self.futures = []
+        self.condition = threading.Condition()
+        # archives being written by this process, entry id to the size reserved for them
+        self.writing = {}
+
+    def used(self):
+        """
+        Bytes of spooled archives and of the archives being written by this process
+        :return: int
+        """
+        spooled = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".part"))
+        return spooled + sum(self.writing.values())
+
+    def reserve(self, entry_id, size, timeout, extra):
+        """
+        Reserve size bytes for an archive, blocks until spooled archives leave enough capacity
+        :param entry_id: str
+        :param size: int
+        :param timeout: int
+        :param extra: dict
+        :return: bool
+        """
+        size = min(size, self.capacity)
+        expires = time.monotonic() + timeout
+        with self.condition:
+            while self.used() + size > self.capacity:
+                remaining = expires - time.monotonic()
+                if remaining <= 0:
+                    self.logger.error("Upload spool wait timeout, {} MB needed {} MB in use".format(size // MB, self.used() // MB), extra=extra)
+                    return False
+                self.condition.wait(min(remaining, SPOOL_POLL_SECONDS))
+            self.writing[entry_id] = size
+        return True
+
+    def write(self, name, write_archive, size, timeout, extra):
+        """
+        Write archive into the spool durably once capacity for it is free
+        :param name: str, archive file name
+        :param write_archive: callable(fileobj)
+        :param size: int, upper bound of the archive size
+        :param timeout: int
+        :param extra: dict
+        :return: tuple of (entry id, path) or None when the spool stayed full
+        """
+        entry_id = uuid.uuid4().hex
+        if not self.reserve(entry_id, size, timeout, extra):
+            return None
+        path = os.path.join(self.directory, "{}-{}".format(entry_id, name))
+        partial = path + ".part"
+        try:
+            with open(partial, "wb") as spool_file:
+                write_archive(spool_file)
+                spool_file.flush()
+                os.fsync(spool_file.fileno())
+            os.rename(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            with self.condition:
+                self.writing.pop(entry_id, None)
+                self.condition.notify_all()
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+        return entry_id, path
+
+    def submit(self, entry_id):
+        """
+        Upload spooled archive in the background
+        :param entry_id: str
+        :return:
+        """
+        with self.lock:
+            self.futures.append(self.executor.submit(self.upload, entry_id))
+
+    def resume(self, bucket):
+        """
+        Queue archives left in the spool by previous runs
+        :param bucket: str
+        :return: int
+        """
+        pending = self.utility.pending_uploads(bucket, logger=self.logger, extra=self.extra)
+        if pending:
+            self.logger.info("Resuming {} spooled uploads".format(len(pending)), extra=self.extra)
+        for entry_id in pending:
+            self.submit(entry_id)
+        return len(pending)
+
+    def discard(self, entry):
+        if os.path.exists(entry['path']):
+            os.unlink(entry['path'])
+        self.utility.finish_upload(entry['id'], logger=self.logger, extra=self.extra)
+        with self.condition:
+            self.condition.notify_all()
+
+    def upload(self, entry_id):
+        entry = self.utility.claim_upload(entry_id, logger=self.logger, extra=self.extra)
+        if entry is None:
+            return
+        if not os.path.exists(entry['path']):
+            self.logger.error("Spooled archive {} is missing, dropped".format(entry['path']), extra=self.extra)
+            self.discard(entry)
+            return
+        try:
+            self.deliver(entry)
+        except Exception as e:
+            if entry['attempts'] + 1 >= MAX_UPLOAD_ATTEMPTS:
+                self.logger.error("Spooled upload {} dropped after {} attempts".format(entry['object_name'], MAX_UPLOAD_ATTEMPTS), extra=self.extra)
+                self.discard(entry)
+            else:
+                self.utility.fail_upload(entry_id, logger=self.logger, extra=self.extra)
+            raise e
+        self.discard(entry)
+
+    def drain(self):
+        """
+        Wait for all queued uploads
+        :return: list of exceptions of failed uploads
+        """
+        failures = []
+        with self.lock:
+            futures, self.futures = self.futures, []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                self.logger.exception("Spooled upload failed {}".format(e), extra=self.extra)
+                failures.append(e)
+        return failures
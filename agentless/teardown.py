@@ -0,0 +1,98 @@
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs a teardown is retried before it is dropped and left to the operator
+MAX_TEARDOWN_ATTEMPTS = 10
+
+
+class TeardownQueue:
+    """
+    Background teardown of scan volumes: unmount, detach, device slot release, delete and removal of
+    the job directories. Every step checks the current state first so a teardown can run again after
+    a partial failure or a crash.
+
+    Teardowns are recorded in SQLite before they are queued, teardowns left by a crashed run are
+    resumed by the next one. They run in parallel, off the critical path of the next snapshot
+    """
+
+    def __init__(self, steps, utility, workers, logger, extra):
+        """
+        :param steps: callable(ScanJob), idempotent teardown of one job
+        :param utility: Utility
+        :param workers: int
+        :param logger: obj
+        :param extra: dict
+        """
+        self.steps = steps
+        self.utility = utility
+        self.logger = logger
+        self.extra = extra
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="teardown")
+        self.lock = threading.Lock()
+        self.futures = []
+
+    def submit(self, job):
+        """
+        Record teardown of job and run it in the background
+        :param job: ScanJob
+        :return: str, teardown id
+        """
+        entry = {'id': uuid.uuid4().hex, 'volume_id': job.volume_id, 'device': job.device, 'mounted_path': job.mounted_path, 'scratch_path': job.scratch_path,
+                 'tenant_id': str(job.tenant_id), 'scan_id': str(job.scan_id), 'instance_id': str(job.instance_id), 'snapshot_id': str(job.snapshot_id)}
+        if not self.utility.save_teardown(entry, logger=self.logger, extra=job.extra):
+            # still torn down, only not resumable after a crash
+            self.logger.error("Teardown of {} not recorded".format(job.volume_id), extra=job.extra)
+        with self.lock:
+            self.futures.append(self.executor.submit(self.run, entry['id'], job))
+        return entry['id']
+
+    def resume(self, job_factory):
+        """
+        Queue teardowns left by previous runs, their device slots are taken over first so that no
+        new scan attaches under a name still used by a leftover volume
+        :param job_factory: callable(entry dict) returning ScanJob
+        :return: int
+        """
+        pending = self.utility.pending_teardowns(logger=self.logger, extra=self.extra)
+        if pending:
+            self.logger.info("Resuming {} teardowns".format(len(pending)), extra=self.extra)
+        for entry in pending:
+            job = job_factory(entry)
+            if job.device:
+                job.device_lease = self.utility.adopt_device(job.device, logger=self.logger, extra=self.extra)
+                if not job.device_lease:
+                    # slot is in use by a live scan, so the leftover volume no longer holds it
+                    job.device = None
+            with self.lock:
+                self.futures.append(self.executor.submit(self.run, entry['id'], job))
+        return len(pending)
+
+    def run(self, teardown_id, job):
+        if not self.utility.claim_teardown(teardown_id, logger=self.logger, extra=job.extra):
+            return
+        try:
+            self.steps(job)
+        except Exception as e:
+            attempts = self.utility.fail_teardown(teardown_id, logger=self.logger, extra=job.extra)
+            if attempts >= MAX_TEARDOWN_ATTEMPTS:
+                self.logger.error("Teardown of volume {} dropped after {} attempts".format(job.volume_id, attempts), extra=job.extra)
+                self.utility.finish_teardown(teardown_id, logger=self.logger, extra=job.extra)
+            raise e
+        self.utility.finish_teardown(teardown_id, logger=self.logger, extra=job.extra)
+
+    def drain(self):
+        """
+        Wait for all queued teardowns
+        :return: list of exceptions of failed teardowns
+        """
+        failures = []
+        with self.lock:
+            futures, self.futures = self.futures, []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                self.logger.exception("Teardown failed {}".format(e), extra=self.extra)
+                failures.append(e)
+        return failures
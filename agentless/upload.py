@@ -0,0 +1,127 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from agentless.retries import retry_policy
+
+# S3 rejects parts smaller than 5 MiB except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    Writable file object feeding an S3 multipart upload. Written bytes are cut into parts which are
+    uploaded in parallel while the archive is still being compressed. At most parts_in_flight parts
+    are held in memory, a writer blocks when all of them are pending which bounds the memory used
+    per job and slows compression down to the upload speed. Every part is retried on its own, no part
+    is queued or retried past the deadline.
+    """
+
+    def __init__(self, client, bucket_name, object_name, logger, extra, part_size=8 * 1024 * 1024, parts_in_flight=4, deadline=None):
+        """
+        :param client: obj s3 client
+        :param bucket_name: str
+        :param object_name: str
+        :param logger: obj
+        :param extra: dict
+        :param part_size: int
+        :param parts_in_flight: int
+        :param deadline: Deadline or None
+        """
+        super().__init__()
+        self.client = client
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.logger = logger
+        self.extra = extra
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.deadline = deadline
+        self.buffer = bytearray()
+        self.futures = []
+        self.part_number = 0
+        self.bytes_written = 0
+        self.slots = threading.BoundedSemaphore(parts_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=parts_in_flight, thread_name_prefix="upload-part")
+        self.upload_id = self.client.create_multipart_upload(Bucket=bucket_name, Key=object_name)["UploadId"]
+        self.logger.info("Multipart upload {} started for {}".format(self.upload_id, object_name), extra=extra)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def submit(self, data):
+        """
+        Queue a part for upload, blocks while parts_in_flight parts are pending
+        :param data: bytes
+        :return:
+        """
+        if self.deadline is not None:
+            self.deadline.check()
+        self.slots.acquire()
+        for future in self.futures:
+            # fail fast, a part which exhausted its retries makes the whole upload fail
+            if future.done() and future.exception():
+                self.slots.release()
+                raise future.exception()
+        self.part_number += 1
+        future = self.executor.submit(self.upload_part, self.part_number, data)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    @retry_policy
+    def upload_part(self, part_number, data):
+        """
+        Upload single part
+        :param part_number: int
+        :param data: bytes
+        :return: dict
+        """
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=self.object_name, UploadId=self.upload_id, PartNumber=part_number, Body=data)
+        self.logger.debug("Part {} of {} uploaded size {}".format(part_number, self.object_name, len(data)), extra=self.extra)
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def close(self):
+        """
+        Upload the remaining bytes and complete the upload
+        :return:
+        """
+        if self.closed:
+            return
+        try:
+            if self.buffer or not self.part_number:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            parts = [future.result() for future in self.futures]
+            self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.object_name, UploadId=self.upload_id, MultipartUpload={"Parts": parts})
+        except Exception:
+            self.abort()
+            raise
+        self.logger.info("Multipart upload completed for {} parts {} size {}".format(self.object_name, len(parts), self.bytes_written), extra=self.extra)
+        self.executor.shutdown(wait=True)
+        super().close()
+
+    def abort(self):
+        """
+        Abort the upload, S3 discards the uploaded parts
+        :return:
+        """
+        self.executor.shutdown(wait=True)
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.object_name, UploadId=self.upload_id)
+            self.logger.warning("Multipart upload aborted for {}".format(self.object_name), extra=self.extra)
+        except Exception as e:
+            self.logger.exception("Multipart upload abort failed for {} {}".format(self.object_name, e), extra=self.extra)
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -1,177 +1,725 @@
+import os
 import time
+import uuid
 
-from blkinfo import BlkDiskInfo
+import shnbin_common
 
-from agentless.model import session, Device, DeviceMount
-from sqlalchemy.exc import IntegrityError, NoResultFound, SQLAlchemyError, MultipleResultsFound, NoSuchTableError, DataError, DatabaseError
+from agentless.slots import SlotWaiter
+from agentless.model import session, lease_engine, Device, LayerDigest, SnapshotResult, JobStage
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
 import threading
 
+# Seconds a device slot lease is valid without renewal, a crashed run frees its slots after this
+LEASE_DURATION = 900
+LEASE_RENEW_INTERVAL = 60
+
 
 class Utility:
 
     def __init__(self):
         self.lock = threading.Lock()
+        # owner token -> (table, value) of slots leased by this process
+        self.leases = {}
+        self.leases_lock = threading.Lock()
+        self.renewer = None
+        self.slots = SlotWaiter(os.path.join(shnbin_common.get_app_data_path(), "slots"))
+
+    def pool_devices(self, logger, extra):
+        """
+        Device names in the slot pool
+        :param extra: dict
+        :param logger: obj
+        :return: set
+        """
+        try:
+            with lease_engine.begin() as connection:
+                return set(value for value, in connection.execute(text('SELECT value FROM "device"')))
+        except SQLAlchemyError as e:
+            logger.error("there was some while querying devices {}".format(e), extra=extra)
+            return set()
 
-    def all_devices(self, logger, extra):
+    def all_devices(self, device_names, logger, extra):
         """
-        Get All Available Devices
+        Size the device slot pool to device_names. Free slots outside of it are removed, slots held by
+        a running scan stay until they are released
+        :param device_names: list
+        :param extra: dict
+        :param logger: obj
         :return: dict
         """
         try:
-            devices = session.query(Device).all()
-        except (DataError, DatabaseError, NoSuchTableError, NoResultFound, SQLAlchemyError) as e:
-            logger.error("there was some while querying table {}".format(e))
-            return {'devices': []}
-        if len(devices) > 0:
-            logger.info("Devices already populated {}".format(devices), extra=extra)
-            return {'device': [(device.value, device.status) for device in devices]}
-        else:
-            # Recommended device names for Linux: /dev/sda1 for root volume. /dev/sd[f-p] for data volumes.
-            # Above info shown when mounting a volume from AWS console.
-            with self.lock:
-                for i in 'fghijklmnop':
-                    device = Device(value=('/dev/sd{}'.format(i)), status=True)
-                    try:
-                        session.add(device)
-                        session.commit()
-                    except IntegrityError as e:
-                        logger.error("trying to insert duplicate Entries {}".format(e), extra=extra)
-                        return {'device': "Device Population Failed! trying to insert duplicate Entries"}
-                logger.info("Device Population Successful", extra=extra)
-                return {'device': "Device Population Successful"}
-
-    def get_device_mount(self, logger, extra):
-        """
-        Get Device Mount
+            with lease_engine.begin() as connection:
+                # INSERT OR IGNORE, another process may populate the table at the same time
+                for value in device_names:
+                    connection.execute(text('INSERT OR IGNORE INTO "device" (value, status) VALUES (:value, 1)'), {'value': value})
+                for value, in connection.execute(text('SELECT value FROM "device"')).fetchall():
+                    if value not in device_names:
+                        connection.execute(text('DELETE FROM "device" WHERE value = :value AND (status = 1 OR lease_expires < :now)'), {'value': value, 'now': time.time()})
+                devices = connection.execute(text('SELECT value, status FROM "device" ORDER BY value')).fetchall()
+        except SQLAlchemyError as e:
+            logger.error("there was some while populating devices {}".format(e), extra=extra)
+            return {'device': []}
+        logger.info("Device Population Successful {} slots".format(len(devices)), extra=extra)
+        return {'device': [(value, bool(status)) for value, status in devices]}
+
+    def free_device_count(self, logger, extra):
+        """
+        Count of devices which are free for attaching, expired leases count as free
         :param extra: dict
         :param logger: obj
-        :return:
+        :return: int
         """
-        with self.lock:
-            count = 0
-            device = self.mount_point(logger=logger, extra=extra)
-            count += 1
-            while not device:
-                time.sleep(2)
-                device = self.mount_point(logger=logger, extra=extra)
-                count += 1
-                if count == 20:
-                    return {'device': False}
-            else:
-                return {'device': device}
+        try:
+            with lease_engine.begin() as connection:
+                return connection.execute(text('SELECT COUNT(*) FROM "device" WHERE status = 1 OR lease_expires < :now'), {'now': time.time()}).scalar()
+        except SQLAlchemyError as e:
+            logger.error("there was some while counting free devices {}".format(e), extra=extra)
+            return 0
 
     @staticmethod
-    def check_if_device_already_present(value, logger, extra):
+    def is_process_alive(pid):
         """
-        Check if device is already mounted
-        :param extra: dict
+        Check if process exists on this host
+        :param pid: int
+        :return: bool
+        """
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def expire_dead_owners(self, connection, table, logger, extra):
+        """
+        Expire leases held by processes which no longer exist, the slots are then reclaimed by the
+        next conditional UPDATE of the same transaction
+        :param connection: obj
+        :param table: str
         :param logger: obj
+        :param extra: dict
+        :return:
+        """
+        pids = connection.execute(text('SELECT DISTINCT owner_pid FROM "{}" WHERE status = 0 AND owner_pid IS NOT NULL'.format(table))).fetchall()
+        for pid, in pids:
+            if pid != os.getpid() and not self.is_process_alive(pid):
+                connection.execute(text('UPDATE "{}" SET lease_expires = 0 WHERE status = 0 AND owner_pid = :pid'.format(table)), {'pid': pid})
+                logger.warning("Reclaiming {} slots of exited process {}".format(table, pid), extra=extra)
+
+    def lease_params(self, owner, now):
+        return {'owner': owner, 'pid': os.getpid(), 'expires': now + LEASE_DURATION, 'now': now}
+
+    def hold_lease(self, table, value, owner, logger, extra):
+        """
+        Remember owner token of a claimed slot and keep the lease renewed while it is held
+        :param table: str
         :param value: str
+        :param owner: str
+        :param logger: obj
+        :param extra: dict
+        :return:
+        """
+        with self.leases_lock:
+            self.leases[owner] = (table, value)
+            if self.renewer is None:
+                self.renewer = threading.Thread(target=self.renew_leases_forever, args=(logger, extra), name="lease-renewer", daemon=True)
+                self.renewer.start()
+
+    def renew_leases_forever(self, logger, extra):
+        while True:
+            time.sleep(LEASE_RENEW_INTERVAL)
+            self.renew_leases(logger=logger, extra=extra)
+
+    def renew_leases(self, logger, extra):
+        """
+        Extend expiry of all leases held by this process
+        :param logger: obj
+        :param extra: dict
         :return: bool
         """
+        with self.leases_lock:
+            leases = list(self.leases.items())
+        if not leases:
+            return True
         try:
-            device_mount = session.query(DeviceMount).filter_by(value=value).one_or_none()
-            if device_mount:
-                logger.info("Device {} status is {}".format(device_mount.value, "Free" if device_mount.status else "In Used"), extra=extra)
-                return device_mount, device_mount.status
-            else:
-                logger.info("Device is free for mount", extra=extra)
-                return False, False
-        except MultipleResultsFound as e:
-            logger.error("Multiple Result Found {}".format(e), extra=extra)
+            with lease_engine.begin() as connection:
+                for owner, (table, value) in leases:
+                    result = connection.execute(text('UPDATE "{}" SET lease_expires = :expires WHERE value = :value AND owner = :owner'.format(table)), {'expires': time.time() + LEASE_DURATION, 'value': value, 'owner': owner})
+                    if result.rowcount != 1:
+                        logger.error("Lease of {} {} was lost".format(table, value), extra=extra)
+            return True
+        except SQLAlchemyError as e:
+            logger.error("lease renewal failed {}".format(e), extra=extra)
             return False
 
-    def mount_point(self, logger, extra):
+    def release_lease(self, owner, logger, extra):
         """
-        Get dynamic device name after volume attach
+        Free slot if it is still leased under owner, a slot leased again by another job since then
+        keeps its new lease
+        :param owner: str, token the slot was leased under
+        :param logger: obj
         :param extra: dict
+        :return: bool
+        """
+        with self.leases_lock:
+            table, value = self.leases.pop(owner, (None, None))
+        if table is None:
+            return False
+        try:
+            with lease_engine.begin() as connection:
+                result = connection.execute(text('UPDATE "{}" SET status = 1, owner = NULL, owner_pid = NULL, lease_expires = NULL WHERE value = :value AND owner = :owner'.format(table)), {'value': value, 'owner': owner})
+        except SQLAlchemyError as e:
+            logger.error("{} release failed {}".format(table, e), extra=extra)
+            return False
+        self.slots.notify(logger=logger, extra=extra)
+        return result.rowcount == 1
+
+    def acquire_device(self, timeout, logger, extra):
+        """
+        Get Device, blocks until a slot is free or timeout, threads are served in FIFO order
+        :param timeout: int
         :param logger: obj
-        :return:
+        :param extra: dict
+        :return: dict with the device and the owner token of its lease
         """
-        for device in BlkDiskInfo().get_disks():
-            if device['children']:
-                for child_device in device['children']:
-                    if child_device['type'] == 'part' and child_device['mountpoint'] == "" and child_device['fstype']:
-                        device_name = "/dev/{}".format(child_device['name'])
-                        device_mount, status = self.check_if_device_already_present(value=device_name, logger=logger, extra=extra)
-                        if not device_mount:
-                            try:
-                                device_ = DeviceMount(value=device_name, status=False)
-                                session.add(device_)
-                                session.commit()
-                                logger.info("dynamic device name {} after volume attach".format(device_.value), extra=extra)
-                                return device_.value
-                            except IntegrityError as e:
-                                logger.error("trying to insert duplicate Entries {}".format(e), extra=extra)
-                                session.rollback()
-                                return False
-                        if not status:
-                            continue
-                        device_mount.status = False
-                        session.add(device_mount)
-                        session.commit()
-                        return device_mount.value
-        else:
+        def claim():
+            leased = self.get_device(logger=logger, extra=extra)
+            return leased if leased['device'] else False
+
+        return self.slots.acquire(Device.__tablename__, claim, timeout=timeout) or {'device': False, 'owner': None}
+
+    def get_device(self, logger, extra):
+        """
+        Get Device, one conditional UPDATE claims a free slot or a slot whose lease expired
+        :return: dict with the device and the owner token of its lease
+        """
+        owner = "{}:{}".format(os.getpid(), uuid.uuid4().hex)
+        try:
+            with lease_engine.begin() as connection:
+                self.expire_dead_owners(connection, Device.__tablename__, logger=logger, extra=extra)
+                connection.execute(text(
+                    'UPDATE "device" SET status = 0, owner = :owner, owner_pid = :pid, lease_expires = :expires '
+                    'WHERE value = (SELECT value FROM "device" WHERE status = 1 OR lease_expires < :now ORDER BY value LIMIT 1)'), self.lease_params(owner, time.time()))
+                device = connection.execute(text('SELECT value FROM "device" WHERE owner = :owner'), {'owner': owner}).scalar()
+        except SQLAlchemyError as e:
+            logger.error("device addition and deletion failed {}".format(e), extra=extra)
+            return {'device': False, 'owner': None}
+        if not device:
+            return {'device': False, 'owner': None}
+        self.hold_lease(Device.__tablename__, device, owner, logger=logger, extra=extra)
+        logger.info("Get Device {} was successful".format(device), extra=extra)
+        return {'device': device, 'owner': owner}
+
+    def adopt_device(self, device, logger, extra):
+        """
+        Lease a specific device slot if it is free or its holder is gone, used to release the slot of a
+        leftover volume only once that volume is detached
+        :param device: str
+        :param logger: obj
+        :param extra: dict
+        :return: str, owner token of the lease, or False
+        """
+        owner = "{}:{}".format(os.getpid(), uuid.uuid4().hex)
+        try:
+            with lease_engine.begin() as connection:
+                self.expire_dead_owners(connection, Device.__tablename__, logger=logger, extra=extra)
+                result = connection.execute(text(
+                    'UPDATE "device" SET status = 0, owner = :owner, owner_pid = :pid, lease_expires = :expires '
+                    'WHERE value = :value AND (status = 1 OR lease_expires < :now)'), dict(self.lease_params(owner, time.time()), value=device))
+        except SQLAlchemyError as e:
+            logger.error("device adopt failed {}".format(e), extra=extra)
             return False
+        if result.rowcount != 1:
+            return False
+        self.hold_lease(Device.__tablename__, device, owner, logger=logger, extra=extra)
+        return owner
 
-    def release_device_mount(self, device, logger, extra):
+    def release_device(self, device, owner, logger, extra):
         """
-        Release Mounted Device
+        Release Device
+        :param device: str
+        :param owner: str, owner token returned when the device was leased
+        :return: bool
+        """
+        if self.release_lease(owner, logger=logger, extra=extra):
+            logger.info("Release Device {} was successful".format(device), extra=extra)
+            return True
+        logger.error("Device {} Release failed".format(device), extra=extra)
+        return False
+
+    def is_layer_known(self, bucket, key, logger, extra):
+        """
+        Check local digest index for a content addressed layer
+        :param bucket: str
+        :param key: str
+        :param logger: obj
+        :param extra: dict
         :return: bool
         """
         with self.lock:
             try:
-                device_mount = session.query(DeviceMount).filter_by(value=device, status=False).one_or_none()
-                if device_mount:
-                    device_mount.status = True
-                    session.add(device_mount)
-                    session.commit()
-                    logger.info("Mounted Device {} released".format(device_mount.value), extra=extra)
-                    return True
-                else:
-                    logger.error("Mounted Device {} release failed ".format(device), extra=extra)
-                    return False
-            except (MultipleResultsFound, SQLAlchemyError) as e:
-                logger.error("Multiple Result Found {}".format(e), extra=extra)
+                return session.query(LayerDigest).filter_by(bucket=bucket, key=key).one_or_none() is not None
+            except SQLAlchemyError as e:
+                logger.error("layer digest lookup failed {}".format(e), extra=extra)
                 return False
 
-    def get_device(self, logger, extra):
+    def save_layer(self, bucket, key, digest, logger, extra):
         """
-        Get Device
-        :return: dict
+        Record content addressed layer in local digest index
+        :param bucket: str
+        :param key: str
+        :param digest: str
+        :param logger: obj
+        :param extra: dict
+        :return: bool
         """
         with self.lock:
-            device = session.query(Device).filter_by(status=True).first()
-            if device:
-                try:
-                    device.status = False
-                    session.add(device)
-                    session.commit()
-                    logger.info("Get Device {} was successful".format(device.value), extra=extra)
-                    return {'device': device.value}
-                except SQLAlchemyError as e:
-                    logger.error("device addition and deletion failed {}".format(e), extra=extra)
-                    return {'device': False}
-            else:
-                return {'device': False}
-
-    def release_device(self, device, logger, extra):
+            try:
+                session.merge(LayerDigest(key=key, bucket=bucket, digest=digest, created=time.time()))
+                session.commit()
+                return True
+            except SQLAlchemyError as e:
+                logger.error("layer digest save failed {}".format(e), extra=extra)
+                session.rollback()
+                return False
+
+    def forget_layer(self, bucket, key, logger, extra):
         """
-        Release Device
+        Remove layer from local digest index once it is found missing in S3
+        :param bucket: str
+        :param key: str
+        :param logger: obj
+        :param extra: dict
         :return: bool
         """
         with self.lock:
             try:
-                device_ = session.query(Device).filter_by(value=device, status=False).one_or_none()
-                if device_:
-                    device_.status = True
-                    session.add(device_)
-                    session.commit()
-                    logger.info("Release Device {} was successful".format(device_.value), extra=extra)
-                    return True
-                else:
-                    logger.error("Device {} Release failed".format(device), extra=extra)
-                    return False
-            except (SQLAlchemyError, MultipleResultsFound) as e:
-                logger.error("device release failed {}".format(e), extra=extra)
+                session.query(LayerDigest).filter_by(bucket=bucket, key=key).delete()
+                session.commit()
+                return True
+            except SQLAlchemyError as e:
+                logger.error("layer digest delete failed {}".format(e), extra=extra)
+                session.rollback()
+                return False
+
+    def get_snapshot_result(self, snapshot_id, tenant_id, bucket, logger, extra):
+        """
+        Key of a previous scan result of the snapshot
+        :param snapshot_id: str
+        :param tenant_id: str
+        :param bucket: str
+        :param logger: obj
+        :param extra: dict
+        :return: str or None
+        """
+        with self.lock:
+            try:
+                result = session.query(SnapshotResult).filter_by(snapshot_id=snapshot_id, tenant_id=str(tenant_id), bucket=bucket).one_or_none()
+                return result.key if result else None
+            except SQLAlchemyError as e:
+                logger.error("snapshot result lookup failed {}".format(e), extra=extra)
+                return None
+
+    def save_snapshot_result(self, snapshot_id, tenant_id, bucket, key, logger, extra):
+        """
+        Record scan result of the snapshot
+        :param snapshot_id: str
+        :param tenant_id: str
+        :param bucket: str
+        :param key: str
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        with self.lock:
+            try:
+                session.merge(SnapshotResult(snapshot_id=snapshot_id, tenant_id=str(tenant_id), bucket=bucket, key=key, created=time.time()))
+                session.commit()
+                return True
+            except SQLAlchemyError as e:
+                logger.error("snapshot result save failed {}".format(e), extra=extra)
+                session.rollback()
+                return False
+
+    def forget_snapshot_result(self, snapshot_id, tenant_id, bucket, logger, extra):
+        """
+        Remove snapshot result once its object is found missing in S3
+        :param snapshot_id: str
+        :param tenant_id: str
+        :param bucket: str
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        with self.lock:
+            try:
+                session.query(SnapshotResult).filter_by(snapshot_id=snapshot_id, tenant_id=str(tenant_id), bucket=bucket).delete()
+                session.commit()
+                return True
+            except SQLAlchemyError as e:
+                logger.error("snapshot result delete failed {}".format(e), extra=extra)
+                session.rollback()
                 return False
+
+    def get_stage(self, key, logger, extra):
+        """
+        Journal entry of a job
+        :param key: dict, tenant_id, scan_id, instance_id and snapshot_id
+        :param logger: obj
+        :param extra: dict
+        :return: dict or None
+        """
+        with self.lock:
+            try:
+                entry = session.query(JobStage).filter_by(**key).one_or_none()
+                return {column.name: getattr(entry, column.name) for column in JobStage.__table__.columns} if entry else None
+            except SQLAlchemyError as e:
+                logger.error("job stage lookup failed {}".format(e), extra=extra)
+                return None
+
+    def save_stage(self, key, stage, artifacts, logger, extra):
+        """
+        Record completed stage of a job, artifacts of earlier stages are kept
+        :param key: dict, tenant_id, scan_id, instance_id and snapshot_id
+        :param stage: str
+        :param artifacts: dict, JobStage columns
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        with self.lock:
+            try:
+                entry = session.query(JobStage).filter_by(**key).one_or_none()
+                if entry is None:
+                    entry = JobStage(**key)
+                    session.add(entry)
+                entry.stage = stage
+                entry.updated = time.time()
+                for name, value in artifacts.items():
+                    setattr(entry, name, value)
+                session.commit()
+                return True
+            except SQLAlchemyError as e:
+                logger.error("job stage save failed {}".format(e), extra=extra)
+                session.rollback()
+                return False
+
+    def prune_stages(self, before, logger, extra):
+        """
+        Remove journal entries not updated since before
+        :param before: float
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        with self.lock:
+            try:
+                session.query(JobStage).filter(JobStage.updated < before).delete()
+                session.commit()
+                return True
+            except SQLAlchemyError as e:
+                logger.error("job stage prune failed {}".format(e), extra=extra)
+                session.rollback()
+                return False
+
+    def save_upload(self, entry, logger, extra):
+        """
+        Record archive written to the upload spool
+        :param entry: dict, uploadSpool columns
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        try:
+            with lease_engine.begin() as connection:
+                connection.execute(text(
+                    'INSERT INTO "uploadSpool" (id, path, bucket, object_name, layer_key, digest, tenant_id, scan_id, instance_id, snapshot_id, attempts, created) '
+                    'VALUES (:id, :path, :bucket, :object_name, :layer_key, :digest, :tenant_id, :scan_id, :instance_id, :snapshot_id, 0, :created)'), dict(entry, created=time.time()))
+            return True
+        except SQLAlchemyError as e:
+            logger.error("upload spool save failed {}".format(e), extra=extra)
+            return False
+
+    def pending_uploads(self, bucket, logger, extra):
+        """
+        Spooled uploads of bucket not being uploaded by a live process, claims of exited processes are cleared
+        :param bucket: str
+        :param logger: obj
+        :param extra: dict
+        :return: list of ids
+        """
+        try:
+            with lease_engine.begin() as connection:
+                self.clear_dead_claims(connection, "uploadSpool")
+                rows = connection.execute(text('SELECT id FROM "uploadSpool" WHERE bucket = :bucket AND owner_pid IS NULL ORDER BY created'), {'bucket': bucket}).fetchall()
+            return [entry_id for entry_id, in rows]
+        except SQLAlchemyError as e:
+            logger.error("upload spool lookup failed {}".format(e), extra=extra)
+            return []
+
+    def clear_dead_claims(self, connection, table):
+        """
+        Clear owner of rows claimed by processes which no longer exist
+        :param connection: obj
+        :param table: str
+        :return:
+        """
+        for pid, in connection.execute(text('SELECT DISTINCT owner_pid FROM "{}" WHERE owner_pid IS NOT NULL'.format(table))).fetchall():
+            if pid != os.getpid() and not self.is_process_alive(pid):
+                connection.execute(text('UPDATE "{}" SET owner_pid = NULL WHERE owner_pid = :pid'.format(table)), {'pid': pid})
+
+    def upload_spooled(self, entry_id, logger, extra):
+        """
+        Is the archive still waiting in the upload spool
+        :param entry_id: str
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        try:
+            with lease_engine.begin() as connection:
+                return connection.execute(text('SELECT COUNT(*) FROM "uploadSpool" WHERE id = :id'), {'id': entry_id}).scalar() > 0
+        except SQLAlchemyError as e:
+            logger.error("upload spool lookup failed {}".format(e), extra=extra)
+            return False
+
+    def claim_upload(self, entry_id, logger, extra):
+        """
+        Take a spooled upload for this process
+        :param entry_id: str
+        :param logger: obj
+        :param extra: dict
+        :return: dict or None when another process has it
+        """
+        try:
+            with lease_engine.begin() as connection:
+                result = connection.execute(text('UPDATE "uploadSpool" SET owner_pid = :pid WHERE id = :id AND owner_pid IS NULL'), {'pid': os.getpid(), 'id': entry_id})
+                if result.rowcount != 1:
+                    return None
+                return dict(connection.execute(text('SELECT * FROM "uploadSpool" WHERE id = :id'), {'id': entry_id}).mappings().one())
+        except SQLAlchemyError as e:
+            logger.error("upload spool claim failed {}".format(e), extra=extra)
+            return None
+
+    def finish_upload(self, entry_id, logger, extra):
+        """
+        Remove delivered upload from the spool
+        :param entry_id: str
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        try:
+            with lease_engine.begin() as connection:
+                connection.execute(text('DELETE FROM "uploadSpool" WHERE id = :id'), {'id': entry_id})
+            return True
+        except SQLAlchemyError as e:
+            logger.error("upload spool delete failed {}".format(e), extra=extra)
+            return False
+
+    def fail_upload(self, entry_id, logger, extra):
+        """
+        Count failed attempt and hand the upload back to the spool
+        :param entry_id: str
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        try:
+            with lease_engine.begin() as connection:
+                connection.execute(text('UPDATE "uploadSpool" SET attempts = attempts + 1, owner_pid = NULL WHERE id = :id'), {'id': entry_id})
+            return True
+        except SQLAlchemyError as e:
+            logger.error("upload spool update failed {}".format(e), extra=extra)
+            return False
+
+    def save_teardown(self, entry, logger, extra):
+        """
+        Record pending teardown
+        :param entry: dict, teardown columns
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        try:
+            with lease_engine.begin() as connection:
+                connection.execute(text(
+                    'INSERT INTO "teardown" (id, volume_id, device, mounted_path, scratch_path, tenant_id, scan_id, instance_id, snapshot_id, attempts, created, owner_pid) '
+                    'VALUES (:id, :volume_id, :device, :mounted_path, :scratch_path, :tenant_id, :scan_id, :instance_id, :snapshot_id, 0, :created, :pid)'), dict(entry, created=time.time(), pid=os.getpid()))
+            return True
+        except SQLAlchemyError as e:
+            logger.error("teardown save failed {}".format(e), extra=extra)
+            return False
+
+    def pending_teardowns(self, logger, extra):
+        """
+        Teardowns not being run by a live process, claims of exited processes are cleared
+        :param logger: obj
+        :param extra: dict
+        :return: list of dict
+        """
+        try:
+            with lease_engine.begin() as connection:
+                self.clear_dead_claims(connection, "teardown")
+                rows = connection.execute(text('SELECT * FROM "teardown" WHERE owner_pid IS NULL ORDER BY created')).mappings().fetchall()
+            return [dict(row) for row in rows]
+        except SQLAlchemyError as e:
+            logger.error("teardown lookup failed {}".format(e), extra=extra)
+            return []
+
+    def teardown_volume_ids(self, logger, extra):
+        """
+        Volumes covered by a recorded teardown, whichever process runs it
+        :param logger: obj
+        :param extra: dict
+        :return: set
+        """
+        try:
+            with lease_engine.begin() as connection:
+                return set(volume_id for volume_id, in connection.execute(text('SELECT volume_id FROM "teardown" WHERE volume_id IS NOT NULL')).fetchall())
+        except SQLAlchemyError as e:
+            logger.error("teardown lookup failed {}".format(e), extra=extra)
+            return set()
+
+    def claim_teardown(self, teardown_id, logger, extra):
+        """
+        Take a teardown for this process, teardowns recorded by this process are already its own
+        :param teardown_id: str
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        try:
+            with lease_engine.begin() as connection:
+                result = connection.execute(text('UPDATE "teardown" SET owner_pid = :pid WHERE id = :id AND (owner_pid IS NULL OR owner_pid = :pid)'), {'pid': os.getpid(), 'id': teardown_id})
+            # an unrecorded teardown is run anyway
+            return result.rowcount == 1 or not self.teardown_exists(teardown_id)
+        except SQLAlchemyError as e:
+            logger.error("teardown claim failed {}".format(e), extra=extra)
+            return True
+
+    @staticmethod
+    def teardown_exists(teardown_id):
+        with lease_engine.begin() as connection:
+            return connection.execute(text('SELECT COUNT(*) FROM "teardown" WHERE id = :id'), {'id': teardown_id}).scalar() > 0
+
+    def finish_teardown(self, teardown_id, logger, extra):
+        """
+        Remove completed teardown
+        :param teardown_id: str
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        try:
+            with lease_engine.begin() as connection:
+                connection.execute(text('DELETE FROM "teardown" WHERE id = :id'), {'id': teardown_id})
+            return True
+        except SQLAlchemyError as e:
+            logger.error("teardown delete failed {}".format(e), extra=extra)
+            return False
+
+    def fail_teardown(self, teardown_id, logger, extra):
+        """
+        Count failed attempt and hand the teardown back for the next run
+        :param teardown_id: str
+        :param logger: obj
+        :param extra: dict
+        :return: int, attempts so far
+        """
+        try:
+            with lease_engine.begin() as connection:
+                connection.execute(text('UPDATE "teardown" SET attempts = attempts + 1, owner_pid = NULL WHERE id = :id'), {'id': teardown_id})
+                return connection.execute(text('SELECT attempts FROM "teardown" WHERE id = :id'), {'id': teardown_id}).scalar() or 0
+        except SQLAlchemyError as e:
+            logger.error("teardown update failed {}".format(e), extra=extra)
+            return 0
+
+    def take_api_token(self, action, rate, burst_seconds, logger, extra):
+        """
+        Take a token from the bucket of action, a missing token is reserved ahead so the caller only
+        has to wait for its turn. The burst size follows the current rate of the bucket
+        :param action: str
+        :param rate: float, initial tokens per second of a new bucket
+        :param burst_seconds: float, burst size in seconds of the rate, at least one token
+        :param logger: obj
+        :param extra: dict
+        :return: float, seconds to wait before calling
+        """
+        now = time.time()
+        try:
+            with lease_engine.begin() as connection:
+                row = connection.execute(text('SELECT tokens, rate, updated FROM "apiBucket" WHERE action = :action'), {'action': action}).fetchone()
+                if row is None:
+                    capacity = max(1.0, rate * burst_seconds)
+                    tokens, updated = capacity, now
+                    connection.execute(text('INSERT INTO "apiBucket" (action, tokens, rate, capacity, updated, last_decrease) VALUES (:action, :tokens, :rate, :capacity, :now, 0)'),
+                                       {'action': action, 'tokens': tokens, 'rate': rate, 'capacity': capacity, 'now': now})
+                else:
+                    tokens, rate, updated = row
+                    # burst of the current rate, shrinks when the rate is halved
+                    capacity = max(1.0, rate * burst_seconds)
+                tokens = min(capacity, tokens + max(now - updated, 0) * rate) - 1
+                connection.execute(text('UPDATE "apiBucket" SET tokens = :tokens, capacity = :capacity, updated = :now WHERE action = :action'),
+                                   {'action': action, 'tokens': tokens, 'capacity': capacity, 'now': now})
+            return -tokens / rate if tokens < 0 else 0.0
+        except SQLAlchemyError as e:
+            logger.error("api bucket update failed {}".format(e), extra=extra)
+            return 0.0
+
+    def decrease_api_rate(self, action, factor, min_rate, interval, logger, extra):
+        """
+        Multiplicative decrease of the rate of action, at most once per interval so that the throttled
+        calls of one burst count as one signal
+        :param action: str
+        :param factor: float
+        :param min_rate: float
+        :param interval: float
+        :param logger: obj
+        :param extra: dict
+        :return: bool, True when decreased
+        """
+        now = time.time()
+        try:
+            with lease_engine.begin() as connection:
+                result = connection.execute(text('UPDATE "apiBucket" SET rate = MAX(:min_rate, rate * :factor), last_decrease = :now WHERE action = :action AND last_decrease <= :since'),
+                                            {'action': action, 'min_rate': min_rate, 'factor': factor, 'now': now, 'since': now - interval})
+            return result.rowcount == 1
+        except SQLAlchemyError as e:
+            logger.error("api bucket update failed {}".format(e), extra=extra)
+            return False
+
+    def increase_api_rate(self, action, step, max_rate, logger, extra):
+        """
+        Additive increase of the rate of action
+        :param action: str
+        :param step: float
+        :param max_rate: float
+        :param logger: obj
+        :param extra: dict
+        :return: bool
+        """
+        try:
+            with lease_engine.begin() as connection:
+                connection.execute(text('UPDATE "apiBucket" SET rate = MIN(:max_rate, rate + :step) WHERE action = :action AND rate < :max_rate'),
+                                   {'action': action, 'step': step, 'max_rate': max_rate})
+            return True
+        except SQLAlchemyError as e:
+            logger.error("api bucket update failed {}".format(e), extra=extra)
+            return False
+
+    def api_rates(self, logger, extra):
+        """
+        Current rate of every API bucket
+        :param logger: obj
+        :param extra: dict
+        :return: dict
+        """
+        try:
+            with lease_engine.begin() as connection:
+                return {action: round(rate, 2) for action, rate in connection.execute(text('SELECT action, rate FROM "apiBucket"')).fetchall()}
+        except SQLAlchemyError as e:
+            logger.error("api bucket lookup failed {}".format(e), extra=extra)
+            return {}
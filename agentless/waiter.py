@@ -0,0 +1,127 @@
+import threading
+
+# DescribeVolumes accepts at most 200 values per filter
+MAX_BATCH_SIZE = 200
+
+
+class _Waiter:
+
+    def __init__(self, states):
+        self.states = states
+        self.state = None
+        self.event = threading.Event()
+
+
+class VolumeWaiter:
+    """
+    Single poller shared by all in flight jobs, instead of every job calling describe_volumes for
+    its own volume every 5 seconds, jobs register the volume and the state they are waiting for
+    and one batched DescribeVolumes call is issued for all registered volumes. The interval is
+    reset to min_interval whenever a volume is registered or reaches its state and doubles up to
+    max_interval while nothing changes.
+    """
+
+    def __init__(self, client_factory, logger, extra, min_interval=1, max_interval=5):
+        """
+        :param client_factory: callable returning ec2 client
+        :param logger: obj
+        :param extra: dict
+        :param min_interval: int
+        :param max_interval: int
+        """
+        self.client_factory = client_factory
+        self.logger = logger
+        self.extra = extra
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.describe_calls = 0
+        self._condition = threading.Condition()
+        self._waiters = {}
+        self._registered = False
+        self._thread = None
+
+    def wait(self, volume_id, states, timeout, extra):
+        """
+        Block until volume reaches one of the states or timeout expires
+        :param volume_id: str
+        :param states: tuple
+        :param timeout: int
+        :param extra: dict
+        :return: str or None
+        """
+        waiter = _Waiter(states)
+        with self._condition:
+            self._waiters.setdefault(volume_id, []).append(waiter)
+            self._registered = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="volume-waiter", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        if not waiter.event.wait(timeout):
+            self._remove(volume_id, waiter)
+            self.logger.error("Volume {} did not reach {} in {} seconds".format(volume_id, states, timeout), extra=extra)
+        return waiter.state
+
+    def _remove(self, volume_id, waiter):
+        with self._condition:
+            waiters = self._waiters.get(volume_id, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self._waiters.pop(volume_id, None)
+
+    def _describe_volumes(self, volume_ids):
+        """
+        Batched describe of volume states, volume-id filter is used instead of VolumeIds so that a
+        volume not yet visible after CreateVolume does not fail the whole batch
+        :param volume_ids: list
+        :return: dict
+        """
+        states = {}
+        client = self.client_factory()
+        for index in range(0, len(volume_ids), MAX_BATCH_SIZE):
+            paginator = client.get_paginator("describe_volumes")
+            pages = paginator.paginate(Filters=[{"Name": "volume-id", "Values": volume_ids[index:index + MAX_BATCH_SIZE]}])
+            for page in pages:
+                self.describe_calls += 1
+                for volume in page["Volumes"]:
+                    states[volume["VolumeId"]] = volume["State"]
+        return states
+
+    def _dispatch(self, states):
+        """
+        Wake every waiter whose volume reached the expected state
+        :param states: dict
+        :return: bool
+        """
+        woken = False
+        for volume_id, state in states.items():
+            for waiter in list(self._waiters.get(volume_id, [])):
+                # error is terminal for a volume, waiter is woken up to fail fast
+                if state in waiter.states or state == "error":
+                    waiter.state = state
+                    waiter.event.set()
+                    self._waiters[volume_id].remove(waiter)
+                    woken = True
+            if not self._waiters.get(volume_id):
+                self._waiters.pop(volume_id, None)
+        return woken
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            with self._condition:
+                while not self._waiters:
+                    self._condition.wait()
+                volume_ids = sorted(self._waiters)
+            try:
+                states = self._describe_volumes(volume_ids)
+            except Exception as e:
+                self.logger.exception("Batched describe volumes failed {}".format(e), extra=self.extra)
+                states = {}
+            with self._condition:
+                changed = self._dispatch(states) or self._registered
+                self._registered = False
+                interval = self.min_interval if changed else min(interval * 2, self.max_interval)
+                # a volume registered meanwhile wakes the poller instead of waiting out the interval
+                self._condition.wait_for(lambda: self._registered, timeout=interval)
@@ -0,0 +1,88 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from agentless.archive import ArchiveBuilder, LAYER_FOLDER, LAYER_TAR, MANIFEST, TOSEND
+
+EXTRA = {'scanId': None, 'tenantId': None}
+FILES = {
+    "var/lib/dpkg/status": b"Package: bash\nStatus: install ok installed\n",
+    "var/lib/rpm/Packages": os.urandom(64 * 1024),
+    "lib/apk/db/installed": b"P:musl\nV:1.2.3\n",
+}
+
+
+class TestArchiveBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.members = []
+        for path, content in FILES.items():
+            source_path = os.path.join(self.root, "snapshot", path)
+            os.makedirs(os.path.dirname(source_path), exist_ok=True)
+            with open(source_path, "wb") as source:
+                source.write(content)
+            self.members.append((source_path, os.path.join(LAYER_FOLDER, path)))
+        self.builder = ArchiveBuilder(logging.getLogger("Agentless"), codec="gzip", level=9)
+
+    def build(self):
+        output = io.BytesIO()
+        with self.builder.layer(self.members, EXTRA) as layer:
+            self.builder.write_archive(layer, output, EXTRA)
+        output.seek(0)
+        return output
+
+    def former_layer(self):
+        """
+        layer.tar as the former implementation built it, files copied into layerfiles/ and added
+        with tarfile "w:gz"
+        """
+        layerfiles = os.path.join(self.root, "former", LAYER_FOLDER)
+        for source_path, arcname in self.members:
+            destination_path = os.path.join(self.root, "former", os.path.dirname(arcname))
+            os.makedirs(destination_path, exist_ok=True)
+            shutil.copy(source_path, destination_path)
+        layer_path = os.path.join(self.root, "former", LAYER_TAR)
+        with tarfile.open(layer_path, "w:gz") as tar:
+            tar.add(layerfiles, arcname=os.path.basename(layerfiles))
+        return layer_path
+
+    @staticmethod
+    def entries(tar):
+        return [(info.name, info.type, info.size, tar.extractfile(info).read() if info.isfile() else None) for info in tar.getmembers()]
+
+    def test_layout(self):
+        with tarfile.open(fileobj=self.build(), mode="r:gz") as tar:
+            names = tar.getnames()
+            layer = tar.extractfile(names[2]).read()
+            manifest = tar.extractfile(names[3]).read()
+            self.assertTrue(tar.getmember(names[0]).isdir() and tar.getmember(names[1]).isdir())
+        digest = hashlib.sha256(layer).hexdigest()
+        self.assertEqual(names, [TOSEND, "{}/{}".format(TOSEND, digest), "{}/{}/{}".format(TOSEND, digest, LAYER_TAR), "{}/{}".format(TOSEND, MANIFEST)])
+        expected = [{"RepoTags": ["vm"], "Layers": ["{}/{}".format(digest, LAYER_TAR)]}]
+        self.assertEqual(manifest, json.dumps(expected, indent=3).encode("utf-8"))
+
+    def test_layer_matches_former_layer(self):
+        with tarfile.open(fileobj=self.build(), mode="r:gz") as tar:
+            layer = tar.extractfile(tar.getnames()[2]).read()
+        with tarfile.open(fileobj=io.BytesIO(layer), mode="r:gz") as tar, tarfile.open(self.former_layer(), mode="r:gz") as former:
+            self.assertEqual(self.entries(tar), self.entries(former))
+
+    def test_layer_digest_is_stable(self):
+        with self.builder.layer(self.members, EXTRA) as first:
+            digest = first.digest
+        with self.builder.layer(self.members, EXTRA) as second:
+            self.assertEqual(second.digest, digest)
+            self.assertEqual(hashlib.sha256(second.fileobj.read()).hexdigest(), digest)
+            self.assertEqual(second.fileobj.tell(), second.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import threading
+import unittest
+
+from agentless.clients import ClientRegistry, MIN_POOL_CONNECTIONS
+
+
+class RateLimiter:
+
+    def __init__(self):
+        self.registered = []
+
+    def register(self, service, client):
+        self.registered.append(service)
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ClientRegistry()
+
+    def test_client_is_reused_per_key(self):
+        client = self.registry.get_client("ec2", "us-east-1")
+        self.assertIs(self.registry.get_client("ec2", "us-east-1"), client)
+        self.assertIsNot(self.registry.get_client("ec2", "eu-west-1"), client)
+        self.assertIsNot(self.registry.get_client("s3", "us-east-1"), client)
+        self.assertEqual(self.registry.stats(), {'created': 3, 'reused': 1})
+
+    def test_concurrent_first_use_creates_one_client(self):
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(self.registry.get_client("s3", "us-east-1"))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, clients))), 1)
+        self.assertEqual(self.registry.stats(), {'created': 1, 'reused': 7})
+
+    def test_configure_sizes_pools_for_concurrency(self):
+        ec2 = self.registry.get_client("ec2", "us-east-1")
+        s3 = self.registry.get_client("s3", "us-east-1")
+        self.assertEqual(s3.meta.config.max_pool_connections, MIN_POOL_CONNECTIONS)
+        # 4 jobs need 40 s3 connections, 8 ec2 connections fit in the default pool
+        self.assertEqual(self.registry.configure(4), 1)
+        self.assertIs(self.registry.get_client("ec2", "us-east-1"), ec2)
+        resized = self.registry.get_client("s3", "us-east-1")
+        self.assertIsNot(resized, s3)
+        self.assertEqual(resized.meta.config.max_pool_connections, 40)
+        self.assertEqual(self.registry.configure(2), 0)
+
+    def test_rate_limiter_registers_new_clients(self):
+        self.registry.get_client("ec2", "us-east-1")
+        rate_limiter = RateLimiter()
+        self.registry.use_rate_limiter(rate_limiter)
+        self.registry.get_client("ec2", "us-east-1")
+        self.registry.get_client("ec2", "eu-west-1")
+        self.assertEqual(rate_limiter.registered, ["ec2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
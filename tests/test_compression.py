@@ -0,0 +1,42 @@
+import gzip
+import io
+import os
+import unittest
+
+from agentless.compression import ParallelGzipWriter, PGZIP_BLOCK_SIZE, open_compressor
+
+
+class TestParallelGzipWriter(unittest.TestCase):
+
+    def compress(self, data, threads=3, chunk=64 * 1024):
+        output = io.BytesIO()
+        writer = ParallelGzipWriter(output, level=6, threads=threads)
+        for offset in range(0, len(data), chunk):
+            writer.write(data[offset:offset + chunk])
+        writer.close()
+        return output.getvalue()
+
+    def test_members_read_back_with_gzip(self):
+        # more blocks than pending writes are allowed, and a short last block
+        data = os.urandom(PGZIP_BLOCK_SIZE) * 4 + b"package database" * 1000
+        self.assertEqual(gzip.decompress(self.compress(data)), data)
+
+    def test_empty_input(self):
+        self.assertEqual(gzip.decompress(self.compress(b"")), b"")
+
+    def test_output_is_deterministic(self):
+        data = b"Package: bash\n" * 200000
+        self.assertEqual(self.compress(data, threads=1), self.compress(data, threads=4))
+
+    def test_close_leaves_fileobj_open(self):
+        output = io.BytesIO()
+        open_compressor(output, codec="pgzip", level=1, threads=2).close()
+        self.assertFalse(output.closed)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            open_compressor(io.BytesIO(), codec="lz4")
+
+
+if __name__ == '__main__':
+    unittest.main()
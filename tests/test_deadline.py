@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+
+from agentless.deadline import Deadline, DeadlineExceeded
+
+
+class TestDeadline(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("agentless.deadline.time.monotonic", return_value=1000.0)
+        self.monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.deadline = Deadline(100, budgets={"attach": 0.1, "upload": 0.5})
+
+    def advance(self, seconds):
+        self.monotonic.return_value += seconds
+
+    def test_stage_budget(self):
+        self.deadline.enter("attach")
+        self.assertEqual(self.deadline.remaining(), 10.0)
+        self.advance(10)
+        self.assertTrue(self.deadline.expired())
+        with self.assertRaisesRegex(DeadlineExceeded, "Stage attach exceeded its budget of 10.0s"):
+            self.deadline.check()
+
+    def test_stage_ends_at_job_deadline(self):
+        self.advance(80)
+        self.deadline.enter("upload")
+        self.assertEqual(self.deadline.remaining(), 20.0)
+        self.advance(20)
+        with self.assertRaisesRegex(DeadlineExceeded, "Job exceeded its deadline of 100.0s in stage upload"):
+            self.deadline.check()
+
+    def test_stage_without_budget(self):
+        self.deadline.enter("capture")
+        self.assertEqual(self.deadline.remaining(), 100.0)
+
+    def test_enter_after_deadline(self):
+        self.deadline.enter("attach")
+        self.advance(100)
+        with self.assertRaises(DeadlineExceeded):
+            self.deadline.enter("upload")
+
+    def test_remaining_never_negative(self):
+        self.advance(500)
+        self.assertEqual(self.deadline.remaining(), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
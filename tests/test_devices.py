@@ -0,0 +1,116 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from agentless.devices import (LEGACY_DEVICE_NAMES, NITRO_ATTACHMENT_LIMIT, XEN_ATTACHMENT_LIMIT, BlockDeviceResolver,
+                               candidate_device_names, slot_device_names)
+
+NITRO = {"InstanceType": "m5.large", "Hypervisor": "nitro", "EbsInfo": {}}
+XEN = {"InstanceType": "m4.large", "Hypervisor": "xen", "EbsInfo": {}}
+
+
+def instance(device_names, network_interfaces=1):
+    return {"BlockDeviceMappings": [{"DeviceName": name} for name in device_names],
+            "NetworkInterfaces": [{"NetworkInterfaceId": "eni-{}".format(index)} for index in range(network_interfaces)]}
+
+
+class TestSlotDeviceNames(unittest.TestCase):
+
+    def test_candidates(self):
+        names = candidate_device_names()
+        self.assertEqual(names[:len(LEGACY_DEVICE_NAMES)], list(LEGACY_DEVICE_NAMES))
+        self.assertEqual(len(names), len(set(names)))
+
+    def test_nitro_shares_limit(self):
+        names = slot_device_names(NITRO, instance(["/dev/xvda", "/dev/sdf"], network_interfaces=2), set())
+        self.assertEqual(len(names), NITRO_ATTACHMENT_LIMIT - 2 - 2)
+        self.assertNotIn("/dev/sdf", names)
+        self.assertEqual(names[0], "/dev/sdg")
+
+    def test_instance_store_takes_attachments(self):
+        instance_type = dict(NITRO, InstanceStorageInfo={"Disks": [{"Count": 2, "SizeInGB": 75}]})
+        self.assertEqual(len(slot_device_names(instance_type, instance(["/dev/xvda"]), set())), NITRO_ATTACHMENT_LIMIT - 2 - 1 - 1)
+
+    def test_dedicated_limit(self):
+        instance_type = dict(NITRO, EbsInfo={"AttachmentLimitType": "dedicated", "MaximumEbsAttachments": 32})
+        self.assertEqual(len(slot_device_names(instance_type, instance(["/dev/xvda"], network_interfaces=4), set())), 32 - 1)
+
+    def test_xen_limit(self):
+        self.assertEqual(len(slot_device_names(XEN, instance(["/dev/xvda"], network_interfaces=3), set())), XEN_ATTACHMENT_LIMIT - 1)
+
+    def test_scan_volumes_keep_their_slot(self):
+        pool = {"/dev/sdf", "/dev/sdg"}
+        names = slot_device_names(NITRO, instance(["/dev/xvda", "/dev/sdf"]), pool)
+        self.assertEqual(names[0], "/dev/sdf")
+        self.assertEqual(len(names), NITRO_ATTACHMENT_LIMIT - 1 - 1)
+
+    def test_xvd_alias_is_foreign(self):
+        names = slot_device_names(XEN, instance(["/dev/sdba"]), set())
+        self.assertNotIn("/dev/xvdba", names)
+
+    def test_no_capacity(self):
+        instance_type = dict(NITRO, EbsInfo={"AttachmentLimitType": "dedicated", "MaximumEbsAttachments": 1})
+        self.assertEqual(slot_device_names(instance_type, instance(["/dev/xvda", "/dev/xvdb"]), set()), [])
+
+
+def mbr(*types):
+    sector = bytearray(512)
+    for index, partition_type in enumerate(types):
+        sector[446 + index * 16 + 4] = partition_type
+    sector[510:512] = b"\x55\xaa"
+    return bytes(sector)
+
+
+class TestBlockDeviceResolver(unittest.TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.sys_block, self.dev = os.path.join(root, "sys", "block"), os.path.join(root, "dev")
+        os.makedirs(self.sys_block)
+        os.makedirs(self.dev)
+        for name, value in (("SYS_BLOCK", self.sys_block), ("DEV", self.dev), ("DEV_BY_ID", os.path.join(self.dev, "disk", "by-id"))):
+            patcher = mock.patch("agentless.devices." + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.resolver = BlockDeviceResolver(logging.getLogger("Agentless"), {'scanId': None, 'tenantId': None})
+        self.addCleanup(self.resolver.stop)
+
+    def add_disk(self, disk, head):
+        os.makedirs(os.path.join(self.sys_block, disk))
+        with open(os.path.join(self.dev, disk), "wb") as device:
+            device.write(head)
+
+    def add_partition(self, disk, partition, size):
+        os.makedirs(os.path.join(self.sys_block, disk, partition))
+        for name, value in (("partition", partition[-1]), ("size", str(size))):
+            with open(os.path.join(self.sys_block, disk, partition, name), "w") as attribute:
+                attribute.write(value)
+        open(os.path.join(self.dev, partition), "w").close()
+
+    def test_unpartitioned_disk(self):
+        self.add_disk("xvdf", b"XFSB" + bytes(508))
+        self.assertEqual(self.resolver.resolve("vol-1", "/dev/sdf"), os.path.join(self.dev, "xvdf"))
+
+    def test_largest_partition(self):
+        self.add_disk("xvdf", mbr(0x83, 0x83))
+        self.add_partition("xvdf", "xvdf1", 2048)
+        self.add_partition("xvdf", "xvdf2", 16777216)
+        self.assertEqual(self.resolver.resolve("vol-1", "/dev/sdf"), os.path.join(self.dev, "xvdf2"))
+
+    def test_waits_for_partition_scan(self):
+        self.add_disk("xvdf", mbr(0xee))
+        # the partitions of the disk are not scanned yet, the bare disk is not mounted
+        self.assertIsNone(self.resolver.resolve("vol-1", "/dev/sdf"))
+        timer = threading.Timer(0.2, self.add_partition, args=("xvdf", "xvdf1", 16777216))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(self.resolver.wait("vol-1", "/dev/sdf", timeout=5, extra=self.resolver.extra), os.path.join(self.dev, "xvdf1"))
+
+
+if __name__ == '__main__':
+    unittest.main()
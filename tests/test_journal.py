@@ -0,0 +1,146 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import boto3
+import sqlalchemy as sa
+from moto import mock_ec2
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from agentless import model
+from agentless.job import ScanJob
+from agentless.journal import StageJournal, CREATED, ATTACHED, MOUNTED, CAPTURED, UPLOADED, JOURNAL_RETENTION
+from agentless.main import AgentLess
+from agentless.reaper import TAG_OWNER_PID
+from agentless.utility import Utility
+
+EXTRA = {'scanId': None, 'tenantId': None}
+
+
+def scan_job(snapshot_id="snap-1"):
+    return ScanJob(tenant_id="tenant", scan_id="scan", instance_id="i-target", snapshot_id=snapshot_id, extra=EXTRA)
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # a database of its own per test, set up like model.engine and model.lease_engine
+        database = "sqlite:////{}".format(os.path.join(self.directory, "agentless.db"))
+        engine, lease_engine = sa.create_engine(database), sa.create_engine(database)
+        event.listen(engine, "connect", model.set_sqlite_pragma)
+        event.listen(lease_engine, "connect", model.set_sqlite_pragma)
+        event.listen(lease_engine, "connect", model.disable_pysqlite_begin)
+        event.listen(lease_engine, "begin", model.begin_immediate)
+        model.Base.metadata.create_all(engine)
+        self.addCleanup(engine.dispose)
+        self.addCleanup(lease_engine.dispose)
+        session = sessionmaker(bind=engine)()
+        self.addCleanup(session.close)
+        for patcher in (mock.patch("agentless.utility.lease_engine", lease_engine), mock.patch("agentless.utility.session", session)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.logger = logging.getLogger("Agentless")
+        self.utility = Utility()
+        self.journal = StageJournal(self.utility, self.logger)
+
+
+class TestStageJournal(JournalTestCase):
+
+    def test_stages_keep_earlier_artifacts(self):
+        job = scan_job()
+        self.assertIsNone(self.journal.lookup(job))
+        self.assertFalse(self.journal.reached(None, CREATED))
+        self.assertTrue(self.journal.record(job, CREATED, volume_id="vol-1"))
+        self.assertTrue(self.journal.record(job, ATTACHED, device="/dev/sdf"))
+        self.assertTrue(self.journal.record(job, MOUNTED, mounted_path="/mnt/tenant/scan/i-target/snap-1"))
+        entry = self.journal.lookup(job)
+        self.assertEqual((entry['stage'], entry['volume_id'], entry['device']), (MOUNTED, "vol-1", "/dev/sdf"))
+        self.assertTrue(self.journal.reached(entry, ATTACHED))
+        self.assertFalse(self.journal.reached(entry, CAPTURED))
+        self.assertIsNone(self.journal.lookup(scan_job("snap-2")))
+
+    def test_prune_old_entries(self):
+        old, recent = scan_job("snap-old"), scan_job("snap-recent")
+        self.journal.record(old, UPLOADED, object_name="old")
+        self.journal.record(recent, UPLOADED, object_name="recent")
+        with mock.patch("agentless.journal.time.time", return_value=time.time() + JOURNAL_RETENTION - 60):
+            self.journal.record(recent, UPLOADED, object_name="recent")
+        with mock.patch("agentless.journal.time.time", return_value=time.time() + JOURNAL_RETENTION + 1):
+            self.assertTrue(self.journal.prune(EXTRA))
+        self.assertIsNone(self.journal.lookup(old))
+        self.assertIsNotNone(self.journal.lookup(recent))
+
+
+@mock_ec2
+class TestResumeVolume(JournalTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+        patcher = mock.patch("agentless.main.log", self.logger, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = boto3.client("ec2", region_name="us-east-1")
+        image_id = self.client.describe_images()["Images"][0]["ImageId"]
+        instance_id = self.client.run_instances(ImageId=image_id, MinCount=1, MaxCount=1, Placement={"AvailabilityZone": "us-east-1a"})["Instances"][0]["InstanceId"]
+        self.utility.all_devices(["/dev/sdf", "/dev/sdg"], logger=self.logger, extra=EXTRA)
+        # resuming only reads the journal, the device pool and the volume, the rest of __init__ is not needed
+        self.agent = AgentLess.__new__(AgentLess)
+        self.agent.ec2_instance_id = instance_id
+        self.agent.logger = self.logger
+        self.agent.utility = self.utility
+        self.agent.journal = self.journal
+        self.agent.get_ec2_client = lambda: self.client
+
+    def volume_of_previous_run(self, job, stage=CREATED, device=None):
+        volume_id = self.client.create_volume(AvailabilityZone="us-east-1a", Size=8,
+                                              TagSpecifications=[{"ResourceType": "volume", "Tags": [{"Key": TAG_OWNER_PID, "Value": "1"}]}])["VolumeId"]
+        if device:
+            self.client.attach_volume(VolumeId=volume_id, InstanceId=self.agent.ec2_instance_id, Device=device)
+        self.journal.record(job, stage, volume_id=volume_id)
+        return volume_id
+
+    def owner_pid(self, volume_id):
+        tags = self.client.describe_volumes(VolumeIds=[volume_id])["Volumes"][0]["Tags"]
+        return next(tag["Value"] for tag in tags if tag["Key"] == TAG_OWNER_PID)
+
+    def test_available_volume_is_reused(self):
+        job = scan_job()
+        volume_id = self.volume_of_previous_run(job)
+        self.assertEqual(self.agent.resume_volume(job), volume_id)
+        self.assertEqual(job.volume_id, volume_id)
+        self.assertIsNone(job.device)
+        # the reaper of a later run does not take it for an orphan of the exited process
+        self.assertEqual(self.owner_pid(volume_id), str(os.getpid()))
+
+    def test_attached_volume_takes_over_its_slot(self):
+        job = scan_job()
+        volume_id = self.volume_of_previous_run(job, stage=MOUNTED, device="/dev/sdg")
+        self.assertEqual(self.agent.resume_volume(job), volume_id)
+        self.assertEqual(job.device, "/dev/sdg")
+        self.assertTrue(job.device_lease)
+        self.assertEqual(self.utility.free_device_count(logger=self.logger, extra=EXTRA), 1)
+
+    def test_volume_is_not_reused(self):
+        gone, captured, queued, fresh = scan_job("snap-gone"), scan_job("snap-captured"), scan_job("snap-queued"), scan_job("snap-fresh")
+        self.client.delete_volume(VolumeId=self.volume_of_previous_run(gone))
+        self.volume_of_previous_run(captured, stage=CAPTURED)
+        volume_id = self.volume_of_previous_run(queued)
+        self.assertTrue(self.utility.save_teardown({'id': "queued", 'volume_id': volume_id, 'device': None, 'mounted_path': None, 'scratch_path': None,
+                                                    'tenant_id': "tenant", 'scan_id': "scan", 'instance_id': "i-target", 'snapshot_id': "snap-queued"},
+                                                   logger=self.logger, extra=EXTRA))
+        for job in (gone, captured, queued, fresh):
+            self.assertIsNone(self.agent.resume_volume(job), job)
+            self.assertIsNone(job.volume_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
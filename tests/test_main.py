@@ -0,0 +1,79 @@
+import logging
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from agentless.job import ScanJob
+from agentless.main import AgentLess, DEFAULT_OPTIONS
+
+
+class TestValidateOptions(unittest.TestCase):
+
+    def setUp(self):
+        # method_start_end logs to the logger created when main runs as a script
+        patcher = mock.patch("agentless.main.log", logging.getLogger("Agentless"), create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def validate(self, **options):
+        # validation only reads the options, the instance metadata and clients of __init__ are not needed
+        agent = AgentLess.__new__(AgentLess)
+        agent.options = dict(DEFAULT_OPTIONS, **options)
+        agent.validate_options()
+
+    def test_defaults(self):
+        self.validate()
+
+    def test_compression_level(self):
+        self.validate(compression="pgzip", compressionLevel=0)
+        self.validate(compression="gzip", compressionLevel="6")
+        for options in ({"compression": "gzip", "compressionLevel": 10}, {"compression": "pgzip", "compressionLevel": -1},
+                        {"compression": "gzip", "compressionLevel": "fast"}, {"compression": "gzip", "compressionLevel": 5.5},
+                        {"compression": "gzip", "compressionLevel": None}, {"compression": "gzip", "compressionLevel": True}):
+            with self.assertRaises(Exception, msg=options):
+                self.validate(**options)
+
+    def test_unknown_codec_and_upload_mode(self):
+        with self.assertRaises(Exception):
+            self.validate(compression="lz4")
+        with self.assertRaises(Exception):
+            self.validate(uploadMode="ftp")
+
+
+class Ec2Client:
+
+    def __init__(self):
+        self.tokens = []
+
+    def create_volume(self, **kwargs):
+        self.tokens.append(kwargs["ClientToken"])
+        if len(self.tokens) == 1:
+            # the first create times out on the client side after the volume was created
+            raise ClientError({"Error": {"Code": "RequestTimeout"}, "ResponseMetadata": {"HTTPStatusCode": 500}}, "CreateVolume")
+        return {"VolumeId": "vol-1"}
+
+
+class TestCreateVolume(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("agentless.main.log", logging.getLogger("Agentless"), create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("agentless.main.ec2_metadata", mock.Mock(availability_zone="us-east-1a"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.agent = AgentLess.__new__(AgentLess)
+        self.agent.ec2_instance_id = "i-0123456789abcdef0"
+
+    def test_retried_create_is_idempotent(self):
+        job = ScanJob("tenant", "scan", "i-0fedcba9876543210", "snap-1", {'scanId': "scan", 'tenantId': "tenant"})
+        client = Ec2Client()
+        self.assertEqual(self.agent._create_volume(job, client, job.snapshot_id, {"VolumeType": "gp3"})["VolumeId"], "vol-1")
+        self.assertEqual(client.tokens, [job.client_token, job.client_token])
+        other = ScanJob("tenant", "scan", "i-0fedcba9876543210", "snap-1", job.extra)
+        self.assertNotEqual(other.client_token, job.client_token)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+import unittest
+
+from agentless.pipeline import Pipeline
+
+EXTRA = {'scanId': None, 'tenantId': None}
+
+
+class Job:
+
+    def __init__(self, snapshot_id):
+        self.snapshot_id = snapshot_id
+        self.extra = EXTRA
+
+    def __repr__(self):
+        return self.snapshot_id
+
+
+class Volumes:
+    """
+    Provision and process stages recording volumes held and jobs processed at the same time
+    """
+
+    def __init__(self, provision_seconds=0.05, process_seconds=0.05):
+        self.provision_seconds = provision_seconds
+        self.process_seconds = process_seconds
+        self.lock = threading.Lock()
+        self.held = self.max_held = 0
+        self.processing = self.max_processing = 0
+        self.events = []
+
+    def record(self, event, job):
+        with self.lock:
+            self.events.append((event, job.snapshot_id))
+
+    def provision(self, job):
+        with self.lock:
+            self.held += 1
+            self.max_held = max(self.max_held, self.held)
+        self.record("provisioning", job)
+        time.sleep(self.provision_seconds)
+        if job.snapshot_id == "snap-cached":
+            self.release()
+            return False
+        if job.snapshot_id == "snap-no-device":
+            self.release()
+            raise Exception("No free device")
+        self.record("provisioned", job)
+        return True
+
+    def process(self, job):
+        with self.lock:
+            self.processing += 1
+            self.max_processing = max(self.max_processing, self.processing)
+        self.record("processing", job)
+        try:
+            time.sleep(self.process_seconds)
+            if job.snapshot_id == "snap-empty":
+                raise Exception("No required files found")
+        finally:
+            with self.lock:
+                self.processing -= 1
+            self.record("processed", job)
+            self.release()
+
+    def release(self):
+        with self.lock:
+            self.held -= 1
+
+
+class TestPipeline(unittest.TestCase):
+
+    def run_pipeline(self, volumes, jobs, concurrency, lookahead):
+        pipeline = Pipeline(volumes.provision, volumes.process, concurrency=concurrency, lookahead=lookahead, logger=logging.getLogger("Agentless"), extra=EXTRA)
+        return pipeline.run(jobs)
+
+    def test_volumes_are_bounded(self):
+        volumes = Volumes()
+        jobs = [Job("snap-{}".format(index)) for index in range(10)]
+        failures = self.run_pipeline(volumes, jobs, concurrency=2, lookahead=1)
+        self.assertEqual(failures, [])
+        self.assertEqual(sorted(job for event, job in volumes.events if event == "processed"), sorted(job.snapshot_id for job in jobs))
+        self.assertLessEqual(volumes.max_held, 3)
+        self.assertLessEqual(volumes.max_processing, 2)
+        self.assertEqual(volumes.held, 0)
+
+    def test_next_volume_is_provisioned_while_processing(self):
+        volumes = Volumes(provision_seconds=0.1, process_seconds=0.1)
+        self.run_pipeline(volumes, [Job("snap-1"), Job("snap-2")], concurrency=1, lookahead=1)
+        events = volumes.events
+        self.assertLess(events.index(("provisioned", "snap-2")), events.index(("processed", "snap-1")))
+        self.assertEqual(volumes.max_held, 2)
+
+    def test_failed_job_does_not_stop_the_others(self):
+        volumes = Volumes()
+        jobs = [Job("snap-1"), Job("snap-no-device"), Job("snap-empty"), Job("snap-cached"), Job("snap-2")]
+        failures = self.run_pipeline(volumes, jobs, concurrency=2, lookahead=2)
+        self.assertEqual(sorted(str(error) for error in failures), ["No free device", "No required files found"])
+        processed = sorted(job for event, job in volumes.events if event == "processed")
+        self.assertEqual(processed, ["snap-1", "snap-2", "snap-empty"])
+        self.assertEqual(volumes.held, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
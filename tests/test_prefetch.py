@@ -0,0 +1,93 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from agentless.deadline import Deadline, DeadlineExceeded
+from agentless.prefetch import Prefetcher
+
+EXTRA = {'scanId': None, 'tenantId': None}
+CHUNK_SIZE = 4096
+
+
+class TestPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.logger = logging.getLogger("Agentless")
+        self.members = []
+        # a partial last chunk, several full chunks and an empty file
+        for name, size in (("passwd", 1000), ("os-release", 10 * CHUNK_SIZE), ("empty", 0)):
+            source_path = os.path.join(self.directory, name)
+            with open(source_path, "wb") as source_file:
+                source_file.write(os.urandom(size))
+            self.members.append((source_path, os.path.join("layerfiles", name)))
+
+    def prefetcher(self, threads=4):
+        prefetcher = Prefetcher(threads, CHUNK_SIZE, self.logger)
+        if prefetcher.executor is not None:
+            self.addCleanup(prefetcher.executor.shutdown)
+        return prefetcher
+
+    @staticmethod
+    def open_descriptors():
+        return len(os.listdir("/proc/self/fd"))
+
+    def test_reads_every_file(self):
+        descriptors = self.open_descriptors()
+        missing = (os.path.join(self.directory, "missing"), "layerfiles/missing")
+        self.assertEqual(self.prefetcher().warm(self.members + [missing], EXTRA), 1000 + 10 * CHUNK_SIZE)
+        self.assertEqual(self.open_descriptors(), descriptors)
+
+    def test_disabled(self):
+        self.assertEqual(self.prefetcher(threads=0).warm(self.members, EXTRA), 0)
+
+    def test_chunks_are_read_in_parallel(self):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def read_chunk(fd, offset, length):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight[1], in_flight[0])
+            # a block fetched from S3 on first read
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+            return length
+
+        with mock.patch.object(Prefetcher, "read_chunk", staticmethod(read_chunk)):
+            self.assertEqual(self.prefetcher(threads=4).warm(self.members, EXTRA), 1000 + 10 * CHUNK_SIZE)
+        self.assertEqual(in_flight[1], 4)
+
+    def test_deadline_stops_waiting(self):
+        descriptors = self.open_descriptors()
+        deadline = Deadline(0.05)
+
+        def read_chunk(fd, offset, length):
+            time.sleep(0.05)
+            return length
+
+        with mock.patch.object(Prefetcher, "read_chunk", staticmethod(read_chunk)):
+            with self.assertRaises(DeadlineExceeded):
+                self.prefetcher(threads=1).warm(self.members, EXTRA, deadline=deadline)
+        # pending reads are cancelled and the descriptors closed
+        self.assertEqual(self.open_descriptors(), descriptors)
+
+    @unittest.skipUnless(hasattr(os, "posix_fadvise"), "posix_fadvise is not available")
+    def test_pages_are_advised(self):
+        prefetcher = self.prefetcher()
+        with mock.patch("agentless.prefetch.os.posix_fadvise") as fadvise:
+            prefetcher.warm(self.members, EXTRA)
+            prefetcher.drop(self.members, EXTRA)
+        advices = [call.args[3] for call in fadvise.call_args_list]
+        self.assertEqual(advices, [os.POSIX_FADV_WILLNEED] * 3 + [os.POSIX_FADV_DONTNEED] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
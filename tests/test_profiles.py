@@ -0,0 +1,84 @@
+import logging
+import os
+import unittest
+
+import boto3
+from botocore.stub import Stubber
+
+from agentless.profiles import VolumeProfiles, volume_arguments, AUTO, VOLUME_PROFILES
+
+EXTRA = {'scanId': None, 'tenantId': None}
+ZONE = "us-east-1a"
+
+
+class TestVolumeArguments(unittest.TestCase):
+
+    def test_small_snapshot(self):
+        # an 8 GiB root volume allows 4000 IOPS
+        self.assertEqual(volume_arguments(VOLUME_PROFILES["gp3-restore"], 8), {"VolumeType": "gp3", "Iops": 4000, "Throughput": 500})
+        self.assertEqual(volume_arguments(VOLUME_PROFILES["gp3-restore"], 1), {"VolumeType": "gp3", "Iops": 3000, "Throughput": 500})
+
+    def test_large_snapshot(self):
+        self.assertEqual(volume_arguments(VOLUME_PROFILES["gp3-restore"], 100), {"VolumeType": "gp3", "Iops": 6000, "Throughput": 500})
+
+    def test_throughput_follows_iops(self):
+        profile = {"VolumeType": "gp3", "Iops": 10000, "Throughput": 1000}
+        self.assertEqual(volume_arguments(profile, 8), {"VolumeType": "gp3", "Iops": 4000, "Throughput": 1000})
+        self.assertEqual(volume_arguments(profile, 6), {"VolumeType": "gp3", "Iops": 3000, "Throughput": 750})
+
+    def test_unknown_size(self):
+        self.assertEqual(volume_arguments(VOLUME_PROFILES["gp3-restore"]), {"VolumeType": "gp3", "Iops": 3000, "Throughput": 500})
+        self.assertEqual(volume_arguments(VOLUME_PROFILES["io2"]), {"VolumeType": "io2", "Iops": 100})
+
+    def test_provisioned_iops(self):
+        self.assertEqual(volume_arguments(VOLUME_PROFILES["io2"], 4), {"VolumeType": "io2", "Iops": 2000})
+        self.assertEqual(volume_arguments(VOLUME_PROFILES["io1"], 8), {"VolumeType": "io1", "Iops": 100, "MultiAttachEnabled": True})
+        self.assertEqual(volume_arguments(dict(VOLUME_PROFILES["io1"], VolumeType="gp3"), 8), {"VolumeType": "gp3", "Iops": 3000})
+
+
+class TestVolumeProfiles(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+        self.client = boto3.client("ec2", region_name="us-east-1")
+        self.stubber = Stubber(self.client)
+        self.addCleanup(self.stubber.deactivate)
+
+    def profiles(self, profile=AUTO):
+        return VolumeProfiles(profile, {}, logging.getLogger("Agentless"), EXTRA)
+
+    def test_auto_profile_of_small_lazy_snapshot(self):
+        self.stubber.add_response("describe_snapshots", {"Snapshots": [{"SnapshotId": "snap-1", "VolumeSize": 8}, {"SnapshotId": "snap-2", "VolumeSize": 200}]},
+                                  {"SnapshotIds": ["snap-1", "snap-2"]})
+        self.stubber.add_response("describe_fast_snapshot_restores", {"FastSnapshotRestores": [{"SnapshotId": "snap-2"}]})
+        self.stubber.activate()
+        profiles = self.profiles()
+        self.assertEqual(profiles.load(self.client, ["snap-2", "snap-1"], ZONE), {"snap-2"})
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(profiles.select("snap-1"), ("gp3-restore", {"VolumeType": "gp3", "Iops": 4000, "Throughput": 500}))
+        self.assertEqual(profiles.select("snap-2"), ("gp3", {"VolumeType": "gp3", "Iops": 3000, "Throughput": 125}))
+
+    def test_missing_permission(self):
+        self.stubber.add_client_error("describe_snapshots", "UnauthorizedOperation")
+        self.stubber.add_client_error("describe_fast_snapshot_restores", "UnauthorizedOperation")
+        self.stubber.activate()
+        profiles = self.profiles()
+        self.assertEqual(profiles.load(self.client, ["snap-1"], ZONE), set())
+        self.assertEqual(profiles.select("snap-1"), ("gp3-restore", {"VolumeType": "gp3", "Iops": 3000, "Throughput": 500}))
+
+    def test_fixed_profile_skips_fast_restore_lookup(self):
+        self.stubber.add_response("describe_snapshots", {"Snapshots": [{"SnapshotId": "snap-1", "VolumeSize": 4}]}, {"SnapshotIds": ["snap-1"]})
+        self.stubber.activate()
+        profiles = self.profiles("io2")
+        profiles.load(self.client, ["snap-1"], ZONE)
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(profiles.select("snap-1"), ("io2", {"VolumeType": "io2", "Iops": 2000}))
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            self.profiles("gp2")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import sqlalchemy as sa
+from sqlalchemy import event
+
+from agentless import model
+from agentless.ratelimit import ApiRateLimiter, ADDITIVE_STEP, DEFAULT_RATES, MIN_RATE
+from agentless.utility import Utility
+
+EXTRA = {'scanId': None, 'tenantId': None}
+ACTION = "ec2.CreateVolume"
+
+
+class TestApiBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # a database of its own per test, set up like model.lease_engine
+        engine = sa.create_engine("sqlite:////{}".format(os.path.join(self.directory, "agentless.db")))
+        event.listen(engine, "connect", model.set_sqlite_pragma)
+        event.listen(engine, "connect", model.disable_pysqlite_begin)
+        event.listen(engine, "begin", model.begin_immediate)
+        model.Base.metadata.create_all(engine)
+        self.addCleanup(engine.dispose)
+        patcher = mock.patch("agentless.utility.lease_engine", engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.logger = logging.getLogger("Agentless")
+        self.utility = Utility()
+
+    def take(self, utility=None, rate=1.0):
+        return (utility or self.utility).take_api_token(ACTION, rate, burst_seconds=2, logger=self.logger, extra=EXTRA)
+
+    def rate(self):
+        return self.utility.api_rates(logger=self.logger, extra=EXTRA)[ACTION]
+
+    def test_burst_then_wait_for_turn(self):
+        self.assertEqual([self.take(), self.take()], [0.0, 0.0])
+        # missing tokens are reserved ahead, every caller waits for its own turn
+        self.assertAlmostEqual(self.take(), 1.0, delta=0.1)
+        self.assertAlmostEqual(self.take(), 2.0, delta=0.1)
+
+    def test_bucket_is_shared_by_processes(self):
+        other = Utility()
+        self.assertEqual([self.take(), self.take(other)], [0.0, 0.0])
+        self.assertAlmostEqual(self.take(other), 1.0, delta=0.1)
+
+    def test_multiplicative_decrease_once_per_interval(self):
+        self.take(rate=4.0)
+        self.assertTrue(self.utility.decrease_api_rate(ACTION, 0.5, MIN_RATE, interval=60, logger=self.logger, extra=EXTRA))
+        # further throttles of the same burst are one signal
+        self.assertFalse(self.utility.decrease_api_rate(ACTION, 0.5, MIN_RATE, interval=60, logger=self.logger, extra=EXTRA))
+        self.assertEqual(self.rate(), 2.0)
+        for _ in range(10):
+            self.utility.decrease_api_rate(ACTION, 0.5, MIN_RATE, interval=0, logger=self.logger, extra=EXTRA)
+        self.assertEqual(self.rate(), MIN_RATE)
+        # the burst follows the rate, a throttled action gets a single token
+        self.assertEqual(self.take(rate=4.0), 0.0)
+        self.assertGreater(self.take(rate=4.0), 4.0)
+
+    def test_additive_increase_is_capped(self):
+        self.take(rate=1.0)
+        self.utility.increase_api_rate(ACTION, 0.25, 1.5, logger=self.logger, extra=EXTRA)
+        self.assertEqual(self.rate(), 1.25)
+        for _ in range(5):
+            self.utility.increase_api_rate(ACTION, 0.25, 1.5, logger=self.logger, extra=EXTRA)
+        self.assertEqual(self.rate(), 1.5)
+
+    def test_limiter_adjusts_rate_from_responses(self):
+        limiter = ApiRateLimiter(self.utility, self.logger, EXTRA)
+        initial, _ = DEFAULT_RATES["mutate"]
+        with mock.patch("agentless.ratelimit.time.sleep") as sleep:
+            for _ in range(3):
+                limiter.before_send("before-send.ec2.CreateVolume")
+        # the burst of the initial rate is 2 tokens, the third call waits
+        self.assertEqual(sleep.call_count, 1)
+        limiter.after_attempt("needs-retry.ec2.CreateVolume", response=(None, {"ResponseMetadata": {}}))
+        self.assertEqual(self.rate(), initial + ADDITIVE_STEP)
+        limiter.after_attempt("needs-retry.ec2.CreateVolume", response=(None, {"Error": {"Code": "RequestLimitExceeded"}}))
+        limiter.after_attempt("needs-retry.ec2.CreateVolume", response=(None, {"Error": {"Code": "RequestLimitExceeded"}}))
+        self.assertEqual(self.rate(), round((initial + ADDITIVE_STEP) / 2, 2))
+        stats = limiter.stats()
+        self.assertEqual((stats['calls'], stats['throttled']), (3, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
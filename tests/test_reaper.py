@@ -0,0 +1,143 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import boto3
+import sqlalchemy as sa
+from moto import mock_ec2
+from sqlalchemy import event
+
+from agentless import model
+from agentless.job import ScanJob
+from agentless.reaper import OrphanReaper, TAG_OWNER_INSTANCE, TAG_OWNER_PID, scan_mounts, volume_tags
+from agentless.utility import Utility
+
+EXTRA = {'scanId': None, 'tenantId': None}
+# pid of no running process
+DEAD_PID = 2 ** 22 + 1
+
+
+class Teardowns:
+    """
+    TeardownQueue recording the jobs it is given
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, job):
+        self.jobs.append(job)
+
+    def drain(self):
+        return []
+
+
+class TestScanMounts(unittest.TestCase):
+
+    def test_only_snapshot_mount_points(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".mounts") as mounts_file:
+            mounts_file.write("/dev/nvme0n1p1 / xfs rw 0 0\n"
+                              "/dev/xvdf1 /mnt/tenant/scan/i-1/snap-1 xfs ro 0 0\n"
+                              "/dev/xvdg /mnt/tenant/scan/i-1/snap\\0402 ext4 ro 0 0\n"
+                              "/dev/xvdh /mnt/tenant/scan ext4 ro 0 0\n")
+            mounts_file.flush()
+            self.assertEqual(scan_mounts("/mnt", mounts_file.name), {"/mnt/tenant/scan/i-1/snap-1": "/dev/xvdf1", "/mnt/tenant/scan/i-1/snap 2": "/dev/xvdg"})
+
+
+@mock_ec2
+class TestOrphanReaper(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # a database of its own per test, set up like model.lease_engine
+        engine = sa.create_engine("sqlite:////{}".format(os.path.join(self.directory, "agentless.db")))
+        event.listen(engine, "connect", model.set_sqlite_pragma)
+        event.listen(engine, "connect", model.disable_pysqlite_begin)
+        event.listen(engine, "begin", model.begin_immediate)
+        model.Base.metadata.create_all(engine)
+        self.addCleanup(engine.dispose)
+        patcher = mock.patch("agentless.utility.lease_engine", engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.logger = logging.getLogger("Agentless")
+        self.utility = Utility()
+        self.utility.all_devices(["/dev/sdf", "/dev/sdg"], logger=self.logger, extra=EXTRA)
+        self.client = boto3.client("ec2", region_name="us-east-1")
+        image_id = self.client.describe_images()["Images"][0]["ImageId"]
+        self.instance_id = self.client.run_instances(ImageId=image_id, MinCount=1, MaxCount=1, Placement={"AvailabilityZone": "us-east-1a"})["Instances"][0]["InstanceId"]
+        self.teardowns = Teardowns()
+        self.mounts = {}
+        patcher = mock.patch("agentless.reaper.scan_mounts", side_effect=lambda root: dict(self.mounts))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_volume(self, snapshot_id, owner_instance_id=None, owner_pid=DEAD_PID, device=None):
+        job = ScanJob(tenant_id="tenant", scan_id="scan", instance_id="i-target", snapshot_id=snapshot_id, extra=EXTRA)
+        tag_specifications = volume_tags(owner_instance_id or self.instance_id, job)
+        for tag in tag_specifications[0]["Tags"]:
+            if tag["Key"] == TAG_OWNER_PID:
+                tag["Value"] = str(owner_pid)
+        volume_id = self.client.create_volume(AvailabilityZone="us-east-1a", Size=8, TagSpecifications=tag_specifications)["VolumeId"]
+        if device:
+            self.client.attach_volume(VolumeId=volume_id, InstanceId=self.instance_id, Device=device)
+        return volume_id
+
+    def reap(self, keep=()):
+        reaper = OrphanReaper(lambda: self.client, self.utility, self.teardowns, job_factory=self.job_factory, mount_root="/mnt", logger=self.logger, extra=EXTRA)
+        return reaper.reap(self.instance_id, keep=keep)
+
+    @staticmethod
+    def job_factory(entry):
+        job = ScanJob(tenant_id=entry['tenant_id'], scan_id=entry['scan_id'], instance_id=entry['instance_id'], snapshot_id=entry['snapshot_id'], extra=EXTRA)
+        job.volume_id, job.device, job.mounted_path = entry['volume_id'], entry['device'], entry['mounted_path']
+        return job
+
+    def test_orphaned_volumes_are_torn_down(self):
+        orphan = self.create_volume("snap-1", device="/dev/sdf")
+        unattached = self.create_volume("snap-2")
+        self.create_volume("snap-own", owner_pid=os.getpid())
+        self.create_volume("snap-live", owner_pid=os.getppid())
+        self.create_volume("snap-other", owner_instance_id="i-0other")
+        report, failures = self.reap()
+        self.assertEqual(failures, [])
+        self.assertEqual(sorted(report['volumes']), sorted([orphan, unattached]))
+        self.assertEqual(report['devices'], ["/dev/sdf"])
+        jobs = {job.volume_id: job for job in self.teardowns.jobs}
+        self.assertEqual(jobs[orphan].mounted_path, "/mnt/tenant/scan/i-target/snap-1")
+        # the slot of the orphaned volume is leased for its teardown
+        self.assertTrue(jobs[orphan].device_lease)
+        self.assertEqual(self.utility.free_device_count(logger=self.logger, extra=EXTRA), 1)
+        self.assertIsNone(jobs[unattached].device)
+
+    def test_resumed_and_queued_volumes_are_kept(self):
+        resumed = self.create_volume("snap-1")
+        queued = self.create_volume("snap-2")
+        self.assertTrue(self.utility.save_teardown({'id': "queued", 'volume_id': queued, 'device': None, 'mounted_path': None, 'scratch_path': None,
+                                                    'tenant_id': "tenant", 'scan_id': "scan", 'instance_id': "i-target", 'snapshot_id': "snap-2"},
+                                                   logger=self.logger, extra=EXTRA))
+        report, _ = self.reap(keep={resumed})
+        self.assertEqual(report['volumes'], [])
+        self.assertEqual(self.teardowns.jobs, [])
+
+    def test_mount_of_detached_volume_is_unmounted(self):
+        self.mounts = {"/mnt/tenant/scan/i-target/snap-1": "/dev/xvdz-gone", "/mnt/tenant/scan/i-target/snap-2": "/dev/null"}
+        report, _ = self.reap()
+        self.assertEqual(report['mounts'], ["/mnt/tenant/scan/i-target/snap-1"])
+        self.assertEqual([(job.volume_id, job.mounted_path) for job in self.teardowns.jobs], [(None, "/mnt/tenant/scan/i-target/snap-1")])
+
+    def test_owner_tag_filter(self):
+        self.create_volume("snap-other", owner_instance_id="i-0other")
+        reaper = OrphanReaper(lambda: self.client, self.utility, self.teardowns, self.job_factory, "/mnt", self.logger, EXTRA)
+        volumes = reaper.tagged_volumes("i-0other")
+        self.assertEqual(len(volumes), 1)
+        self.assertIn({"Key": TAG_OWNER_INSTANCE, "Value": "i-0other"}, volumes[0]["Tags"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError, EndpointConnectionError, ParamValidationError
+
+from agentless.retries import (RetryPolicy, TransientError, classify, EVENTUAL_CONSISTENCY, TERMINAL, THROTTLING,
+                               TRANSIENT)
+
+
+def client_error(code, status=400):
+    return ClientError({"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "Operation")
+
+
+def upload_failed(error):
+    # upload_file raises S3UploadFailedError while handling the ClientError of the failed request
+    try:
+        raise error
+    except ClientError:
+        try:
+            raise S3UploadFailedError("Failed to upload tosend.tar.gz")
+        except S3UploadFailedError as e:
+            return e
+
+
+class TestClassify(unittest.TestCase):
+
+    def test_client_errors(self):
+        self.assertEqual(classify(client_error("RequestLimitExceeded")), THROTTLING)
+        self.assertEqual(classify(client_error("SlowDown", 503)), THROTTLING)
+        self.assertEqual(classify(client_error("InvalidVolume.NotFound")), EVENTUAL_CONSISTENCY)
+        self.assertEqual(classify(client_error("InternalError", 500)), TRANSIENT)
+        self.assertEqual(classify(client_error("SomethingNew", 502)), TRANSIENT)
+        self.assertEqual(classify(client_error("AccessDenied", 403)), TERMINAL)
+
+    def test_local_errors(self):
+        self.assertEqual(classify(EndpointConnectionError(endpoint_url="https://ec2.us-east-1.amazonaws.com")), TRANSIENT)
+        self.assertEqual(classify(ParamValidationError(report="Missing required parameter")), TERMINAL)
+        self.assertEqual(classify(TransientError("device not ready")), TRANSIENT)
+        self.assertEqual(classify(OSError("mount failed")), TRANSIENT)
+        self.assertEqual(classify(ValueError("bad option")), TERMINAL)
+
+    def test_upload_failed_is_classified_by_wrapped_error(self):
+        self.assertEqual(classify(upload_failed(client_error("SlowDown", 503))), THROTTLING)
+        self.assertEqual(classify(upload_failed(client_error("AccessDenied", 403))), TERMINAL)
+        self.assertEqual(classify(S3UploadFailedError("Failed to upload")), TERMINAL)
+
+    def test_error_raised_while_handling_is_not_unwrapped(self):
+        try:
+            raise client_error("AccessDenied", 403)
+        except ClientError:
+            try:
+                raise TransientError("device not ready")
+            except TransientError as e:
+                error = e
+        self.assertEqual(classify(error), TRANSIENT)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy({THROTTLING: (3, 0.0, 0.0), TRANSIENT: (2, 0.0, 0.0), EVENTUAL_CONSISTENCY: (2, 0.0, 0.0), TERMINAL: (1, 0.0, 0.0)})
+
+    def call(self, errors):
+        attempts = []
+
+        @self.policy
+        def operation():
+            attempts.append(1)
+            if len(attempts) <= len(errors):
+                raise errors[len(attempts) - 1]
+            return len(attempts)
+
+        return operation, attempts
+
+    def test_retried_until_success(self):
+        operation, _ = self.call([client_error("Throttling"), client_error("Throttling")])
+        self.assertEqual(operation(), 3)
+        self.assertEqual(self.policy.stats()[THROTTLING], {'retries': 2, 'failures': 0})
+
+    def test_attempts_exhausted(self):
+        error = client_error("InternalError", 500)
+        operation, attempts = self.call([error, error, error])
+        with self.assertRaises(ClientError):
+            operation()
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.policy.stats()[TRANSIENT], {'retries': 1, 'failures': 1})
+
+    def test_terminal_not_retried(self):
+        operation, attempts = self.call([client_error("AccessDenied", 403)])
+        with self.assertRaises(ClientError):
+            operation()
+        self.assertEqual(len(attempts), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from agentless.scratch import ScratchManager, MB
+
+EXTRA = {'scanId': None, 'tenantId': None}
+
+
+class Job:
+
+    def __init__(self, snapshot_id):
+        self.snapshot_id = snapshot_id
+        self.extra = EXTRA
+
+
+class TestScratchManager(unittest.TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.scratch = ScratchManager(root, 512, logging.getLogger("Agentless"), EXTRA)
+
+    def test_upfront_reservation_is_capped(self):
+        self.assertTrue(self.scratch.reserve(Job("snap-1"), 512 * MB, timeout=0))
+        self.assertEqual(self.scratch.used(), 128 * MB)
+
+    def test_growing_jobs_do_not_deadlock(self):
+        jobs = [Job("snap-1"), Job("snap-2")]
+        for job in jobs:
+            self.assertTrue(self.scratch.reserve(job, 256 * MB, timeout=0))
+        grown = []
+
+        def process(job):
+            # both need more than half of the budget, they run one after the other
+            grown.append(self.scratch.grow(job, 301 * MB, timeout=5))
+            time.sleep(0.1)
+            self.scratch.release(job)
+
+        threads = [threading.Thread(target=process, args=(job,)) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(grown, [True, True])
+        self.assertEqual(self.scratch.used(), 0)
+
+    def test_growing_job_goes_before_new_reservation(self):
+        running, waiting = Job("snap-1"), Job("snap-2")
+        self.assertTrue(self.scratch.reserve(running, 128 * MB, timeout=0))
+        self.assertTrue(self.scratch.grow(running, 400 * MB, timeout=0))
+        self.assertTrue(self.scratch.reserve(waiting, 64 * MB, timeout=0))
+        grower = threading.Thread(target=self.scratch.grow, args=(waiting, 200 * MB, 5))
+        grower.start()
+        time.sleep(0.1)
+        # budget is left for a new reservation, but a job is waiting to grow
+        self.assertFalse(self.scratch.reserve(Job("snap-3"), 16 * MB, timeout=0.1))
+        self.scratch.release(running)
+        grower.join()
+        self.assertEqual(self.scratch.used(), 200 * MB)
+
+    def test_growing_jobs_never_oversubscribe_budget(self):
+        jobs = [Job("snap-{}".format(index)) for index in range(4)]
+        for job in jobs:
+            self.assertTrue(self.scratch.reserve(job, 128 * MB, timeout=0))
+        self.assertTrue(self.scratch.grow(jobs[0], 300 * MB, timeout=0))
+        # the newest up-front reservations are revoked so that the total stays within budget
+        self.assertLessEqual(self.scratch.used(), 512 * MB)
+        self.assertEqual(set(self.scratch.reserved), {"snap-0", "snap-1"})
+        self.assertFalse(self.scratch.grow(jobs[1], 300 * MB, timeout=0.1))
+        self.assertTrue(self.scratch.grow(jobs[2], 200 * MB, timeout=0))
+        self.assertEqual(self.scratch.used(), 500 * MB)
+
+    def test_grow_above_budget_is_clamped(self):
+        job = Job("snap-1")
+        self.assertTrue(self.scratch.grow(job, 2048 * MB, timeout=0))
+        self.assertEqual(self.scratch.used(), 512 * MB)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import sqlalchemy as sa
+from sqlalchemy import event, text
+
+from agentless import model
+from agentless.scratch import MB
+from agentless.spool import UploadSpool, MAX_UPLOAD_ATTEMPTS
+from agentless.utility import Utility
+
+EXTRA = {'scanId': None, 'tenantId': None}
+BUCKET = "bucket"
+# pid of no running process
+DEAD_PID = 2 ** 22 + 1
+
+
+class TestUploadSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # a database of its own per test, set up like model.lease_engine
+        engine = sa.create_engine("sqlite:////{}".format(os.path.join(self.directory, "agentless.db")))
+        event.listen(engine, "connect", model.set_sqlite_pragma)
+        event.listen(engine, "connect", model.disable_pysqlite_begin)
+        event.listen(engine, "begin", model.begin_immediate)
+        model.Base.metadata.create_all(engine)
+        self.addCleanup(engine.dispose)
+        self.engine = engine
+        patcher = mock.patch("agentless.utility.lease_engine", engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.logger = logging.getLogger("Agentless")
+        self.utility = Utility()
+        self.spool_path = os.path.join(self.directory, "spool")
+        self.delivered = []
+        self.failing = set()
+
+    def deliver(self, entry):
+        if entry['object_name'] in self.failing:
+            raise Exception("Upload To S3 Failed")
+        with open(entry['path'], "rb") as spooled:
+            self.delivered.append((entry['object_name'], spooled.read()))
+
+    def spool(self, capacity=1):
+        spool = UploadSpool(self.spool_path, capacity, deliver=self.deliver, utility=self.utility, workers=2, logger=self.logger, extra=EXTRA)
+        self.addCleanup(spool.executor.shutdown)
+        return spool
+
+    def spool_archive(self, spool, name, data, timeout=0):
+        spooled = spool.write(name, lambda spool_file: spool_file.write(data), size=len(data), timeout=timeout, extra=EXTRA)
+        if spooled is None:
+            return None
+        entry_id, path = spooled
+        self.assertTrue(self.utility.save_upload({'id': entry_id, 'path': path, 'bucket': BUCKET, 'object_name': name, 'layer_key': "layers/" + name,
+                                                  'digest': "0" * 64, 'tenant_id': "tenant", 'scan_id': "scan", 'instance_id': "i-1", 'snapshot_id': "snap-" + name},
+                                                 logger=self.logger, extra=EXTRA))
+        return entry_id
+
+    def rows(self):
+        with self.engine.begin() as connection:
+            return connection.execute(text('SELECT object_name, attempts, owner_pid FROM "uploadSpool" ORDER BY created')).fetchall()
+
+    def test_upload_removes_archive(self):
+        spool = self.spool()
+        spool.submit(self.spool_archive(spool, "a.tar.gz", b"a" * 100))
+        self.assertEqual(spool.drain(), [])
+        self.assertEqual(self.delivered, [("a.tar.gz", b"a" * 100)])
+        self.assertEqual(os.listdir(self.spool_path), [])
+        self.assertEqual(self.rows(), [])
+
+    def test_full_spool_waits_for_uploads(self):
+        spool = self.spool(capacity=1)
+        first = self.spool_archive(spool, "a.tar.gz", b"a" * (MB // 2 + 1))
+        # both archives do not fit, the second waits until the first is uploaded
+        self.assertIsNone(self.spool_archive(spool, "b.tar.gz", b"b" * (MB // 2), timeout=0.1))
+        written = []
+        writer = threading.Thread(target=lambda: written.append(self.spool_archive(spool, "b.tar.gz", b"b" * (MB // 2), timeout=5)))
+        writer.start()
+        time.sleep(0.1)
+        self.assertEqual(written, [])
+        spool.submit(first)
+        writer.join()
+        self.assertIsNotNone(written[0])
+        self.assertLessEqual(spool.used(), MB)
+
+    def test_resume_uploads_of_previous_run(self):
+        previous = self.spool()
+        self.spool_archive(previous, "a.tar.gz", b"a" * 100)
+        claimed = self.spool_archive(previous, "b.tar.gz", b"b" * 100)
+        # the previous run exited while uploading b
+        with self.engine.begin() as connection:
+            connection.execute(text('UPDATE "uploadSpool" SET owner_pid = :pid WHERE id = :id'), {'pid': DEAD_PID, 'id': claimed})
+        spool = self.spool()
+        self.assertEqual(spool.resume(BUCKET), 2)
+        self.assertEqual(spool.drain(), [])
+        self.assertEqual(sorted(self.delivered), [("a.tar.gz", b"a" * 100), ("b.tar.gz", b"b" * 100)])
+        self.assertEqual(self.rows(), [])
+
+    def test_failed_upload_stays_spooled_until_attempts_run_out(self):
+        self.failing.add("a.tar.gz")
+        spool = self.spool()
+        spool.submit(self.spool_archive(spool, "a.tar.gz", b"a" * 100))
+        self.assertEqual(len(spool.drain()), 1)
+        self.assertEqual(self.rows(), [("a.tar.gz", 1, None)])
+        self.assertEqual(len(os.listdir(self.spool_path)), 1)
+        for _ in range(MAX_UPLOAD_ATTEMPTS - 1):
+            self.assertEqual(spool.resume(BUCKET), 1)
+            self.assertEqual(len(spool.drain()), 1)
+        self.assertEqual(self.rows(), [])
+        self.assertEqual(os.listdir(self.spool_path), [])
+        self.assertEqual(spool.resume(BUCKET), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
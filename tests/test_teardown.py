@@ -0,0 +1,119 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import sqlalchemy as sa
+from sqlalchemy import event, text
+
+from agentless import model
+from agentless.job import ScanJob
+from agentless.teardown import TeardownQueue, MAX_TEARDOWN_ATTEMPTS
+from agentless.utility import Utility
+
+EXTRA = {'scanId': None, 'tenantId': None}
+# pid of no running process
+DEAD_PID = 2 ** 22 + 1
+
+
+def scan_job(volume_id, device=None):
+    job = ScanJob(tenant_id="tenant", scan_id="scan", instance_id="i-1", snapshot_id="snap-" + volume_id, extra=EXTRA)
+    job.volume_id, job.device = volume_id, device
+    return job
+
+
+def resumed_job(entry):
+    job = scan_job(entry['volume_id'], entry['device'])
+    job.mounted_path, job.scratch_path = entry['mounted_path'], entry['scratch_path']
+    return job
+
+
+class TestTeardownQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # a database of its own per test, set up like model.lease_engine
+        engine = sa.create_engine("sqlite:////{}".format(os.path.join(self.directory, "agentless.db")))
+        event.listen(engine, "connect", model.set_sqlite_pragma)
+        event.listen(engine, "connect", model.disable_pysqlite_begin)
+        event.listen(engine, "begin", model.begin_immediate)
+        model.Base.metadata.create_all(engine)
+        self.addCleanup(engine.dispose)
+        self.engine = engine
+        patcher = mock.patch("agentless.utility.lease_engine", engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.logger = logging.getLogger("Agentless")
+        self.utility = Utility()
+        self.utility.all_devices(["/dev/sdf", "/dev/sdg"], logger=self.logger, extra=EXTRA)
+        self.lock = threading.Lock()
+        self.torn_down = []
+        self.failing = set()
+
+    def steps(self, job):
+        if job.volume_id in self.failing:
+            raise Exception("Detach failed")
+        if job.device_lease:
+            self.utility.release_device(job.device, job.device_lease, logger=self.logger, extra=EXTRA)
+        with self.lock:
+            self.torn_down.append(job.volume_id)
+
+    def queue(self):
+        queue = TeardownQueue(self.steps, utility=self.utility, workers=2, logger=self.logger, extra=EXTRA)
+        self.addCleanup(queue.executor.shutdown)
+        return queue
+
+    def rows(self):
+        with self.engine.begin() as connection:
+            return connection.execute(text('SELECT volume_id, attempts, owner_pid FROM "teardown" ORDER BY volume_id')).fetchall()
+
+    def record(self, volume_id, device=None, owner_pid=None):
+        self.assertTrue(self.utility.save_teardown({'id': volume_id.replace("-", ""), 'volume_id': volume_id, 'device': device, 'mounted_path': None, 'scratch_path': None,
+                                                    'tenant_id': "tenant", 'scan_id': "scan", 'instance_id': "i-1", 'snapshot_id': "snap-" + volume_id},
+                                                   logger=self.logger, extra=EXTRA))
+        with self.engine.begin() as connection:
+            connection.execute(text('UPDATE "teardown" SET owner_pid = :pid WHERE volume_id = :volume_id'), {'pid': owner_pid, 'volume_id': volume_id})
+
+    def test_teardown_removes_record(self):
+        queue = self.queue()
+        queue.submit(scan_job("vol-1"))
+        queue.submit(scan_job("vol-2"))
+        self.assertEqual(queue.drain(), [])
+        self.assertEqual(sorted(self.torn_down), ["vol-1", "vol-2"])
+        self.assertEqual(self.rows(), [])
+
+    def test_resume_teardowns_of_exited_process(self):
+        leased = self.utility.get_device(logger=self.logger, extra=EXTRA)
+        self.record("vol-1", device=leased['device'], owner_pid=DEAD_PID)
+        self.record("vol-2")
+        # a teardown run by a live process is left to it
+        self.record("vol-3", owner_pid=os.getppid())
+        with self.engine.begin() as connection:
+            connection.execute(text('UPDATE "device" SET owner_pid = :pid WHERE value = :value'), {'pid': DEAD_PID, 'value': leased['device']})
+        queue = self.queue()
+        self.assertEqual(queue.resume(resumed_job), 2)
+        self.assertEqual(queue.drain(), [])
+        self.assertEqual(sorted(self.torn_down), ["vol-1", "vol-2"])
+        self.assertEqual(self.rows(), [("vol-3", 0, os.getppid())])
+        # the slot of the leftover volume is free once it is torn down
+        self.assertEqual(self.utility.free_device_count(logger=self.logger, extra=EXTRA), 2)
+
+    def test_failed_teardown_is_resumed_until_attempts_run_out(self):
+        self.failing.add("vol-1")
+        queue = self.queue()
+        queue.submit(scan_job("vol-1"))
+        self.assertEqual(len(queue.drain()), 1)
+        self.assertEqual(self.rows(), [("vol-1", 1, None)])
+        for _ in range(MAX_TEARDOWN_ATTEMPTS - 1):
+            self.assertEqual(queue.resume(resumed_job), 1)
+            self.assertEqual(len(queue.drain()), 1)
+        self.assertEqual(self.rows(), [])
+        self.assertEqual(queue.resume(resumed_job), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import logging
+import os
+import unittest
+from unittest import mock
+
+import boto3
+from botocore.exceptions import ClientError
+from moto import mock_s3
+
+from agentless.upload import MultipartUploadWriter, MIN_PART_SIZE
+
+BUCKET = "agentless-test"
+KEY = "agentless-va/tenant/scan/tosend.tar.gz"
+EXTRA = {'scanId': None, 'tenantId': None}
+
+
+@mock_s3
+class TestMultipartUploadWriter(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+        self.client = boto3.client("s3", region_name="us-east-1")
+        self.client.create_bucket(Bucket=BUCKET)
+        self.logger = logging.getLogger("Agentless")
+        # two full parts and a short last one
+        self.data = os.urandom(2 * MIN_PART_SIZE + 1024)
+
+    def writer(self):
+        return MultipartUploadWriter(self.client, BUCKET, KEY, self.logger, EXTRA, part_size=MIN_PART_SIZE, parts_in_flight=2)
+
+    def assert_nothing_stored(self):
+        self.assertNotIn("Uploads", self.client.list_multipart_uploads(Bucket=BUCKET))
+        with self.assertRaises(ClientError):
+            self.client.head_object(Bucket=BUCKET, Key=KEY)
+
+    def test_completed_upload(self):
+        with self.writer() as writer:
+            # writes smaller than a part are buffered until a part is full
+            for offset in range(0, len(self.data), 1024 * 1024):
+                writer.write(self.data[offset:offset + 1024 * 1024])
+        self.assertEqual(writer.part_number, 3)
+        self.assertEqual(writer.bytes_written, len(self.data))
+        self.assertEqual(self.client.get_object(Bucket=BUCKET, Key=KEY)["Body"].read(), self.data)
+        self.assertNotIn("Uploads", self.client.list_multipart_uploads(Bucket=BUCKET))
+
+    def test_empty_upload(self):
+        with self.writer():
+            pass
+        self.assertEqual(self.client.get_object(Bucket=BUCKET, Key=KEY)["Body"].read(), b"")
+
+    def test_failed_part_aborts_upload(self):
+        upload_part = self.client.upload_part
+
+        def fail_second_part(**kwargs):
+            if kwargs["PartNumber"] == 2:
+                raise ClientError({"Error": {"Code": "AccessDenied", "Message": "Access Denied"}}, "UploadPart")
+            return upload_part(**kwargs)
+
+        writer = self.writer()
+        with mock.patch.object(self.client, "upload_part", side_effect=fail_second_part) as patched:
+            with self.assertRaises(ClientError):
+                writer.write(self.data)
+                writer.close()
+        # terminal errors are not retried
+        self.assertEqual([call.kwargs["PartNumber"] for call in patched.call_args_list].count(2), 1)
+        self.assertTrue(writer.closed)
+        self.assert_nothing_stored()
+
+    def test_exception_aborts_upload(self):
+        with self.assertRaises(ValueError):
+            with self.writer() as writer:
+                writer.write(self.data)
+                raise ValueError("archive failed")
+        self.assertTrue(writer.closed)
+        self.assert_nothing_stored()
+
+
+if __name__ == '__main__':
+    unittest.main()
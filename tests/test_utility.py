@@ -0,0 +1,108 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import sqlalchemy as sa
+from sqlalchemy import event, text
+
+from agentless import model
+from agentless.utility import Utility
+
+EXTRA = {'scanId': None, 'tenantId': None}
+DEVICES = ["/dev/sdf", "/dev/sdg"]
+
+
+class TestDeviceLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # a database of its own per test, set up like model.lease_engine
+        engine = sa.create_engine("sqlite:////{}".format(os.path.join(self.directory, "devices.db")))
+        event.listen(engine, "connect", model.set_sqlite_pragma)
+        event.listen(engine, "connect", model.disable_pysqlite_begin)
+        event.listen(engine, "begin", model.begin_immediate)
+        model.Base.metadata.create_all(engine)
+        self.addCleanup(engine.dispose)
+        self.engine = engine
+        for patcher in (mock.patch("agentless.utility.lease_engine", engine),
+                        mock.patch("agentless.utility.shnbin_common.get_app_data_path", return_value=self.directory)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.logger = logging.getLogger("Agentless")
+        self.utility = Utility()
+        self.utility.all_devices(DEVICES, logger=self.logger, extra=EXTRA)
+
+    def get_device(self):
+        return self.utility.get_device(logger=self.logger, extra=EXTRA)
+
+    def release(self, leased):
+        return self.utility.release_device(leased['device'], leased['owner'], logger=self.logger, extra=EXTRA)
+
+    def slot(self, device):
+        with self.engine.begin() as connection:
+            return connection.execute(text('SELECT status, owner, owner_pid, lease_expires FROM "device" WHERE value = :value'), {'value': device}).fetchone()
+
+    def expire(self, device, **columns):
+        assignments = ", ".join("{} = :{}".format(name, name) for name in columns)
+        with self.engine.begin() as connection:
+            connection.execute(text('UPDATE "device" SET {} WHERE value = :value'.format(assignments)), dict(columns, value=device))
+
+    def test_claim_and_release(self):
+        first, second = self.get_device(), self.get_device()
+        self.assertEqual([first['device'], second['device']], DEVICES)
+        self.assertEqual(self.get_device(), {'device': False, 'owner': None})
+        self.assertEqual(self.utility.free_device_count(logger=self.logger, extra=EXTRA), 0)
+        self.assertTrue(self.release(first))
+        self.assertEqual(self.slot(first['device'])[:2], (1, None))
+        self.assertEqual(self.get_device()['device'], first['device'])
+
+    def test_expired_lease_is_reclaimed(self):
+        stale = self.get_device()
+        self.get_device()
+        # the holder stopped renewing its lease
+        self.expire(stale['device'], lease_expires=time.time() - 1)
+        self.assertEqual(self.utility.free_device_count(logger=self.logger, extra=EXTRA), 1)
+        reclaimed = self.get_device()
+        self.assertEqual(reclaimed['device'], stale['device'])
+        self.assertNotEqual(reclaimed['owner'], stale['owner'])
+        # the former holder releasing late does not free the slot of the new holder
+        self.assertFalse(self.release(stale))
+        self.assertEqual(self.slot(stale['device'])[:2], (0, reclaimed['owner']))
+        self.assertTrue(self.release(reclaimed))
+
+    def test_slot_of_exited_process_is_reclaimed(self):
+        leased = self.get_device()
+        self.get_device()
+        self.expire(leased['device'], owner="1:exited", owner_pid=os.getpid() + 1)
+        with mock.patch.object(Utility, "is_process_alive", return_value=False):
+            reclaimed = self.get_device()
+        self.assertEqual(reclaimed['device'], leased['device'])
+        self.assertGreater(self.slot(leased['device'])[3], time.time())
+
+    def test_renewal_extends_lease(self):
+        leased = self.get_device()
+        self.expire(leased['device'], lease_expires=time.time() + 1)
+        self.assertTrue(self.utility.renew_leases(logger=self.logger, extra=EXTRA))
+        self.assertGreater(self.slot(leased['device'])[3], time.time() + 60)
+
+    def test_adopt_device(self):
+        leased = self.get_device()
+        self.assertFalse(self.utility.adopt_device(leased['device'], logger=self.logger, extra=EXTRA))
+        self.assertTrue(self.release(leased))
+        owner = self.utility.adopt_device(leased['device'], logger=self.logger, extra=EXTRA)
+        self.assertTrue(owner)
+        self.assertTrue(self.utility.release_device(leased['device'], owner, logger=self.logger, extra=EXTRA))
+
+    def test_pool_shrinks_around_held_slots(self):
+        leased = self.get_device()
+        devices = self.utility.all_devices(["/dev/sdh"], logger=self.logger, extra=EXTRA)['device']
+        self.assertEqual(devices, [(leased['device'], False), ("/dev/sdh", True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import logging
+import threading
+import unittest
+
+from agentless.waiter import VolumeWaiter
+
+EXTRA = {'scanId': None, 'tenantId': None}
+
+
+class Ec2Client:
+    """
+    describe_volumes paginator over volume states that change after a number of calls
+    """
+
+    def __init__(self, states):
+        # volume id to the list of states returned by successive calls, missing volumes are not visible yet
+        self.states = states
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "describe_volumes"
+        return self
+
+    def paginate(self, Filters):
+        volume_ids = Filters[0]["Values"]
+        with self.lock:
+            self.calls.append(list(volume_ids))
+            volumes = []
+            for volume_id in volume_ids:
+                states = self.states.get(volume_id)
+                if states:
+                    volumes.append({"VolumeId": volume_id, "State": states.pop(0) if len(states) > 1 else states[0]})
+        return [{"Volumes": volumes}]
+
+
+class TestVolumeWaiter(unittest.TestCase):
+
+    def waiter(self, client):
+        return VolumeWaiter(lambda: client, logging.getLogger("Agentless"), EXTRA, min_interval=0.01, max_interval=0.05)
+
+    def test_concurrent_waits_share_describe_calls(self):
+        client = Ec2Client({"vol-{}".format(index): ["creating"] * index + ["available"] for index in range(1, 6)})
+        waiter = self.waiter(client)
+        results = {}
+
+        def wait(volume_id):
+            results[volume_id] = waiter.wait(volume_id, states=("available",), timeout=5, extra=EXTRA)
+
+        threads = [threading.Thread(target=wait, args=(volume_id,)) for volume_id in client.states]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(results.values()), {"available"})
+        self.assertEqual(len(results), 5)
+        # one batched call per poll instead of one per volume and poll
+        self.assertEqual(waiter.describe_calls, len(client.calls))
+        self.assertLess(len(client.calls), 5 * 6)
+        self.assertTrue(any(len(volume_ids) > 1 for volume_ids in client.calls))
+
+    def test_volume_not_visible_yet(self):
+        client = Ec2Client({})
+        waiter = self.waiter(client)
+        timer = threading.Timer(0.1, client.states.__setitem__, args=("vol-1", ["available"]))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(waiter.wait("vol-1", states=("available",), timeout=5, extra=EXTRA), "available")
+
+    def test_error_state_fails_fast(self):
+        waiter = self.waiter(Ec2Client({"vol-1": ["creating", "error"]}))
+        self.assertEqual(waiter.wait("vol-1", states=("available",), timeout=5, extra=EXTRA), "error")
+
+    def test_timeout(self):
+        waiter = self.waiter(Ec2Client({"vol-1": ["creating"]}))
+        self.assertIsNone(waiter.wait("vol-1", states=("available",), timeout=0.1, extra=EXTRA))
+        self.assertEqual(waiter._waiters, {})
+
+
+if __name__ == '__main__':
+    unittest.main()